@@ -1,13 +1,32 @@
 import os
-import shutil
+import asyncio
+import functools
+import json
+import mimetypes
+import threading
+import time
 import uvicorn
-import uuid
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from collections import deque
+from contextlib import suppress
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 from pyngrok import ngrok, conf
-from typing import Union
+from typing import List, Optional, Union
 
 # Import your custom class from the inference.py file
-from inference import SimpleInference
+from inference import SimpleInference, VISUAL_TOKEN_BUDGETS as DEFAULT_VISUAL_TOKEN_BUDGETS
+from batching import BatchingInference, QueueFullError
+from replica_pool import ReplicaPool, parse_replicas
+from fake_inference import FakeInference
+from image_store import ImageStore, StoredImage, content_image_id, decode_image
+from retrieval import ReferenceIndex
+from reference_store import ReferenceStore
+from streaming import AsyncTextStreamer, sse_event
+from structured_output import StreamingAnswerParser
+from preverify import PreVerifier
+from result_cache import ResultCache, image_hash, normalize_text
+from metrics import metrics
 
 # --- Import your mini-dataset from a separate file ---
 # Assuming dataset.py contains DATASET_IMAGES dictionary
@@ -18,143 +37,961 @@ VERIFIED_DIR = "verified_images"
 os.makedirs(VERIFIED_DIR, exist_ok=True)
 os.makedirs("dataset", exist_ok=True) # Ensure your dataset directory exists
 
+MODEL_ID = os.environ.get("ROBOBRAIN_MODEL_ID", "BAAI/RoboBrain2.0-3B")
+# Device of the model: "cuda", "cuda:1", "cpu", ... (default: spread over the GPUs, or the CPU if there is none)
+DEVICE = os.environ.get("ROBOBRAIN_DEVICE") or None
+# Model replicas in their own processes, e.g. "cuda*2", "cpu*4" or "cuda:0;cpu:0-7" (empty: one model in this process)
+REPLICAS = os.environ.get("ROBOBRAIN_REPLICAS", "")
+# Serve with fake_inference.FakeInference instead of the model, e.g. for load tests without a GPU.
+# JSON of its options, e.g. '{"latency_ms": 80, "per_request_ms": 10}' (empty: the real model)
+FAKE_MODEL = os.environ.get("ROBOBRAIN_FAKE_MODEL", "")
+
+# Concurrent /verify and /prompt calls are grouped into one generate call of up to
+# MAX_BATCH_SIZE requests, waiting at most MAX_BATCH_WAIT_MS for the batch to fill up
+MAX_BATCH_SIZE = int(os.environ.get("ROBOBRAIN_MAX_BATCH_SIZE", 8))
+MAX_BATCH_WAIT_MS = float(os.environ.get("ROBOBRAIN_MAX_BATCH_WAIT_MS", 10))
+# Requests beyond this many waiting for the model are rejected with 503 + Retry-After
+MAX_QUEUE_SIZE = int(os.environ.get("ROBOBRAIN_MAX_QUEUE_SIZE", 32))
+# Verified images live in memory; writing them to VERIFIED_DIR happens in the background and can be turned off
+IMAGE_STORE_SIZE = int(os.environ.get("ROBOBRAIN_IMAGE_STORE_SIZE", 256))
+PERSIST_VERIFIED_IMAGES = os.environ.get("ROBOBRAIN_PERSIST_VERIFIED", "1") == "1"
+# VERIFIED_DIR is capped by file count, size and time since last use; the least recently used images go first
+VERIFIED_MAX_FILES = int(os.environ.get("ROBOBRAIN_VERIFIED_MAX_FILES", 10000))
+VERIFIED_MAX_MB = float(os.environ.get("ROBOBRAIN_VERIFIED_MAX_MB", 2048))
+VERIFIED_TTL_HOURS = float(os.environ.get("ROBOBRAIN_VERIFIED_TTL_HOURS", 24 * 7))
+# DATASET_IMAGES are resized to REFERENCE_MAX_SIZE on first use and the copies kept in REFERENCE_CACHE_DIR
+REFERENCE_CACHE_DIR = os.environ.get("ROBOBRAIN_REFERENCE_CACHE_DIR", "dataset/.cache")
+REFERENCE_MAX_SIZE = int(os.environ.get("ROBOBRAIN_REFERENCE_MAX_SIZE", 480))
+# Preprocessed DATASET_IMAGES tensors are cached up to this size, and built at startup unless disabled
+REFERENCE_CACHE_MB = float(os.environ.get("ROBOBRAIN_REFERENCE_CACHE_MB", 256))
+WARM_REFERENCE_CACHE = os.environ.get("ROBOBRAIN_WARM_REFERENCE_CACHE", "1") == "1"
+# Vision-encoder outputs per verified image and reference, so later prompts skip the vision tower (0 disables)
+VISION_CACHE_MB = float(os.environ.get("ROBOBRAIN_VISION_CACHE_MB", 512))
+# Visual tokens (min, max) per task and image role, as JSON merged over inference.VISUAL_TOKEN_BUDGETS,
+# e.g. '{"verify": {"image": [4, 128]}, "pointing": {"image": [256, 2048]}}'
+VISUAL_TOKEN_BUDGETS = json.loads(os.environ.get("ROBOBRAIN_VISUAL_TOKEN_BUDGETS", "{}"))
+# "classify" scores 'same' vs 'different' in one forward pass; "generate" keeps the free-form answer
+VERIFY_MODE = os.environ.get("ROBOBRAIN_VERIFY_MODE", "classify")
+DEFAULT_VERIFY_THRESHOLD = float(os.environ.get("ROBOBRAIN_VERIFY_THRESHOLD", 0.5))
+# Minimum retrieval score for an object_id / prompt to use a reference image (RAG) instead of the model alone
+RAG_THRESHOLD = float(os.environ.get("ROBOBRAIN_RAG_THRESHOLD", 0.75))
+# RAG verification first matches keypoints against the reference; only ambiguous cases go to the model
+PREVERIFY = os.environ.get("ROBOBRAIN_PREVERIFY", "1") == "1"
+PREVERIFY_ACCEPT_INLIERS = int(os.environ.get("ROBOBRAIN_PREVERIFY_ACCEPT_INLIERS", 25))
+PREVERIFY_REJECT_INLIERS = int(os.environ.get("ROBOBRAIN_PREVERIFY_REJECT_INLIERS", 3))
+# Verify and pointing results of near-duplicate images (perceptual hash within RESULT_CACHE_DISTANCE bits) are reused (0 disables)
+RESULT_CACHE_SIZE = int(os.environ.get("ROBOBRAIN_RESULT_CACHE_SIZE", 1024))
+RESULT_CACHE_TTL = float(os.environ.get("ROBOBRAIN_RESULT_CACHE_TTL", 300))
+RESULT_CACHE_DISTANCE = int(os.environ.get("ROBOBRAIN_RESULT_CACHE_DISTANCE", 4))
+# Per-stage timings of every request, as /metrics histograms and an X-Timing header (metrics.py reads the
+# same variable, so model replica processes follow it)
+METRICS = os.environ.get("ROBOBRAIN_METRICS", "1") == "1"
+metrics.enabled = METRICS
+
 app = FastAPI(
     title="RoboBrain Stateful API",
-    description="A two-step API with RAG: 1. Verify an image. 2. Use the ID to send prompts.",
+    description="A two-step API with RAG: 1. Verify an image. 2. Use the ID to send prompts. /verify_and_point does both in one call, /prompt_stream streams the answer, /ws keeps a session open for a stream of frames.",
     version="4.0.0"
 )
 
+# --- Reference Images ---
+reference_store = ReferenceStore(DATASET_IMAGES, cache_dir=REFERENCE_CACHE_DIR, max_size=REFERENCE_MAX_SIZE)
+# Object ids and prompts are matched against the reference names with one vectorized query
+reference_index = ReferenceIndex(threshold=RAG_THRESHOLD)
+reference_index.add_many({name: reference_store.source(name) for name in reference_store})
+
 # --- Model Loading ---
 print("Initializing server and loading model...")
-model = SimpleInference("BAAI/RoboBrain2.0-3B")
+model_options = dict(
+    reference_cache_bytes=int(REFERENCE_CACHE_MB * 1024 * 1024),
+    vision_cache_bytes=int(VISION_CACHE_MB * 1024 * 1024),
+    visual_token_budgets={
+        task: {**DEFAULT_VISUAL_TOKEN_BUDGETS.get(task, {}), **{role: tuple(tokens) for role, tokens in VISUAL_TOKEN_BUDGETS.get(task, {}).items()}}
+        for task in {*DEFAULT_VISUAL_TOKEN_BUDGETS, *VISUAL_TOKEN_BUDGETS}
+    }
+)
+if FAKE_MODEL:
+    print(f"Serving with a fake model: {FAKE_MODEL}")
+    model = FakeInference(**model_options, **json.loads(FAKE_MODEL))
+elif REPLICAS:
+    # This process only preprocesses images; every replica process loads the weights on its own device
+    model = ReplicaPool(
+        parse_replicas(REPLICAS),
+        functools.partial(SimpleInference, MODEL_ID, **model_options),
+        frontend=SimpleInference(MODEL_ID, load_model=False, **model_options)
+    )
+else:
+    model = SimpleInference(MODEL_ID, device=DEVICE, **model_options)
+pre_verifier = PreVerifier(accept_inliers=PREVERIFY_ACCEPT_INLIERS, reject_inliers=PREVERIFY_REJECT_INLIERS) if PREVERIFY else None
+if WARM_REFERENCE_CACHE:
+    reference_paths = reference_store.warm()
+    model.reference_cache.warm(reference_paths, budgets={model.pixel_budget(task, "reference") for task in ("verify_based_on_reference", "pointing_based_on_reference")})
+    if pre_verifier is not None:
+        pre_verifier.warm(reference_paths)
+# One batching worker per replica, so every replica always has a batch to run
+engine = BatchingInference(model, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_BATCH_WAIT_MS, max_queue_size=MAX_QUEUE_SIZE, num_workers=len(model) if isinstance(model, ReplicaPool) else 1)
+# Cached embeddings of a verified image live exactly as long as the image stays in memory
+image_store = ImageStore(
+    max_images=IMAGE_STORE_SIZE,
+    persist_dir=VERIFIED_DIR if PERSIST_VERIFIED_IMAGES else None,
+    on_evict=model.forget_image,
+    max_files=VERIFIED_MAX_FILES,
+    max_bytes=int(VERIFIED_MAX_MB * 1024 * 1024),
+    ttl=VERIFIED_TTL_HOURS * 3600
+)
+result_cache = ResultCache(max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, max_distance=RESULT_CACHE_DISTANCE) if RESULT_CACHE_SIZE > 0 else None
 print("Model loaded. Server is ready.")
 
-# --- API Endpoints ---
-@app.get("/")
-def root():
-    return {"message": "Welcome to the Stateful RoboBrain API. Use /verify and /prompt endpoints."}
+# --- Helpers ---
+def queue_full(e: QueueFullError) -> HTTPException:
+    print(f"Inference queue full ({engine.queue_depth()} waiting). Rejecting request.")
+    return HTTPException(
+        status_code=503,
+        detail="RoboBrain is busy, please retry shortly.",
+        headers={"Retry-After": str(e.retry_after)}
+    )
 
-@app.post("/verify")
-async def verify_image_and_get_id(
-    object_id: str = Form(..., description="A description of the object to verify in the image."),
-    image: UploadFile = File(...)
-):
+async def run_inference(mode="generate", **request):
+    """Hand a request to the inference worker without blocking the event loop."""
+    try:
+        future = engine.submit_classify(**request) if mode == "classify" else engine.submit(**request)
+    except QueueFullError as e:
+        raise queue_full(e)
+    result = await asyncio.wrap_future(future)
+    trace_results(result)
+    return result
+
+def trace_results(*results):
     """
-    Verifies an object using RAG if a keyword is detected, otherwise uses the foundation model only.
+    Add the queue wait, model time, model stages ("model.generate", ...) and token counts of results to
+    the trace of the running request. Results from one batch share their stages, so those count once.
     """
-    temp_upload_path = os.path.join(VERIFIED_DIR, f"temp_{image.filename}")
-    
+    trace = metrics.current()
+    if trace is None:
+        return
+    stages = {}
+    for result in results:
+        timing = result.get("timing") or {}
+        breakdown = result.get("stages") or {}
+        durations = [("queue_wait", timing.get("wait_ms")), ("model", timing.get("service_ms"))]
+        durations += [(f"model.{stage}", ms) for stage, ms in breakdown.get("stages_ms", {}).items()]
+        for stage, ms in durations:
+            if ms is not None:
+                stages[stage] = max(stages.get(stage, 0.0), ms / 1000)
+        for name, value in breakdown.items():
+            if name != "stages_ms":
+                trace.count(name, value)
+    for stage, seconds in stages.items():
+        trace.add(stage, seconds)
+
+def inference_events(**request):
+    """
+    Return an async iterator of the (event, data) pairs of a generation:
+    "text" for every new piece of text, "point" (or "box") as soon as a coordinate tuple is complete,
+    then "done" with the result dict, or "error". Raises QueueFullError if the queue is already full.
+    The generation is only queued once the iterator is first read, so a response whose body is never
+    sent (e.g. the client disconnected first) queues nothing; closing the iterator cancels it.
+    """
+    if engine.max_queue_size and engine.queue_depth() >= engine.max_queue_size:
+        raise QueueFullError(engine.retry_after())
+    streamer = AsyncTextStreamer(model.processor.tokenizer, asyncio.get_running_loop())
+    cancel = threading.Event()
+
+    # Streamed coordinates are mapped back to the original image like the final result is
+    images = request.get("image")
+    scale = model.output_scale(images[0] if isinstance(images, list) else images)
+    parser = StreamingAnswerParser(request.get("task", "general"), request.get("enable_thinking", True), scale=scale)
+    item_event = "box" if parser.output_type == "boxes" else "point"
+
+    async def events():
+        try:
+            future = engine.submit_stream(streamer=streamer, cancel=cancel, **request)
+        except QueueFullError as e:
+            # The queue filled up between the check above and the first read
+            print(f"Inference queue full ({engine.queue_depth()} waiting). Rejecting streamed request.")
+            yield "error", {"status": 503, "detail": "RoboBrain is busy, please retry shortly.", "retry_after": e.retry_after}
+            return
+        # Also wakes up the reader when the request fails or is cancelled before generating anything
+        future.add_done_callback(lambda _: streamer.close())
+        try:
+            while True:
+                chunk = await streamer.queue.get()
+                if chunk is None:
+                    break
+                yield "text", {"text": chunk}
+                for item in parser.feed(chunk):
+                    yield item_event, {"index": len(parser.items) - 1, item_event: item}
+            try:
+                result = await asyncio.wrap_future(future)
+            except Exception as e:
+                print(f"An error occurred during a streamed task: {e}")
+                yield "error", {"detail": f"An internal server error occurred: {e}"}
+                return
+            print("Streamed task complete.")
+            trace_results(result)
+            yield "done", result
+        finally:
+            if not future.done():
+                print("Client disconnected. Cancelling generation.")
+                cancel.set()
+                future.cancel()
+
+    return events()
+
+def stream_inference(events, first_events=(), extra_result=None) -> StreamingResponse:
+    """
+    Stream (event, data) pairs, e.g. from inference_events, back as Server-Sent Events.
+    "done" carries the same result dict the non-streaming endpoint returns.
+    If the client disconnects, the generation is cancelled.
+    """
+    async def body():
+        try:
+            for event in first_events:
+                yield event
+            async for event, data in events:
+                yield sse_event(event, {**data, **(extra_result or {})} if event == "done" else data)
+        finally:
+            await events.aclose()
+
+    return StreamingResponse(body(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def decode_and_hash(data: bytes):
+    with metrics.span("decode"):
+        decoded = decode_image(data)
+    with metrics.span("phash"):
+        phash = image_hash(decoded)
+    return decoded, phash
+
+async def read_image(data: bytes, file_extension: str) -> StoredImage:
+    """
+    Decode and hash image bytes off the event loop, without writing them to disk.
+    The image_id is derived from the bytes, so an identical upload reuses the id (and the stored copy).
+    Preprocessing for the model waits until `image_input` needs it, so requests answered by the result
+    cache or the keypoint pre-check never pay for it.
+    """
+    image_id = content_image_id(data)
+    stored = image_store.get(image_id)
+    if stored is not None and stored.phash is not None:
+        return stored
     try:
-        with open(temp_upload_path, "wb") as buffer:
-            shutil.copyfileobj(image.file, buffer)
+        decoded, phash = await run_in_threadpool(decode_and_hash, data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StoredImage(image_id, decoded, data, file_extension, phash=phash)
 
-        # Check if the object ID is a keyword in your mini-dataset
-        reference_image_path = DATASET_IMAGES.get(object_id.lower())
-        
-        if reference_image_path:
-            # --- KEYWORD DETECTED: USE RAG ---
-            print(f"Keyword '{object_id}' detected. Running RAG verification.")
-            images_for_inference = [os.path.abspath(temp_upload_path), reference_image_path]
-            task_for_inference = "verify_based_on_reference"
-        else:
-            # --- KEYWORD NOT DETECTED: USE FOUNDATION MODEL ONLY ---
-            print(f"Keyword '{object_id}' not found. Running verification with foundation model only.")
-            images_for_inference = [os.path.abspath(temp_upload_path)]
-            task_for_inference = "verify"
+async def read_upload(image: UploadFile) -> StoredImage:
+    """Read an upload and decode it like read_image."""
+    with metrics.span("upload_read"):
+        data = await image.read()
+    file_extension = os.path.splitext(image.filename or "")[1].lower() or ".png"
+    return await read_image(data, file_extension)
+
+def discard(stored: StoredImage):
+    """Drop the cached embeddings of an image that failed verification, unless it is also a verified image."""
+    if stored.image_id not in image_store:
+        model.forget_image(stored.image_id)
+
+async def get_verified_image(image_id: str) -> StoredImage:
+    """Look the image up in memory, falling back to images persisted by an earlier run."""
+    stored = image_store.get(image_id)
+    if stored is None:
+        stored = await run_in_threadpool(image_store.load_from_disk, image_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail=f"Image with ID '{image_id}' not found. Please verify the image first.")
+    if stored.phash is None:
+        with metrics.span("phash"):
+            stored.phash = image_hash(stored.image)
+    return stored
+
+async def image_input(stored: StoredImage, task: str):
+    """Preprocessed tensors of a stored image at the visual-token budget of `task`, encoded on first use."""
+    budget = model.pixel_budget(task, "image")
+    encoded = stored.encodings.get(budget)
+    if encoded is None:
+        encoded = await run_in_threadpool(model.encode_image, stored.image, key=stored.image_id, budget=budget)
+        stored.encodings[budget] = encoded
+    return encoded
+
+def load_reference(name: str, task: str):
+    # Resizes the reference on first use, then preprocesses it at the task's budget (both cached)
+    return model.reference_cache.get(reference_store[name], model.pixel_budget(task, "reference"))
+
+async def get_reference(name: str, task: str):
+    """Preprocessed tensors of a RAG reference image for `task`, from the reference cache."""
+    return await run_in_threadpool(load_reference, name, task)
+
+def cached_result(key, stored: StoredImage):
+    """A result cached for this request on this (or a nearly identical) image, or None."""
+    if result_cache is None:
+        return None
+    return result_cache.get(key, stored.phash, stored.image.size)
+
+def cache_result(key, stored: StoredImage, result: dict):
+    if result_cache is not None and not result.get("cancelled"):
+        result_cache.put(key, stored.phash, stored.image.size, result)
+
+def pointing_cache_key(request: dict, reference):
+    return (request["task"], normalize_text(request["text"]), reference and reference["name"], request["enable_thinking"], request["do_sample"])
+
+def find_reference(query: str):
+    """The best matching reference as {"name", "path", "score"}, or None if nothing scores above RAG_THRESHOLD."""
+    match = reference_index.match(query)
+    if match is None:
+        return None
+    name, path, score = match
+    return {"name": name, "path": path, "score": round(score, 3)}
+
+def pre_verify(stored: StoredImage, name: str):
+    with metrics.span("preverify"):
+        return pre_verifier.check(stored.image, reference_store[name])
+
+async def verify_object(object_id: str, stored: StoredImage, find=find_reference, threshold=DEFAULT_VERIFY_THRESHOLD):
+    """
+    Verifies an object using RAG if a reference matches it, otherwise uses the foundation model only.
+    With a reference, a keypoint pre-check runs first and settles clear matches and clear mismatches
+    without the model. The result's "stage" says which one decided: "keypoints" or "model".
+    The pre-check's thresholds stand for DEFAULT_VERIFY_THRESHOLD, so a caller asking for a stricter
+    `threshold` gets no keypoint "same", and one asking for a looser one no keypoint "different".
+    """
+    # Look the object ID up in the reference index of your mini-dataset
+    reference = find(object_id)
+
+    if reference and pre_verifier is not None:
+        verdict, stats = await run_in_threadpool(pre_verify, stored, reference["name"])
+        if (verdict == "same" and threshold > DEFAULT_VERIFY_THRESHOLD) or (verdict == "different" and threshold < DEFAULT_VERIFY_THRESHOLD):
+            verdict = None
+        if verdict is not None:
+            print(f"Keypoint pre-check against '{reference['name']}': {verdict} ({stats['inliers']} inliers). Skipping the model.")
+            return {"answer": verdict, "stage": "keypoints", "keypoints": stats, "reference": reference}
+    
+    if reference:
+        # --- REFERENCE FOUND: USE RAG ---
+        print(f"Reference '{reference['name']}' matches '{object_id}' (score {reference['score']}). Running RAG verification.")
+        task_for_inference = "verify_based_on_reference"
+    else:
+        # --- NO REFERENCE FOUND: USE FOUNDATION MODEL ONLY ---
+        print(f"No reference matches '{object_id}'. Running verification with foundation model only.")
+        task_for_inference = "verify"
+
+    # Looked up before any preprocessing, which a hit does not need
+    cache_key = ("verify", task_for_inference, normalize_text(object_id), VERIFY_MODE, reference and reference["name"])
+    cached = cached_result(cache_key, stored)
+    if cached is not None:
+        print(f"Verification of '{object_id}' answered from the result cache.")
+        return {**cached, "reference": reference, "stage": "cache"}
+
+    images_for_inference = await request_images(stored, task_for_inference, reference)
 
-        # Run Verification with the selected images and task
-        verification_result = model.inference(
+    # Run Verification with the selected images and task
+    if VERIFY_MODE == "classify":
+        result = await run_inference(
+            text=object_id,
+            image=images_for_inference,
+            task=task_for_inference,
+            mode="classify"
+        )
+    else:
+        result = await run_inference(
             text=object_id,
             image=images_for_inference,
             task=task_for_inference,
-            plot=False,
             enable_thinking=False,
             do_sample=True
         )
+    cache_result(cache_key, stored, result)
+    result["reference"] = reference
+    result["stage"] = "model"
+    return result
 
-        if verification_result.get("answer") == "same":
-            # Verification successful, save image and return ID
-            image_id = str(uuid.uuid4())
-            file_extension = os.path.splitext(image.filename)[1]
-            permanent_path = os.path.join(VERIFIED_DIR, f"{image_id}{file_extension}")
-            os.rename(temp_upload_path, permanent_path)
-            
-            print(f"Verification successful. Image saved as {image_id}{file_extension}")
-            return {"status": "verified", "image_id": image_id}
+def is_verified(verification_result: dict, threshold: float) -> bool:
+    """Classification results pass when P('same') reaches the threshold, generated ones when the answer is 'same'."""
+    scores = verification_result.get("scores")
+    if scores is not None:
+        return scores["same"] >= threshold
+    return verification_result.get("answer") == "same"
+
+def same_probability(verification_result: dict):
+    """P('same') of a classification result, or None for generated answers."""
+    return verification_result.get("scores", {}).get("same")
+
+async def request_images(stored: StoredImage, task: str, reference):
+    """The preprocessed images of a request: the stored image, then the reference if there is one."""
+    images = [await image_input(stored, task)]
+    if reference:
+        images.append(await get_reference(reference["name"], task))
+    return images
+
+def pointing_request(prompt: str, find=find_reference):
+    """
+    Builds the pointing task for a prompt. RAG is enabled if a reference from the mini-dataset
+    matches the prompt. Returns the request and the matched reference. The request has no "image"
+    yet, so the result cache can be checked first; `request_images` adds them.
+    """
+    # Find the reference that best matches the prompt, if any scores high enough
+    reference = find(prompt)
+    
+    if reference:
+        # --- REFERENCE FOUND: USE RAG for pointing ---
+        print(f"Reference '{reference['name']}' matches the prompt (score {reference['score']}). Running RAG pointing task.")
+        task_for_inference = "pointing_based_on_reference"
+    else:
+        # --- NO REFERENCE FOUND: USE FOUNDATION MODEL ONLY ---
+        print("No reference matches the prompt. Running pointing with foundation model only.")
+        task_for_inference = "pointing"
+
+    request = {
+        "text": prompt,
+        "task": task_for_inference,
+        "enable_thinking": False,
+        "do_sample": True
+    }
+    return request, reference
+
+async def point_on_image(prompt: str, stored: StoredImage):
+    """Runs a pointing task on a verified image, or answers it from the result cache."""
+    request, reference = pointing_request(prompt)
+    cache_key = pointing_cache_key(request, reference)
+    result = cached_result(cache_key, stored)
+    if result is None:
+        request["image"] = await request_images(stored, request["task"], reference)
+        result = await run_inference(**request)
+        cache_result(cache_key, stored, result)
+    result["reference"] = reference
+    return result
+
+async def point_many(prompts: list, stored: StoredImage):
+    """
+    Runs several pointing tasks on one verified image. Every prompt gets its own reference lookup;
+    the ones not in the result cache run together as one padded batch. Results are in prompt order.
+    """
+    built = [pointing_request(prompt) for prompt in prompts]
+    keys = [pointing_cache_key(request, reference) for request, reference in built]
+    results = [cached_result(key, stored) for key in keys]
+
+    todo = [i for i, result in enumerate(results) if result is None]
+    if todo:
+        requests = [{**built[i][0], "image": await request_images(stored, built[i][0]["task"], built[i][1])} for i in todo]
+        do_sample = all(request.pop("do_sample", True) for request in requests)
+        try:
+            futures = engine.submit_many(requests, do_sample=do_sample)
+        except QueueFullError as e:
+            raise queue_full(e)
+        computed = await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+        trace_results(*computed)
+        for i, result in zip(todo, computed):
+            cache_result(keys[i], stored, result)
+            results[i] = result
+
+    for result, (_, reference) in zip(results, built):
+        result["reference"] = reference
+    return results
+
+async def replay_events(result: dict):
+    """The events inference_events would have produced for a finished (cached) result."""
+    item_event = "box" if "boxes" in result else "point"
+    items = result.get("boxes", result.get("points", result.get("trajectory", [])))
+    for index, item in enumerate(items):
+        yield item_event, {"index": index, item_event: item}
+    yield "done", result
+
+async def pointing_events(request: dict, reference, stored: StoredImage):
+    """
+    inference_events for a request from pointing_request, replayed from the result cache when possible;
+    a finished generation is added to the cache. Raises QueueFullError like inference_events.
+    """
+    cache_key = pointing_cache_key(request, reference)
+    cached = cached_result(cache_key, stored)
+    if cached is not None:
+        return replay_events(cached)
+    images = await request_images(stored, request["task"], reference)
+    events = inference_events(**request, image=images)
+
+    async def caching_events():
+        try:
+            async for event, data in events:
+                if event == "done":
+                    cache_result(cache_key, stored, data)
+                yield event, data
+        finally:
+            await events.aclose()
+
+    return caching_events()
+
+# --- WebSocket Sessions ---
+class ARSession:
+    """
+    State of one /ws connection: the current object_id, prompt and threshold, the last verified
+    frame and the references already matched, so later messages only carry what changed.
+    """
+
+    def __init__(self):
+        self.object_id = None
+        self.prompt = None
+        self.threshold = DEFAULT_VERIFY_THRESHOLD
+        # Also forward the "text" events; off by default, the points and the final result are enough for the client
+        self.text = False
+        # StoredImage of the last verified frame, the target of {"action": "prompt"}
+        self.verified = None
+        self.frames = 0
+        self.dropped = 0
+        # The job being worked on, so {"action": "cancel"} can stop it
+        self.running = None
+        self.closed = False
+        self._references = {}
+
+    def configure(self, message: dict):
+        """Apply the settings of a JSON message. Raises ValueError for an invalid threshold."""
+        for key in ("object_id", "prompt"):
+            if key in message:
+                setattr(self, key, str(message[key]))
+        if "threshold" in message:
+            self.threshold = min(1.0, max(0.0, float(message["threshold"])))
+        if "text" in message:
+            self.text = bool(message["text"])
+
+    def find_reference(self, query: str):
+        """find_reference, remembered for the rest of the session."""
+        if query not in self._references:
+            self._references[query] = find_reference(query)
+        return self._references[query]
+
+def frame_extension(data: bytes) -> str:
+    """File extension for the encoded bytes of a frame, used when it is persisted."""
+    if data.startswith(b"\x89PNG"):
+        return ".png"
+    if data[8:12] == b"WEBP":
+        return ".webp"
+    return ".jpg"
+
+async def receive_session_messages(websocket: WebSocket, session: ARSession, pending: deque, wake: asyncio.Event):
+    """
+    Read client messages into `pending` until the client disconnects. A frame that arrives while
+    an older one is still waiting replaces it, so the session always works on the latest frame.
+    """
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
+        if message.get("bytes") is not None:
+            session.frames += 1
+            stale = [job for job in pending if job["action"] == "frame"]
+            for job in stale:
+                pending.remove(job)
+            session.dropped += len(stale)
+            pending.append({
+                "action": "frame",
+                "frame": session.frames,
+                "data": message["bytes"],
+                "object_id": session.object_id,
+                "prompt": session.prompt,
+                "threshold": session.threshold
+            })
+        else:
+            try:
+                settings = json.loads(message.get("text") or "")
+                if not isinstance(settings, dict):
+                    raise ValueError("Messages must be JSON objects.")
+                session.configure(settings)
+            except ValueError as e:
+                pending.append({"action": "error", "detail": f"Invalid message: {e}"})
+            else:
+                if settings.get("action") == "prompt":
+                    pending.append({"action": "prompt", "prompt": session.prompt})
+                elif settings.get("action") == "cancel":
+                    # Stop the running job; the frames waiting behind it are only answered with "cancelled"
+                    for i, job in enumerate(pending):
+                        if job["action"] == "frame":
+                            pending[i] = {"action": "cancelled", "frame": job["frame"]}
+                    if session.running is not None:
+                        session.running.cancel()
+        wake.set()
+
+async def run_session_job(websocket: WebSocket, session: ARSession, job: dict):
+    """
+    Verify a frame and point on it, or point on the session's last verified frame, pushing
+    the events to the client as JSON messages. Failures are sent as "error" events with an HTTP status.
+    Returns that status (200 on success).
+    """
+    frame = job.get("frame")
+
+    async def send(event: str, data: dict):
+        await websocket.send_json({"event": event, "frame": frame, **data})
+
+    try:
+        if job["action"] == "error":
+            raise HTTPException(status_code=400, detail=job["detail"])
+
+        prompt = job["prompt"]
+        if job["action"] == "frame":
+            if not job["object_id"] or not prompt:
+                raise HTTPException(status_code=400, detail="Send object_id and prompt before the first frame.")
+            data = job["data"]
+            stored = await read_image(data, frame_extension(data))
+            verification_result = await verify_object(job["object_id"], stored, find=session.find_reference, threshold=job["threshold"])
+            if not is_verified(verification_result, job["threshold"]):
+                discard(stored)
+                raise HTTPException(status_code=404, detail="YOU DARE LIE TO ROBOBRAIN????", headers={"X-Verify-Stage": verification_result["stage"]})
+
+            image_store.put(stored)
+            session.verified = stored
+            print(f"Session frame {frame} verified. Image stored as {stored.image_id}{stored.extension}")
+            await send("verified", {
+                "image_id": stored.image_id,
+                "confidence": same_probability(verification_result),
+                "stage": verification_result["stage"],
+                "dropped": session.dropped,
+                "timing": verification_result.get("timing")
+            })
+        else:
+            stored = session.verified
+            if stored is None:
+                raise HTTPException(status_code=404, detail="No frame has been verified in this session yet.")
+            if not prompt:
+                raise HTTPException(status_code=400, detail="Send a prompt first.")
+
+        request, reference = pointing_request(prompt, find=session.find_reference)
+        try:
+            events = await pointing_events(request, reference, stored)
+        except QueueFullError as e:
+            raise queue_full(e)
+        try:
+            async for event, data in events:
+                if event == "text" and not session.text:
+                    continue
+                await send(event, {**data, "reference": reference} if event == "done" else data)
+        finally:
+            await events.aclose()
+        return 200
+
+    except HTTPException as e:
+        headers = e.headers or {}
+        extra = {}
+        if "Retry-After" in headers:
+            extra["retry_after"] = int(headers["Retry-After"])
+        if "X-Verify-Stage" in headers:
+            extra["stage"] = headers["X-Verify-Stage"]
+        await send("error", {"status": e.status_code, "detail": e.detail, **extra})
+        return e.status_code
+    except Exception as e:
+        print(f"An error occurred in a WebSocket session: {e}")
+        await send("error", {"status": 500, "detail": f"An internal server error occurred: {e}"})
+        return 500
+
+async def run_session_jobs(websocket: WebSocket, session: ARSession, pending: deque, wake: asyncio.Event):
+    """Work through the session's pending messages one at a time, in order."""
+    while True:
+        await wake.wait()
+        while pending:
+            job = pending.popleft()
+            if job["action"] == "cancelled":
+                await websocket.send_json({"event": "cancelled", "frame": job["frame"]})
+                continue
+            # The job's task starts with its own trace, like an HTTP request does in time_request
+            with metrics.trace() as trace:
+                session.running = asyncio.create_task(run_session_job(websocket, session, job))
+            start = time.perf_counter()
+            status = 499
+            try:
+                status = await session.running
+            except asyncio.CancelledError:
+                if session.closed:
+                    raise
+                await websocket.send_json({"event": "cancelled", "frame": job.get("frame")})
+            finally:
+                session.running = None
+                if trace is not None:
+                    metrics.observe_request(f"/ws {job['action']}", status, time.perf_counter() - start, trace)
+        wake.clear()
+
+# --- Request Timing ---
+async def time_request(request: Request, call_next):
+    """
+    Trace every request by stage. The breakdown up to the response headers is sent back as X-Timing;
+    the whole request, including a streamed body, is observed into the /metrics histograms once sent.
+    """
+    start = time.perf_counter()
+    with metrics.trace() as trace:
+        response = await call_next(request)
+    response.headers["X-Timing"] = ", ".join(filter(None, [f"total={(time.perf_counter() - start) * 1000:.1f}", trace.header()]))
+    body = response.body_iterator
+
+    async def observed_body():
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            # Route templates ("/images/{image_id}") keep the number of series bounded
+            route = request.scope.get("route")
+            metrics.observe_request(getattr(route, "path", "unmatched"), response.status_code, time.perf_counter() - start, trace)
+
+    response.body_iterator = observed_body()
+    return response
+
+# Only installed with metrics on, so a disabled server has no middleware in its request path
+if METRICS:
+    app.middleware("http")(time_request)
+
+# --- API Endpoints ---
+@app.get("/")
+def root():
+    return {"message": "Welcome to the Stateful RoboBrain API. Use /verify and /prompt endpoints, /verify_and_point for both in one call, or the /ws WebSocket for a stream of frames."}
+
+@app.get("/stats")
+def stats():
+    """Queue and cache counters of the running server."""
+    return {
+        "queue_depth": engine.queue_depth(),
+        "verified_images_in_memory": len(image_store),
+        "verified_images_on_disk": image_store.directory.stats() if image_store.directory is not None else None,
+        "references": len(reference_store),
+        "reference_cache": model.reference_cache.stats(),
+        "vision_cache": model.vision_cache.stats() if model.vision_cache is not None else None,
+        "visual_token_budgets": model.visual_token_budgets,
+        "replicas": model.stats() if isinstance(model, ReplicaPool) else None,
+        "pre_verification": pre_verifier.stats() if pre_verifier is not None else None,
+        "result_cache": result_cache.stats() if result_cache is not None else None
+    }
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Request, stage and token histograms (see metrics.py) and queue gauges in the Prometheus text format."""
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled (ROBOBRAIN_METRICS=0).")
+    gauges = {
+        "robobrain_queue_depth": engine.queue_depth(),
+        "robobrain_verified_images_in_memory": len(image_store),
+    }
+    return Response(content=metrics.render(gauges), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/images")
+def list_images():
+    """Ids of the verified images this node holds, e.g. for the gateway to move them when the node is drained."""
+    return {"image_ids": image_store.image_ids()}
+
+@app.get("/images/{image_id}")
+async def download_image(image_id: str):
+    """The original bytes of a verified image."""
+    stored = await get_verified_image(image_id)
+    return Response(content=stored.data, media_type=mimetypes.guess_type(f"image{stored.extension}")[0] or "application/octet-stream")
+
+@app.post("/images")
+async def import_image(image: UploadFile = File(...)):
+    """
+    Store an image that was already verified on another node, without verifying it again.
+    The image_id is derived from the bytes, so it stays the same.
+    """
+    stored = await read_upload(image)
+    image_store.put(stored)
+    return {"image_id": stored.image_id}
+
+@app.get("/references")
+def search_references(query: str, k: int = 3):
+    """The k references that best match a prompt or object_id, with their retrieval scores."""
+    return {
+        "threshold": reference_index.threshold,
+        "matches": [{"name": name, "path": path, "score": round(score, 3)} for name, path, score in reference_index.search(query, k)]
+    }
+
+@app.post("/references")
+async def add_reference(
+    name: str = Form(..., description="The object name prompts and object ids are matched against."),
+    image: UploadFile = File(...)
+):
+    """
+    Adds (or replaces) a RAG reference image without restarting the server.
+    """
+    data = await image.read()
+    try:
+        await run_in_threadpool(decode_image, data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    file_extension = os.path.splitext(image.filename or "")[1].lower() or ".png"
+    path = await run_in_threadpool(reference_store.add_image, name, data, file_extension)
+    reference_index.add(name, path)
+    print(f"Reference '{name}' added from {path}.")
+    return {"status": "added", "name": name, "path": path, "references": len(reference_store)}
+
+@app.post("/verify")
+async def verify_image_and_get_id(
+    object_id: str = Form(..., description="A description of the object to verify in the image."),
+    image: UploadFile = File(...),
+    threshold: float = Form(DEFAULT_VERIFY_THRESHOLD, ge=0.0, le=1.0, description="Minimum P('same') to accept the object.")
+):
+    """
+    Verifies an object using RAG if a reference matches it, otherwise uses the foundation model only.
+    """
+    try:
+        stored = await read_upload(image)
+        verification_result = await verify_object(object_id, stored, threshold=threshold)
+
+        if is_verified(verification_result, threshold):
+            # Verification successful, keep the image and return ID
+            image_store.put(stored)
+            print(f"Verification successful. Image stored as {stored.image_id}{stored.extension}")
+            return {
+                "status": "verified",
+                "image_id": stored.image_id,
+                "confidence": same_probability(verification_result),
+                "reference": verification_result.get("reference"),
+                "stage": verification_result["stage"],
+                "timing": verification_result.get("timing")
+            }
         else:
             # Verification failed
-            os.remove(temp_upload_path)
+            discard(stored)
             print("Verification failed. Sending comedic error.")
             raise HTTPException(
                 status_code=404, 
-                detail="YOU DARE LIE TO ROBOBRAIN????"
+                detail="YOU DARE LIE TO ROBOBRAIN????",
+                headers={"X-Verify-Stage": verification_result["stage"]}
             )
             
+    except HTTPException:
+        raise
     except Exception as e:
-        if os.path.exists(temp_upload_path):
-            os.remove(temp_upload_path)
-        if isinstance(e, HTTPException):
-            raise e
         raise HTTPException(status_code=500, detail=f"An internal server error occurred: {e}")
 
 
 @app.post("/prompt")
 async def run_prompt_on_verified_image(
     image_id: str = Form(..., description="The unique ID of the previously verified image."),
-    prompt: str = Form(..., description="The pointing instruction for the model.")
+    prompt: Optional[str] = Form(None, description="The pointing instruction for the model."),
+    prompts: Optional[List[str]] = Form(None, description="Several pointing instructions for the same image (repeat the field), run as one batch.")
 ):
     """
     Runs a pointing task on an image that has already been verified,
     using its unique image_id. RAG is enabled if a keyword from the
     mini-dataset is detected in the prompt.
+    With `prompts`, every instruction is run in one batch and {"results": [...]} is returned in the same order.
     """
-    # Find the image file by its ID, checking common extensions
-    image_path = None
-    for ext in ['.png', '.jpg', '.jpeg', '.webp']:
-        potential_path = os.path.join(VERIFIED_DIR, f"{image_id}{ext}")
-        if os.path.exists(potential_path):
-            image_path = potential_path
-            break
-    
-    if not image_path:
-        raise HTTPException(status_code=404, detail=f"Image with ID '{image_id}' not found. Please verify the image first.")
+    if not prompt and not prompts:
+        raise HTTPException(status_code=422, detail="Send a prompt or one or more prompts.")
+    stored = await get_verified_image(image_id)
 
     try:
-        # --- NEW LOGIC: Check if the prompt contains a keyword for RAG ---
-        found_keyword = None
-        for keyword in DATASET_IMAGES.keys():
-            # Check for keyword existence in the lowercase prompt
-            if keyword in prompt.lower():
-                found_keyword = keyword
-                break
-        
-        if found_keyword:
-            # --- KEYWORD DETECTED: USE RAG for pointing ---
-            print(f"Keyword '{found_keyword}' detected in prompt. Running RAG pointing task.")
-            images_for_inference = [os.path.abspath(image_path), DATASET_IMAGES.get(found_keyword)]
-            task_for_inference = "pointing_based_on_reference"
-        else:
-            # --- KEYWORD NOT DETECTED: USE FOUNDATION MODEL ONLY ---
-            print("Keyword not found in prompt. Running pointing with foundation model only.")
-            images_for_inference = [os.path.abspath(image_path)]
-            task_for_inference = "pointing"
-
-        # Run Pointing Task with the selected images and task
-        pointing_result = model.inference(
-            text=prompt,
-            image=images_for_inference,
-            task=task_for_inference,
-            plot=True,
-            enable_thinking=False,
-            do_sample=True
-        )
+        if prompts:
+            results = await point_many(([prompt] if prompt else []) + prompts, stored)
+            print(f"Pointing task complete for {len(results)} prompts.")
+            return {"results": results}
+
+        pointing_result = await point_on_image(prompt, stored)
         print("Pointing task complete.")
         return pointing_result
 
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"An error occurred during the pointing task: {e}")
         raise HTTPException(status_code=500, detail=f"An internal server error occurred: {e}")
 
+
+@app.post("/prompt_stream")
+async def stream_prompt_on_verified_image(
+    image_id: str = Form(..., description="The unique ID of the previously verified image."),
+    prompt: str = Form(..., description="The pointing instruction for the model.")
+):
+    """
+    Like /prompt, but streams the answer as Server-Sent Events so every point
+    can be used as soon as it has been generated.
+    """
+    stored = await get_verified_image(image_id)
+    request, reference = pointing_request(prompt)
+    try:
+        events = await pointing_events(request, reference, stored)
+    except QueueFullError as e:
+        raise queue_full(e)
+    return stream_inference(events, extra_result={"reference": reference})
+
+
+@app.post("/verify_and_point")
+async def verify_and_point(
+    object_id: str = Form(..., description="A description of the object to verify in the image."),
+    prompt: str = Form(..., description="The pointing instruction for the model."),
+    image: UploadFile = File(...),
+    threshold: float = Form(DEFAULT_VERIFY_THRESHOLD, ge=0.0, le=1.0, description="Minimum P('same') to accept the object."),
+    stream: bool = Form(False, description="Stream the pointing answer as Server-Sent Events, like /prompt_stream.")
+):
+    """
+    Verifies the object and, if it matches, runs the pointing task on the same
+    decoded image in a single round trip. The image is stored like in /verify,
+    so the returned image_id can still be used for further /prompt calls.
+    With `stream`, a "verified" event is sent first, followed by the /prompt_stream events.
+    """
+    try:
+        stored = await read_upload(image)
+        verification_result = await verify_object(object_id, stored, threshold=threshold)
+
+        if not is_verified(verification_result, threshold):
+            discard(stored)
+            print("Verification failed. Sending comedic error.")
+            raise HTTPException(
+                status_code=404, 
+                detail="YOU DARE LIE TO ROBOBRAIN????",
+                headers={"X-Verify-Stage": verification_result["stage"]}
+            )
+
+        image_store.put(stored)
+        print(f"Verification successful. Image stored as {stored.image_id}{stored.extension}")
+
+        if stream:
+            verified = {"status": "verified", "image_id": stored.image_id, "confidence": same_probability(verification_result), "stage": verification_result["stage"], "timing": verification_result.get("timing")}
+            request, reference = pointing_request(prompt)
+            try:
+                events = await pointing_events(request, reference, stored)
+            except QueueFullError as e:
+                raise queue_full(e)
+            return stream_inference(events, first_events=[sse_event("verified", verified)], extra_result={"reference": reference})
+
+        pointing_result = await point_on_image(prompt, stored)
+        print("Pointing task complete.")
+        return {
+            "status": "verified",
+            "image_id": stored.image_id,
+            "confidence": same_probability(verification_result),
+            "stage": verification_result["stage"],
+            **pointing_result,
+            "timing": {"verify": verification_result.get("timing"), "prompt": pointing_result.get("timing")}
+        }
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"An error occurred during verify_and_point: {e}")
+        raise HTTPException(status_code=500, detail=f"An internal server error occurred: {e}")
+
+
+@app.websocket("/ws")
+async def ar_session(websocket: WebSocket):
+    """
+    A persistent session for clients that keep sending frames, such as the AR client.
+
+    The client sends JSON text messages to set `object_id`, `prompt`, `threshold` and `text`
+    (any subset; they stay set for the session), and binary messages holding one encoded frame each.
+    Every frame is verified against the object_id and, if it matches, pointed on with the prompt.
+    {"action": "prompt"} (optionally with a new prompt) points on the last verified frame again
+    without re-uploading it, and {"action": "cancel"} stops the running job. Results come back as JSON messages {"event", "frame", ...}:
+    "verified", then "point" (or "box") as soon as each is generated, then "done" with the /prompt
+    result, "error" with an HTTP status, or "cancelled". Frames that arrive while another one is still waiting
+    are dropped in favour of the newest.
+    """
+    await websocket.accept()
+    session = ARSession()
+    pending = deque()
+    wake = asyncio.Event()
+    worker = asyncio.create_task(run_session_jobs(websocket, session, pending, wake))
+    try:
+        await receive_session_messages(websocket, session, pending, wake)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # Cancelling the worker closes its event stream, which cancels a running generation
+        session.closed = True
+        worker.cancel()
+        with suppress(asyncio.CancelledError, WebSocketDisconnect, RuntimeError):
+            await worker
+        print(f"WebSocket session closed after {session.frames} frames ({session.dropped} dropped).")
+
 # --- Main execution block to start the server and ngrok tunnel ---
 if __name__ == "__main__":
     NGROK_AUTHTOKEN = os.environ.get("NGROK_AUTHTOKEN")
@@ -1,5 +1,100 @@
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+import io
 import os
+import cv2
+import numpy as np
+
+# Encoder settings per output format: PIL format name and OpenCV extension / quality flag
+FORMATS = {
+    "JPEG": (".jpg", cv2.IMWRITE_JPEG_QUALITY),
+    "PNG": (".png", None),
+    "WEBP": (".webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+
+# Shared encoder pools, one per worker count, so batches don't pay for thread start-up
+_pools = {}
+
+
+def _format_name(fmt):
+    fmt = fmt.upper().lstrip(".")
+    fmt = "JPEG" if fmt == "JPG" else fmt
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported image format '{fmt}'. Use one of {', '.join(FORMATS)}.")
+    return fmt
+
+def _fit(width, height, max_size):
+    """Target size that fits in max_size x max_size with the aspect ratio kept, and the scale factor."""
+    scale = min(1.0, max_size / max(width, height))
+    return (max(1, round(width * scale)), max(1, round(height * scale))), scale
+
+def load_image(source, bgr=True):
+    """
+    Returns a PIL image from a numpy frame (BGR like OpenCV unless bgr=False), a PIL image,
+    encoded bytes or a file path.
+    """
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, np.ndarray):
+        if source.ndim == 3 and bgr:
+            source = cv2.cvtColor(source, cv2.COLOR_BGRA2RGBA if source.shape[2] == 4 else cv2.COLOR_BGR2RGB)
+        return Image.fromarray(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        image = Image.open(io.BytesIO(source))
+        image.load()
+        return image
+    return Image.open(source)
+
+def resize_image(image, max_size=1024):
+    """
+    Shrinks a PIL image to fit in max_size x max_size, keeping the aspect ratio.
+    Returns the image and the scale factor (1.0 if it was already small enough).
+    """
+    size, scale = _fit(*image.size, max_size)
+    if scale < 1.0:
+        image = image.resize(size, Image.LANCZOS)
+    return image, scale
+
+def encode_image(source, max_size=1024, fmt="JPEG", quality=90, bgr=True):
+    """
+    Resizes an image in memory and encodes it, without touching the disk.
+    `source` can be a numpy frame, a PIL image, encoded bytes or a path. Returns the encoded
+    bytes and the scale factor, so coordinates on the result map back by dividing by it.
+    """
+    fmt = _format_name(fmt)
+
+    if isinstance(source, np.ndarray):
+        # OpenCV frames stay in OpenCV: no conversion to PIL and back
+        height, width = source.shape[:2]
+        size, scale = _fit(width, height, max_size)
+        if scale < 1.0:
+            source = cv2.resize(source, size, interpolation=cv2.INTER_AREA)
+        if not bgr and source.ndim == 3:
+            source = cv2.cvtColor(source, cv2.COLOR_RGBA2BGRA if source.shape[2] == 4 else cv2.COLOR_RGB2BGR)
+        extension, quality_flag = FORMATS[fmt]
+        params = [quality_flag, int(quality)] if quality_flag is not None else []
+        ok, buffer = cv2.imencode(extension, source, params)
+        if not ok:
+            raise ValueError(f"Could not encode frame as {fmt}.")
+        return buffer.tobytes(), scale
+
+    image, scale = resize_image(load_image(source, bgr=bgr), max_size)
+    if fmt == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format=fmt, **({} if fmt == "PNG" else {"quality": int(quality)}))
+    return output.getvalue(), scale
+
+def encode_images(sources, max_size=1024, fmt="JPEG", quality=90, bgr=True, max_workers=4):
+    """
+    encode_image for many images at once on a shared thread pool (OpenCV and PIL release the GIL
+    while resizing and encoding). Returns a list of (bytes, scale) in the order of `sources`.
+    """
+    pool = _pools.get(max_workers)
+    if pool is None:
+        pool = _pools.setdefault(max_workers, ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="resize"))
+    futures = [pool.submit(encode_image, source, max_size, fmt, quality, bgr) for source in sources]
+    return [future.result() for future in futures]
 
 def process_and_resize_image(input_path, max_size=1024):
     """
@@ -7,29 +102,27 @@ def process_and_resize_image(input_path, max_size=1024):
     saving it with a new name. Returns the path to the processed image.
     """
     try:
-        img = Image.open(input_path)
-        
+        img = load_image(input_path)
+        resized, scale = resize_image(img, max_size)
+
         # Check if resizing is needed
-        if max(img.size) > max_size:
+        if scale < 1.0:
             print(f"Resizing image: {input_path} (Original size: {img.size})")
-            
-            # This maintains the aspect ratio
-            img.thumbnail((max_size, max_size))
-            
+
             # Create a new filename for the resized image
             directory, filename = os.path.split(input_path)
             name, ext = os.path.splitext(filename)
             output_filename = f"{name}_resized{ext}"
             output_path = os.path.join(directory, output_filename)
-            
-            img.save(output_path)
+
+            resized.save(output_path)
             print(f"Resized image saved to: {output_path}")
             return output_path
         else:
             # If no resizing is needed, just return the original path
             print(f"Image {input_path} is already within size limits.")
             return input_path
-            
+
     except Exception as e:
         print(f"Error processing image {input_path}: {e}")
         return None
\ No newline at end of file
@@ -0,0 +1,234 @@
+import math
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class QueueFullError(RuntimeError):
+    """Raised by `submit` when the inference queue is at capacity."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Inference queue is full, retry in {retry_after}s.")
+        self.retry_after = retry_after
+
+
+class _PendingRequest:
+    """A single inference call waiting in the batching queue."""
+
+    def __init__(self, request: dict, options: dict, queue_depth: int):
+        self.request = request
+        # How the model is called: {"mode": "generate", "do_sample", "temperature", "max_new_tokens"[, "streamer", "cancel"]} or {"mode": "classify", "labels"}
+        self.options = options
+        self.queue_depth = queue_depth
+        self.enqueued_at = time.perf_counter()
+        self.future = Future()
+
+    @property
+    def group_key(self):
+        # Requests can only share a model call if they are run the same way
+        return tuple(sorted(self.options.items()))
+
+
+class BatchingInference:
+    """
+    Dynamic micro-batching in front of SimpleInference.
+
+    Concurrent callers submit requests, a single worker thread collects them for up to
+    `max_wait_ms` (or until `max_batch_size` requests are waiting) and runs them through
+    one padded `batch_inference` call (or one `batch_classify` forward pass for `submit_classify`).
+    Every caller gets its own result dict, plus a "timing" entry with the queue depth it saw,
+    its wait time and the service time.
+
+    The queue is bounded by `max_queue_size` (0 means unbounded): once it is full, `submit`
+    raises QueueFullError straight away instead of letting requests pile up.
+
+    With `num_workers` > 1, that many worker threads collect and run batches concurrently, for a
+    model that can serve several calls at once (e.g. a ReplicaPool with one worker per replica).
+    """
+
+    def __init__(self, model, max_batch_size=8, max_wait_ms=10, max_queue_size=64, num_workers=1):
+        self.model = model
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_ms = max(0.0, float(max_wait_ms))
+        self.max_queue_size = max(0, int(max_queue_size))
+        self.num_workers = max(1, int(num_workers))
+
+        self._queue = queue.Queue(maxsize=self.max_queue_size)
+        self._closed = False
+        # Moving average of how long one batch takes, used to estimate Retry-After
+        self._avg_service_s = 1.0
+        self._workers = [threading.Thread(target=self._run, name=f"batching-inference-{i}", daemon=True) for i in range(self.num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, text, image, task="general", enable_thinking=True, do_sample=True, temperature=0.5, max_new_tokens=768, **kwargs) -> Future:
+        """Queue a request and return a Future resolving to its result dict."""
+        if self._closed:
+            raise RuntimeError("BatchingInference has been closed.")
+
+        kwargs.pop("plot", None)
+        request = {"text": text, "image": image, "task": task, "enable_thinking": enable_thinking, **kwargs}
+        return self._enqueue(request, {"mode": "generate", "do_sample": do_sample, "temperature": temperature, "max_new_tokens": max_new_tokens})
+
+    def submit_many(self, requests: list, do_sample=True, temperature=0.5, max_new_tokens=768) -> list:
+        """
+        Queue several requests (dicts with the arguments of `submit`) as one unit, so they always run
+        in the same padded batch, e.g. several prompts on one image. Returns one Future per request.
+        """
+        if self._closed:
+            raise RuntimeError("BatchingInference has been closed.")
+
+        options = {"mode": "generate", "do_sample": do_sample, "temperature": temperature, "max_new_tokens": max_new_tokens}
+        group = []
+        for request in requests:
+            request = {"task": "general", "enable_thinking": True, **request}
+            request.pop("plot", None)
+            group.append(_PendingRequest(request, options, queue_depth=self._queue.qsize()))
+        try:
+            self._queue.put_nowait(group)
+        except queue.Full:
+            raise QueueFullError(self.retry_after()) from None
+        return [pending.future for pending in group]
+
+    def submit_stream(self, text, image, streamer, cancel=None, task="general", enable_thinking=True, do_sample=True, temperature=0.5, max_new_tokens=768, **kwargs) -> Future:
+        """
+        Queue a request whose tokens are pushed to `streamer` while they are generated.
+        Streamed requests run on their own rather than in a padded batch; setting the `cancel`
+        event stops the generation.
+        """
+        if self._closed:
+            raise RuntimeError("BatchingInference has been closed.")
+
+        kwargs.pop("plot", None)
+        request = {"text": text, "image": image, "task": task, "enable_thinking": enable_thinking, **kwargs}
+        # The streamer is part of the options, so the request never shares a group with another one
+        return self._enqueue(request, {"mode": "generate", "do_sample": do_sample, "temperature": temperature, "max_new_tokens": max_new_tokens, "streamer": streamer, "cancel": cancel})
+
+    def submit_classify(self, text, image, task="verify", labels=("same", "different"), **kwargs) -> Future:
+        """Queue a single-forward-pass classification (see SimpleInference.batch_classify)."""
+        if self._closed:
+            raise RuntimeError("BatchingInference has been closed.")
+
+        for option in ("plot", "enable_thinking", "do_sample", "temperature", "max_new_tokens"):
+            kwargs.pop(option, None)
+        request = {"text": text, "image": image, "task": task, **kwargs}
+        return self._enqueue(request, {"mode": "classify", "labels": tuple(labels)})
+
+    def _enqueue(self, request: dict, options: dict) -> Future:
+        pending = _PendingRequest(request, options, queue_depth=self._queue.qsize())
+        try:
+            self._queue.put_nowait(pending)
+        except queue.Full:
+            raise QueueFullError(self.retry_after()) from None
+        return pending.future
+
+    def queue_depth(self) -> int:
+        """Number of requests waiting for the worker."""
+        return self._queue.qsize()
+
+    def retry_after(self) -> int:
+        """Rough number of seconds until the current backlog has been served."""
+        batches_ahead = math.ceil(self._queue.qsize() / (self.max_batch_size * self.num_workers))
+        return max(1, math.ceil(batches_ahead * self._avg_service_s))
+
+    def inference(self, text, image, task="general", plot=False, enable_thinking=True, do_sample=True, temperature=0.5, max_new_tokens=768, **kwargs):
+        """Blocking drop-in replacement for SimpleInference.inference (including a list of prompts)."""
+        if isinstance(text, list):
+            requests = [{"text": prompt, "image": image, "task": task, "enable_thinking": enable_thinking, **kwargs} for prompt in text]
+            futures = self.submit_many(requests, do_sample=do_sample, temperature=temperature, max_new_tokens=max_new_tokens)
+            return [future.result() for future in futures]
+        return self.submit(text, image, task=task, enable_thinking=enable_thinking, do_sample=do_sample, temperature=temperature, max_new_tokens=max_new_tokens, **kwargs).result()
+
+    def close(self):
+        """Stop the workers once the queued requests have been served."""
+        self._closed = True
+        # Blocking put: the sentinels have to get in even when the queue is full. One per worker
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _collect_batch(self):
+        """
+        Block for the first request, then gather more until the batch is full or the window expires.
+        Groups from `submit_many` are never split, so a batch can exceed max_batch_size to keep one whole.
+        """
+        first = self._queue.get()
+        if first is None:
+            return None
+
+        batch = list(first) if isinstance(first, list) else [first]
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                pending = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if pending is None:
+                # Put the sentinel back so this (or another) worker stops after this batch
+                self._queue.put_nowait(None)
+                break
+            if isinstance(pending, list):
+                batch.extend(pending)
+            else:
+                batch.append(pending)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                return
+
+            groups = {}
+            for pending in batch:
+                groups.setdefault(pending.group_key, []).append(pending)
+
+            for group in groups.values():
+                self._run_group(group)
+
+    def _call_model(self, requests: list, options: dict):
+        options = dict(options)
+        if options.pop("mode") == "classify":
+            return self.model.batch_classify(requests, **options)
+        return self.model.batch_inference(requests, **options)
+
+    def _run_group(self, group):
+        # Skip requests whose caller already gave up
+        group = [pending for pending in group if pending.future.set_running_or_notify_cancel()]
+        if not group:
+            return
+
+        options = group[0].options
+        started_at = time.perf_counter()
+        try:
+            results = self._call_model([pending.request for pending in group], options)
+        except Exception as e:
+            if len(group) == 1:
+                group[0].future.set_exception(e)
+                return
+            # One bad request must not fail the whole batch, so fall back to running them one by one
+            print(f"Batched inference failed for {len(group)} requests ({e}). Retrying individually.")
+            results = []
+            for pending in group:
+                try:
+                    results.append(self._call_model([pending.request], options)[0])
+                except Exception as single_error:
+                    results.append(single_error)
+
+        finished_at = time.perf_counter()
+        self._avg_service_s = 0.8 * self._avg_service_s + 0.2 * (finished_at - started_at)
+
+        for pending, result in zip(group, results):
+            if isinstance(result, Exception):
+                pending.future.set_exception(result)
+                continue
+            result["timing"] = {
+                "queue_depth": pending.queue_depth,
+                "wait_ms": round((started_at - pending.enqueued_at) * 1000, 2),
+                "service_ms": round((finished_at - started_at) * 1000, 2),
+                "batch_size": len(group),
+            }
+            pending.future.set_result(result)
@@ -0,0 +1,96 @@
+"""
+Throughput of the one-call-per-request path against the micro-batching engine.
+
+Usage:
+    python benchmarks/benchmark_batching.py --requests 32 --concurrency 8 --max-batch-size 8 --max-wait-ms 10
+"""
+import argparse
+import itertools
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference import SimpleInference
+from batching import BatchingInference
+from dataset import DATASET_IMAGES
+from reference_store import ReferenceStore
+
+
+def build_workload(num_requests):
+    """Mix of the one-image and two-image tasks the API sends, cycling over the reference images."""
+    references = list(ReferenceStore(DATASET_IMAGES).items())
+    workload = []
+    for i, (name, path) in zip(range(num_requests), itertools.cycle(references)):
+        other_name, other_path = references[(i + 1) % len(references)]
+        kind = i % 3
+        if kind == 0:
+            workload.append({"text": name, "image": [path], "task": "verify"})
+        elif kind == 1:
+            workload.append({"text": name, "image": [path, other_path], "task": "verify_based_on_reference"})
+        else:
+            workload.append({"text": f"point to the {other_name}", "image": [path, other_path], "task": "pointing_based_on_reference"})
+    return workload
+
+
+def run_sequential(model, workload, do_sample):
+    latencies = []
+    start = time.perf_counter()
+    for request in workload:
+        t0 = time.perf_counter()
+        model.inference(enable_thinking=False, do_sample=do_sample, **request)
+        latencies.append(time.perf_counter() - t0)
+    return time.perf_counter() - start, latencies
+
+
+def run_batched(engine, workload, concurrency, do_sample):
+    def call(request):
+        t0 = time.perf_counter()
+        engine.inference(enable_thinking=False, do_sample=do_sample, **request)
+        return time.perf_counter() - t0
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(call, workload))
+    return time.perf_counter() - start, latencies
+
+
+def report(label, elapsed, latencies):
+    print(f"{label:<12} {len(latencies) / elapsed:8.2f} req/s   "
+          f"mean {statistics.mean(latencies) * 1000:8.1f} ms   "
+          f"max {max(latencies) * 1000:8.1f} ms   total {elapsed:6.1f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="BAAI/RoboBrain2.0-3B")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of simultaneous clients for the batched run.")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--greedy", action="store_true", help="Disable sampling so both runs generate comparable lengths.")
+    args = parser.parse_args()
+
+    model = SimpleInference(args.model)
+    workload = build_workload(args.requests)
+    do_sample = not args.greedy
+
+    # Warm up kernels and caches so the first measured run is not penalised
+    model.inference(enable_thinking=False, do_sample=do_sample, **workload[0])
+
+    sequential = run_sequential(model, workload, do_sample)
+    engine = BatchingInference(model, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    batched = run_batched(engine, workload, args.concurrency, do_sample)
+    engine.close()
+
+    print(f"\n{args.requests} requests, concurrency {args.concurrency}, max batch {args.max_batch_size}, window {args.max_wait_ms} ms")
+    report("sequential", *sequential)
+    report("batched", *batched)
+    print(f"speed-up     {sequential[0] / batched[0]:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
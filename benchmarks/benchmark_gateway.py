@@ -0,0 +1,112 @@
+"""
+Throughput of the gateway in front of 1, 2, 4, ... local stub nodes, and correctness of the stateful flow.
+
+For every node count, stub nodes (benchmarks/stub_node.py) and a gateway are started as local processes.
+--clients concurrent clients then each run --flows flows of /verify with a new image followed by --prompts
+/prompt calls on the returned image_id. Every /prompt must find its image, so any non-200 answer is an error.
+With --drain, the first node is drained halfway through the run and every flow must still succeed.
+Exits with status 1 if any flow failed.
+
+Usage:
+    python benchmarks/benchmark_gateway.py --nodes 1 2 4 --clients 16 --flows 10
+    python benchmarks/benchmark_gateway.py --nodes 3 --drain
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start(command, env=None):
+    return subprocess.Popen([sys.executable, *command], cwd=ROOT, env={**os.environ, **(env or {})}, stdout=subprocess.DEVNULL)
+
+
+async def wait_until_up(client, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up.")
+
+
+async def flow(client, gateway, client_index, flow_index, prompts):
+    """One /verify and its /prompt calls; returns the number of failed calls."""
+    # Unique bytes per flow, so every flow gets its own image_id
+    data = f"image {client_index}-{flow_index}-{time.time_ns()}".encode()
+    verified = await client.post(f"{gateway}/verify", data={"object_id": "kettle"}, files={"image": ("frame.png", data, "image/png")})
+    if verified.status_code != 200:
+        return 1 + prompts
+    image_id = verified.json()["image_id"]
+    failures = 0
+    for _ in range(prompts):
+        response = await client.post(f"{gateway}/prompt", data={"image_id": image_id, "prompt": "point to the handle"})
+        failures += response.status_code != 200
+    return failures
+
+
+async def measure(node_count, args):
+    ports = [args.base_port + 1 + i for i in range(node_count)]
+    urls = [f"http://127.0.0.1:{port}" for port in ports]
+    gateway = f"http://127.0.0.1:{args.base_port}"
+    processes = [start(["benchmarks/stub_node.py", "--port", str(port), "--service-ms", str(args.service_ms)]) for port in ports]
+    processes.append(start(["gateway.py"], env={"ROBOBRAIN_GATEWAY_NODES": ",".join(urls), "ROBOBRAIN_GATEWAY_PORT": str(args.base_port)}))
+    try:
+        async with httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=args.clients * 2)) as client:
+            for url in urls + [gateway]:
+                await wait_until_up(client, f"{url}/")
+
+            async def run_client(index):
+                failures = 0
+                for flow_index in range(args.flows):
+                    failures += await flow(client, gateway, index, flow_index, args.prompts)
+                    if args.drain and index == 0 and flow_index == args.flows // 2 and node_count > 1:
+                        await client.post(f"{gateway}/gateway/nodes/drain", params={"url": urls[0]})
+                return failures
+
+            start_time = time.perf_counter()
+            failures = sum(await asyncio.gather(*(run_client(i) for i in range(args.clients))))
+            elapsed = time.perf_counter() - start_time
+            spread = [(await client.get(f"{url}/stats")).json() for url in urls]
+        calls = args.clients * args.flows * (1 + args.prompts)
+        return calls / elapsed, failures, [node["verified"] + node["prompts"] for node in spread]
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--flows", type=int, default=10)
+    parser.add_argument("--prompts", type=int, default=3)
+    parser.add_argument("--service-ms", type=float, default=20)
+    parser.add_argument("--drain", action="store_true", help="Drain the first node halfway through every run.")
+    parser.add_argument("--base-port", type=int, default=18000)
+    args = parser.parse_args()
+
+    print(f"\n{'nodes':>6}{'calls/s':>10}{'speed-up':>10}{'failed':>8}  calls per node")
+    baseline, failed = None, 0
+    for count in args.nodes:
+        rate, failures, spread = asyncio.run(measure(count, args))
+        baseline = baseline or rate
+        failed += failures
+        print(f"{count:>6}{rate:>10.1f}{rate / baseline:>9.2f}x{failures:>8}  {spread}")
+    if failed:
+        sys.exit(f"{failed} calls failed: the stateful /verify -> /prompt flow broke.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Latency of N pointing prompts on one image: N sequential inference calls vs one multi-prompt call.
+
+The sequential runs are timed both without the vision cache (every call encodes the image again, as
+separate /prompt calls used to) and with it (the image is keyed, so only the first call encodes it).
+
+Usage:
+    python benchmarks/benchmark_multi_prompt.py --image "dataset/electric stove.jpeg" --targets 1 2 4 8
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from PIL import Image
+
+from inference import SimpleInference
+
+TARGETS = ["power button", "timer button", "increase button", "decrease button", "display", "plug", "cooking plate", "logo"]
+
+
+def timed(fn):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def sequential(model, image, prompts, keyed):
+    encoded = model.encode_image(image, key=f"bench_{uuid.uuid4().hex}" if keyed else None)
+    try:
+        for prompt in prompts:
+            model.inference(prompt, encoded, task="pointing", enable_thinking=False, do_sample=False)
+    finally:
+        model.forget_image(encoded.key)
+
+
+def batched(model, image, prompts):
+    model.inference(prompts, image, task="pointing", enable_thinking=False, do_sample=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="BAAI/RoboBrain2.0-3B")
+    parser.add_argument("--image", default="dataset/electric stove.jpeg")
+    parser.add_argument("--targets", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    model = SimpleInference(args.model)
+    image = Image.open(args.image).convert("RGB")
+    # Warm-up, so CUDA initialisation is not part of the first measurement
+    batched(model, image, ["point to the power button"])
+
+    print(f"\n{'targets':>8}{'sequential':>14}{'seq. + cache':>14}{'one batch':>12}{'speed-up':>10}")
+    for count in args.targets:
+        prompts = [f"point to the {TARGETS[i % len(TARGETS)]}" for i in range(count)]
+        plain = statistics.median(timed(lambda: sequential(model, image, prompts, keyed=False)) for _ in range(args.repeats))
+        cached = statistics.median(timed(lambda: sequential(model, image, prompts, keyed=True)) for _ in range(args.repeats))
+        batch = statistics.median(timed(lambda: batched(model, image, prompts)) for _ in range(args.repeats))
+        print(f"{count:>8}{plain * 1000:>11.0f} ms{cached * 1000:>11.0f} ms{batch * 1000:>9.0f} ms{plain / batch:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
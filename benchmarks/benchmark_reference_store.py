@@ -0,0 +1,59 @@
+"""
+Startup and first-lookup cost of the reference images: eager resizing at import (the old dataset.py)
+vs the lazy ReferenceStore, with an empty cache and with the manifest of an earlier run.
+
+Works on a temporary copy of the dataset directory, so the repository is not touched.
+
+Usage:
+    python benchmarks/benchmark_reference_store.py
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Resize import process_and_resize_image
+from dataset import DATASET_IMAGES
+from reference_store import ReferenceStore
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reference", default="stove", help="Reference looked up by the first request.")
+    parser.add_argument("--max-size", type=int, default=480)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        dataset_dir = os.path.join(workdir, "dataset")
+        shutil.copytree("dataset", dataset_dir, ignore=shutil.ignore_patterns(".cache", "*_resized.*"))
+        references = {name: os.path.join(workdir, path) for name, path in DATASET_IMAGES.items()}
+        cache_dir = os.path.join(dataset_dir, ".cache")
+
+        # What importing the old dataset.py did on every server start
+        _, eager_ms = timed(lambda: {name: process_and_resize_image(path, args.max_size) for name, path in references.items()})
+
+        rows = []
+        for label in ("lazy, empty cache", "lazy, cached manifest"):
+            store, startup_ms = timed(lambda: ReferenceStore(references, cache_dir=cache_dir, max_size=args.max_size))
+            _, first_ms = timed(lambda: store[args.reference])
+            _, all_ms = timed(store.warm)
+            rows.append((label, startup_ms, first_ms, all_ms))
+
+    print(f"\n{'':<24}{'startup':>12}{'first lookup':>16}{'all references':>18}")
+    print(f"{'eager (old dataset.py)':<24}{eager_ms:>9.1f} ms{0:>13.1f} ms{0:>15.1f} ms")
+    for label, startup_ms, first_ms, all_ms in rows:
+        print(f"{label:<24}{startup_ms:>9.1f} ms{first_ms:>13.1f} ms{all_ms:>15.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
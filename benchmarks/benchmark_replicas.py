@@ -0,0 +1,71 @@
+"""
+Throughput of the inference pool with 1, 2, 4, ... replica processes on the CPU.
+
+The available cores are split evenly between the replicas (see parse_replicas "cpu*N"), and --requests
+concurrent calls are sent through BatchingInference with one worker per replica. Without --model every
+replica runs StubInference (fixed matrix work per request), so scaling can be measured on any Linux
+machine; with --model each replica loads that checkpoint on the CPU and answers a pointing prompt.
+
+Usage:
+    python benchmarks/benchmark_replicas.py --replicas 1 2 4 --requests 64
+    python benchmarks/benchmark_replicas.py --model path/to/small-checkpoint --image "dataset/electric stove.jpeg" --requests 16
+"""
+import argparse
+import functools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batching import BatchingInference
+from replica_pool import ReplicaPool, StubInference, parse_replicas
+
+
+def throughput(count, args):
+    """Requests per second of `count` replicas serving args.requests concurrent calls."""
+    if args.model:
+        from inference import SimpleInference
+        factory = functools.partial(SimpleInference, args.model, vision_cache_bytes=0)
+    else:
+        factory = functools.partial(StubInference, work=args.work)
+    pool = ReplicaPool(parse_replicas(f"cpu*{count}"), factory)
+    engine = BatchingInference(pool, max_batch_size=args.batch_size, max_wait_ms=5, max_queue_size=0, num_workers=count)
+    try:
+        request = {"text": "point to the power button", "image": os.path.abspath(args.image), "task": "pointing", "enable_thinking": False, "do_sample": False, "max_new_tokens": 32}
+        # Warm-up, one call per replica
+        for future in [engine.submit(**request) for _ in range(count)]:
+            future.result()
+
+        start = time.perf_counter()
+        futures = [engine.submit(**request) for _ in range(args.requests)]
+        for future in futures:
+            future.result()
+        return args.requests / (time.perf_counter() - start)
+    finally:
+        engine.close()
+        pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replicas", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--model", default="", help="Checkpoint every replica loads on the CPU (default: StubInference).")
+    parser.add_argument("--image", default="dataset/electric stove.jpeg")
+    parser.add_argument("--work", type=int, default=20, help="Matrix multiplications per request of the stub model.")
+    args = parser.parse_args()
+
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    print(f"{cores} cores available")
+    print(f"\n{'replicas':>9}{'req/s':>10}{'speed-up':>10}")
+    baseline = None
+    for count in args.replicas:
+        rate = throughput(count, args)
+        baseline = baseline or rate
+        print(f"{count:>9}{rate:>10.2f}{rate / baseline:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
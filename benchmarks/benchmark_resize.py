@@ -0,0 +1,64 @@
+"""
+Per-frame cost of preparing an upload: the old disk round trip (imwrite -> process_and_resize_image -> read -> remove)
+vs the in-memory encode_image, and serial vs thread-pool encoding of a batch of frames.
+
+Usage:
+    python benchmarks/benchmark_resize.py --frames 50 --width 1280 --height 720
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Resize import encode_image, encode_images, process_and_resize_image
+
+
+def via_disk(frame, max_size, workdir):
+    path = os.path.join(workdir, "temp_frame_for_detection.jpg")
+    cv2.imwrite(path, frame)
+    path = process_and_resize_image(path, max_size)
+    with open(path, "rb") as f:
+        data = f.read()
+    os.remove(path)
+    return data
+
+
+def timed(fn, frames):
+    start = time.perf_counter()
+    fn(frames)
+    return (time.perf_counter() - start) / len(frames) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=50)
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--max-size", type=int, default=480)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    # Smooth noise compresses like a camera frame rather than like white noise
+    frames = [cv2.GaussianBlur(rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8), (15, 15), 0) for _ in range(args.frames)]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        disk_ms = timed(lambda batch: [via_disk(frame, args.max_size, workdir) for frame in batch], frames)
+    rows = [("disk round trip", disk_ms)]
+    for fmt in ("JPEG", "WEBP", "PNG"):
+        rows.append((f"in memory, {fmt}", timed(lambda batch: [encode_image(frame, args.max_size, fmt=fmt) for frame in batch], frames)))
+    rows.append((f"in memory, JPEG, {args.workers} threads", timed(lambda batch: encode_images(batch, args.max_size, max_workers=args.workers), frames)))
+
+    print(f"\n{args.frames} frames of {args.width}x{args.height} -> {args.max_size}px")
+    for label, ms in rows:
+        print(f"{label:<32}{ms:>8.2f} ms/frame")
+
+
+if __name__ == "__main__":
+    main()
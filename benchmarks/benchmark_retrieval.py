@@ -0,0 +1,67 @@
+"""
+Reference lookup cost of the old keyword scan vs the vectorized ReferenceIndex as the number of references grows.
+
+Usage:
+    python benchmarks/benchmark_retrieval.py --sizes 13 100 1000 10000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from retrieval import ReferenceIndex
+from dataset import DATASET_IMAGES
+
+WORDS = ["red", "black", "power", "bank", "display", "kettle", "button", "switch", "rocker", "stove", "timer",
+         "remote", "cool", "fan", "lamp", "door", "handle", "knob", "lid", "screen", "mug", "drawer", "left", "right"]
+
+
+def synthetic_references(count, rng):
+    references = dict(DATASET_IMAGES)
+    while len(references) < count:
+        references[" ".join(rng.sample(WORDS, rng.randint(1, 3))) + f" {len(references)}"] = "dataset/kettle.png"
+    return references
+
+
+def keyword_scan(references, prompt):
+    # The lookup /prompt used to do: first key that is a substring of the prompt
+    for keyword in references.keys():
+        if keyword in prompt.lower():
+            return keyword
+    return None
+
+
+def timed(fn, prompts):
+    start = time.perf_counter()
+    for prompt in prompts:
+        fn(prompt)
+    return (time.perf_counter() - start) / len(prompts) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[13, 100, 1000, 10000])
+    parser.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    prompts = [f"point to the {' '.join(rng.sample(WORDS, 2))}" for _ in range(args.queries)]
+
+    print(f"{'references':>10}  {'keyword scan':>14}  {'index query':>12}  {'index build':>12}")
+    for size in args.sizes:
+        references = synthetic_references(size, rng)
+        start = time.perf_counter()
+        index = ReferenceIndex()
+        index.add_many(references)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        scan_ms = timed(lambda prompt: keyword_scan(references, prompt), prompts)
+        index_ms = timed(index.match, prompts)
+        print(f"{len(references):>10}  {scan_ms:>11.3f} ms  {index_ms:>9.3f} ms  {build_ms:>9.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Tokens generated and latency of pointing requests with and without structured early stopping.
+
+Usage:
+    python benchmarks/benchmark_structured_output.py --requests 12
+"""
+import argparse
+import itertools
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference import SimpleInference
+from dataset import DATASET_IMAGES
+from reference_store import ReferenceStore
+
+POINTING_SAMPLES = [
+    ("dataset/electric stove_resized.jpeg", "timer button"),
+    ("dataset/electric stove_resized.jpeg", "increase button"),
+    ("dataset/ac remote_resized.png", "cool button"),
+    ("dataset/kettle.png", "kettle button"),
+]
+
+
+def run(model, references, samples, structured_stopping, do_sample):
+    tokens, latencies, parsed = [], [], 0
+    for image_path, keyword in samples:
+        start = time.perf_counter()
+        result = model.inference(
+            f"point to the {keyword}",
+            [image_path, references[keyword]],
+            task="pointing_based_on_reference",
+            enable_thinking=False,
+            do_sample=do_sample,
+            structured_stopping=structured_stopping
+        )
+        latencies.append(time.perf_counter() - start)
+        tokens.append(result["generated_tokens"])
+        parsed += bool(result.get("points"))
+    return tokens, latencies, parsed
+
+
+def report(label, tokens, latencies, parsed):
+    print(f"{label:<20} tokens/request {statistics.mean(tokens):7.1f} (max {max(tokens):4d})   "
+          f"latency mean {statistics.mean(latencies) * 1000:8.1f} ms   answers with points {parsed}/{len(tokens)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="BAAI/RoboBrain2.0-3B")
+    parser.add_argument("--requests", type=int, default=12)
+    parser.add_argument("--greedy", action="store_true", help="Disable sampling (the API samples at temperature 0.5).")
+    args = parser.parse_args()
+
+    model = SimpleInference(args.model)
+    samples = list(itertools.islice(itertools.cycle(POINTING_SAMPLES), args.requests))
+    do_sample = not args.greedy
+    references = ReferenceStore(DATASET_IMAGES)
+    run(model, references, samples[:1], True, do_sample)  # warm-up
+
+    free = run(model, references, samples, False, do_sample)
+    structured = run(model, references, samples, True, do_sample)
+
+    print(f"\n{args.requests} pointing requests")
+    report("free-form (768 max)", *free)
+    report("structured stop", *structured)
+    saved = statistics.mean(free[1]) - statistics.mean(structured[1])
+    print(f"latency saved per request: {saved * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
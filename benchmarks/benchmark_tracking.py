@@ -0,0 +1,111 @@
+"""
+Tracking speed and drift of the AR client's point tracker backends on a recorded video.
+
+The video is replayed forwards for --frames frames and then backwards to the first frame. A perfect
+tracker ends where it started, so the distance between the start and end positions (round-trip drift)
+measures drift without ground truth. Points are picked with goodFeaturesToTrack on the first frame
+unless --points is given.
+
+Usage:
+    python benchmarks/benchmark_tracking.py --video recording.mp4 --frames 150
+    python benchmarks/benchmark_tracking.py --video recording.mp4 --points "320,240 400,260"
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2
+import numpy as np
+
+from point_tracking import TRACKER_BACKENDS, create_tracker
+
+
+def read_frames(path, max_frames):
+    capture = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < max_frames:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        frames.append(frame)
+    capture.release()
+    return frames
+
+
+def initial_points(frame, points_arg, max_points):
+    if points_arg:
+        return [tuple(float(v) for v in point.split(",")) for point in points_arg.split()]
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    corners = cv2.goodFeaturesToTrack(gray, maxCorners=max_points, qualityLevel=0.05, minDistance=30)
+    return [tuple(corner) for corner in corners.reshape(-1, 2)] if corners is not None else []
+
+
+def run(backend, frames, points):
+    """Track one point at a time, so each one's start and end can be matched up. Returns (fps, drifts, lost)."""
+    sequence = frames + frames[-2::-1]
+    drifts, lost, updates, elapsed = [], 0, 0, 0.0
+    for point in points:
+        tracker = create_tracker(backend)
+        tracker.add(frames[0], point)
+        position = None
+        for frame in sequence[1:]:
+            start = time.perf_counter()
+            tracked = tracker.update(frame)
+            elapsed += time.perf_counter() - start
+            updates += 1
+            if not tracked:
+                break
+            position = tracked[0]
+        tracker.close()
+        if len(tracker) == 0 or position is None:
+            lost += 1
+        else:
+            drifts.append(float(np.hypot(position[0] - point[0], position[1] - point[1])))
+    return updates / elapsed if elapsed else 0.0, drifts, lost
+
+
+def run_all_at_once(backend, frames, points):
+    """FPS with every point tracked together, the way the client runs."""
+    tracker = create_tracker(backend)
+    for point in points:
+        tracker.add(frames[0], point)
+    start = time.perf_counter()
+    for frame in frames[1:]:
+        tracker.update(frame)
+    elapsed = time.perf_counter() - start
+    tracker.close()
+    return (len(frames) - 1) / elapsed if elapsed else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--video", required=True)
+    parser.add_argument("--frames", type=int, default=150)
+    parser.add_argument("--points", default="", help="Space separated x,y points on the first frame.")
+    parser.add_argument("--max-points", type=int, default=8)
+    parser.add_argument("--backends", default=",".join(TRACKER_BACKENDS))
+    args = parser.parse_args()
+
+    frames = read_frames(args.video, args.frames)
+    if len(frames) < 2:
+        sys.exit(f"Could not read at least two frames from {args.video}.")
+    points = initial_points(frames[0], args.points, args.max_points)
+    if not points:
+        sys.exit("No points to track.")
+
+    print(f"\n{len(points)} points, {len(frames)} frames forwards and back")
+    print(f"{'backend':<8}{'FPS (all points)':>18}{'FPS (1 point)':>15}{'median drift':>14}{'max drift':>11}{'lost':>6}")
+    for backend in args.backends.split(","):
+        fps_all = run_all_at_once(backend, frames, points)
+        fps_one, drifts, lost = run(backend, frames, points)
+        median = f"{statistics.median(drifts):.1f} px" if drifts else "-"
+        worst = f"{max(drifts):.1f} px" if drifts else "-"
+        print(f"{backend:<8}{fps_all:>18.1f}{fps_one:>15.1f}{median:>14}{worst:>11}{lost:>6}")
+
+
+if __name__ == "__main__":
+    main()
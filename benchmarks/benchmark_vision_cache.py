@@ -0,0 +1,79 @@
+"""
+Time-to-first-token for the first and the n-th prompt on one verified image, with and without the vision cache.
+
+Every prompt is generated with max_new_tokens=1, so the measured time is prefill (vision tower + text)
+plus a single decoding step.
+
+Usage:
+    python benchmarks/benchmark_vision_cache.py --image "dataset/electric stove.jpeg" --prompts 8
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from PIL import Image
+
+from inference import SimpleInference
+from dataset import DATASET_IMAGES
+from reference_store import ReferenceStore
+
+PROMPTS = ["point to the power button", "point to the timer button", "point to the increase button", "point to the decrease button"]
+
+
+def time_to_first_token(model, image, reference, prompt):
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    if reference is not None:
+        model.inference(prompt, [image, reference], task="pointing_based_on_reference", enable_thinking=False, do_sample=False, max_new_tokens=1)
+    else:
+        model.inference(prompt, [image], task="pointing", enable_thinking=False, do_sample=False, max_new_tokens=1)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter() - start
+
+
+def run(model, image_path, reference_path, num_prompts, image_id):
+    image = model.encode_image(Image.open(image_path).convert("RGB"), key=image_id)
+    reference = model.reference_cache.get(reference_path) if reference_path else None
+    return [time_to_first_token(model, image, reference, PROMPTS[i % len(PROMPTS)]) for i in range(num_prompts)]
+
+
+def report(label, timings):
+    print(f"{label:<14} first {timings[0] * 1000:8.1f} ms   "
+          f"n-th (median of {len(timings) - 1}) {statistics.median(timings[1:]) * 1000:8.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="BAAI/RoboBrain2.0-3B")
+    parser.add_argument("--image", default="dataset/electric stove.jpeg")
+    parser.add_argument("--reference", default="timer button", help="DATASET_IMAGES key used for the RAG prompts, or '' for plain pointing.")
+    parser.add_argument("--prompts", type=int, default=8)
+    args = parser.parse_args()
+
+    model = SimpleInference(args.model)
+    reference_path = ReferenceStore(DATASET_IMAGES).get(args.reference) if args.reference else None
+
+    # Warm up kernels on a different key so neither run starts with a cached image
+    run(model, args.image, reference_path, 1, image_id="warmup")
+    model.vision_cache.clear()
+
+    cached = run(model, args.image, reference_path, args.prompts, image_id="benchmark")
+    vision_cache, model.vision_cache = model.vision_cache, None
+    uncached = run(model, args.image, reference_path, args.prompts, image_id="benchmark")
+    model.vision_cache = vision_cache
+
+    print(f"\n{args.prompts} prompts on {args.image}" + (f" with reference '{args.reference}'" if reference_path else ""))
+    report("no cache", uncached)
+    report("vision cache", cached)
+    print(f"vision cache stats: {model.vision_cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Latency, GPU memory and pointing error of a pointing prompt at several visual-token budgets.
+
+Every image is resized to at most N visual tokens (one token per 28x28 pixels) before the vision tower,
+for each N in --budgets. The error is the distance in original-image pixels between the first point of
+each run and the ground truth (--ground-truth, a JSON file {"image path": [x, y]}), or, for images without
+one, the point found at the largest budget.
+
+Usage:
+    python benchmarks/benchmark_visual_tokens.py --images "dataset/electric stove.jpeg" --prompt "point to the power button"
+    python benchmarks/benchmark_visual_tokens.py --images photos/*.jpg --budgets 64 256 1024 4096 --ground-truth points.json
+"""
+import argparse
+import json
+import math
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from PIL import Image
+
+from inference import SimpleInference
+
+
+def run(model, image, prompt, max_tokens):
+    """One pointing call at `max_tokens`; returns the first point, latency (s), peak memory (bytes) and visual tokens."""
+    model.visual_token_budgets = {"pointing": {"image": (4, max_tokens)}}
+    torch.cuda.reset_peak_memory_stats()
+    torch.cuda.synchronize()
+    start = time.perf_counter()
+    encoded = model.encode_image(image, budget=model.pixel_budget("pointing"))
+    result = model.inference(prompt, encoded, task="pointing", enable_thinking=False, do_sample=False)
+    torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    tokens = int(encoded.image_grid_thw.prod()) // model.processor.image_processor.merge_size ** 2
+    points = result.get("points") or [None]
+    return points[0], elapsed, torch.cuda.max_memory_allocated(), tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="BAAI/RoboBrain2.0-3B")
+    parser.add_argument("--images", nargs="+", default=["dataset/electric stove.jpeg"])
+    parser.add_argument("--prompt", default="point to the power button")
+    parser.add_argument("--budgets", type=int, nargs="+", default=[64, 128, 256, 512, 1024, 2048])
+    parser.add_argument("--ground-truth", default="", help="JSON file mapping image paths to the expected [x, y].")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    ground_truth = {}
+    if args.ground_truth:
+        with open(args.ground_truth) as f:
+            ground_truth = json.load(f)
+
+    # The vision cache would hide the vision-tower cost of every repeat after the first
+    model = SimpleInference(args.model, vision_cache_bytes=0)
+    images = {path: Image.open(path).convert("RGB") for path in args.images}
+    budgets = sorted(args.budgets)
+    # Warm-up, so CUDA initialisation is not part of the first measurement
+    run(model, next(iter(images.values())), args.prompt, budgets[0])
+
+    measured = {budget: {} for budget in budgets}
+    for budget in budgets:
+        for path, image in images.items():
+            runs = [run(model, image, args.prompt, budget) for _ in range(args.repeats)]
+            measured[budget][path] = (runs[0][0], statistics.median(r[1] for r in runs), max(r[2] for r in runs), runs[0][3])
+
+    print(f"\n{'max tokens':>10}{'tokens':>8}{'latency':>11}{'peak memory':>14}{'error':>10}{'no point':>10}")
+    for budget in budgets:
+        errors, missing = [], 0
+        for path in images:
+            point = measured[budget][path][0]
+            target = ground_truth.get(path) or measured[budgets[-1]][path][0]
+            if point is None or target is None:
+                missing += 1
+            else:
+                errors.append(math.dist(point, target))
+        rows = measured[budget].values()
+        tokens = statistics.median(row[3] for row in rows)
+        latency = statistics.median(row[1] for row in rows)
+        memory = max(row[2] for row in rows)
+        error = f"{statistics.mean(errors):>7.1f} px" if errors else f"{'-':>10}"
+        print(f"{budget:>10}{tokens:>8.0f}{latency * 1000:>8.0f} ms{memory / 1024 ** 2:>11.0f} MB{error}{missing:>10}")
+
+
+if __name__ == "__main__":
+    main()
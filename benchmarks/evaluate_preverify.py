@@ -0,0 +1,89 @@
+"""
+How often the keypoint pre-check settles a RAG verification without the model, and how often it agrees with it.
+
+Every image in --images is checked against every reference (or the --references given). With --model,
+each pair is also classified by the model like /verify does, and the agreement rate of the pairs the
+pre-check decided is reported; otherwise only the skip share and the pre-check cost are.
+
+Usage:
+    python benchmarks/evaluate_preverify.py --images verified_images --limit 50
+    python benchmarks/evaluate_preverify.py --references "ac remote" "kettle" --model BAAI/RoboBrain2.0-3B
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+from dataset import DATASET_IMAGES
+from image_store import IMAGE_EXTENSIONS
+from preverify import PreVerifier
+from reference_store import ReferenceStore
+
+
+def list_images(directory, limit):
+    # Walk the shards too: the server stores verified images under <id[:2]>/<id>.<ext>
+    paths = []
+    for root, _, files in os.walk(directory):
+        paths.extend(os.path.join(root, name) for name in files if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+    return sorted(paths)[:limit or None]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", default="verified_images")
+    parser.add_argument("--limit", type=int, default=0, help="Only use the first N images (0 = all).")
+    parser.add_argument("--references", nargs="*", help="DATASET_IMAGES keys to check against (default: all).")
+    parser.add_argument("--accept-inliers", type=int, default=25)
+    parser.add_argument("--reject-inliers", type=int, default=3)
+    parser.add_argument("--model", default="", help="Also classify every pair with this model to measure agreement.")
+    parser.add_argument("--threshold", type=float, default=0.5, help="P('same') the model needs to verify.")
+    args = parser.parse_args()
+
+    store = ReferenceStore(DATASET_IMAGES)
+    names = args.references or list(store)
+    verifier = PreVerifier(accept_inliers=args.accept_inliers, reject_inliers=args.reject_inliers)
+    verifier.warm([store[name] for name in names])
+    model = None
+    if args.model:
+        from inference import SimpleInference
+        model = SimpleInference(args.model)
+
+    images = list_images(args.images, args.limit)
+    counts = {"same": 0, "different": 0, None: 0}
+    agree, compared, check_ms, model_ms = 0, 0, [], []
+    for path in images:
+        image = Image.open(path).convert("RGB")
+        for name in names:
+            start = time.perf_counter()
+            verdict, _ = verifier.check(image, store[name])
+            check_ms.append((time.perf_counter() - start) * 1000)
+            counts[verdict] += 1
+
+            if model is not None and verdict is not None:
+                start = time.perf_counter()
+                result = model.classify(name, [image, store[name]], task="verify_based_on_reference")
+                model_ms.append((time.perf_counter() - start) * 1000)
+                model_verdict = "same" if result["scores"]["same"] >= args.threshold else "different"
+                compared += 1
+                agree += model_verdict == verdict
+
+    total = sum(counts.values())
+    if not total:
+        sys.exit(f"No images found in {args.images}.")
+    decided = counts["same"] + counts["different"]
+    print(f"\n{len(images)} images x {len(names)} references = {total} verifications")
+    print(f"decided by keypoints   {decided:>6} ({decided / total:.1%})  same {counts['same']}, different {counts['different']}")
+    print(f"left to the model      {counts[None]:>6} ({counts[None] / total:.1%})")
+    print(f"pre-check cost         {statistics.median(check_ms):>6.1f} ms median")
+    if compared:
+        print(f"agreement with model   {agree / compared:>6.1%} of {compared} decided pairs")
+        print(f"model cost             {statistics.median(model_ms):>6.1f} ms median")
+
+
+if __name__ == "__main__":
+    main()
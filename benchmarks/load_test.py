@@ -0,0 +1,286 @@
+"""
+End-to-end load test of the verify -> prompt API, with latency percentiles per endpoint as JSON.
+
+Every session uploads an image from dataset/ or verified_images/ to /verify and, if it is verified, sends
+--prompts pointing prompts on the returned image_id (a --stream-fraction of them to /prompt_stream),
+--think-ms apart. Sessions either run back to back on --concurrency workers (closed loop), or arrive at
+--rate sessions per second as a Poisson process with at most --concurrency running (open loop).
+
+The server is either a running instance (--url) or New_API.py loaded in this process (--in-process),
+optionally with the fake model (--fake-latency-ms) so the server hot path can be measured without a GPU.
+The report has p50/p95/p99 latency, status counts and error rate per endpoint, the server-side queueing
+delay (the "timing" of each result), throughput and, for streams, the time to the first point
+(only meaningful over HTTP: in process, httpx hands over a streamed body once it is complete).
+With --compare, the percentiles are printed next to those of an earlier report.
+
+Usage:
+    python benchmarks/load_test.py --in-process --fake-latency-ms 80 --sessions 200 --concurrency 8
+    python benchmarks/load_test.py --url http://127.0.0.1:8000 --rate 2 --duration 60 --output run.json
+    python benchmarks/load_test.py --in-process --fake-latency-ms 80 --output new.json --compare baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import httpx
+
+from dataset import DATASET_IMAGES
+from image_store import IMAGE_EXTENSIONS
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return None
+    ordered = sorted(values)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {"p50": round(pick(0.50), 2), "p95": round(pick(0.95), 2), "p99": round(pick(0.99), 2), "mean": round(sum(ordered) / len(ordered), 2), "max": round(ordered[-1], 2)}
+
+
+class Recorder:
+    """Latencies, status codes and server-side queueing delays per endpoint."""
+
+    def __init__(self):
+        self.latency_ms = defaultdict(list)
+        self.queue_wait_ms = defaultdict(list)
+        self.first_point_ms = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.client_wait_ms = []
+
+    def add(self, endpoint: str, status, latency_ms: float, result=None):
+        self.statuses[endpoint][str(status)] += 1
+        self.latency_ms[endpoint].append(latency_ms)
+        timing = result.get("timing") if isinstance(result, dict) else None
+        if timing and "wait_ms" in timing:
+            self.queue_wait_ms[endpoint].append(timing["wait_ms"])
+
+    def report(self, elapsed_s: float, sessions: int) -> dict:
+        endpoints = {}
+        for endpoint, statuses in self.statuses.items():
+            count = sum(statuses.values())
+            # A 404 from /verify is a rejected image, not a server error
+            errors = sum(n for status, n in statuses.items() if not status.startswith("2") and not (endpoint == "/verify" and status == "404"))
+            endpoints[endpoint] = {
+                "count": count,
+                "throughput_rps": round(count / elapsed_s, 2),
+                "errors": errors,
+                "error_rate": round(errors / count, 4),
+                "status": dict(statuses),
+                "latency_ms": percentiles(self.latency_ms[endpoint]),
+                "queue_wait_ms": percentiles(self.queue_wait_ms[endpoint]),
+                "first_point_ms": percentiles(self.first_point_ms[endpoint]),
+            }
+        calls = sum(e["count"] for e in endpoints.values())
+        errors = sum(e["errors"] for e in endpoints.values())
+        return {
+            "duration_s": round(elapsed_s, 2),
+            "sessions": sessions,
+            "sessions_per_s": round(sessions / elapsed_s, 2),
+            "throughput_rps": round(calls / elapsed_s, 2),
+            "error_rate": round(errors / calls, 4) if calls else 0.0,
+            "client_queue_ms": percentiles(self.client_wait_ms),
+            "endpoints": endpoints,
+        }
+
+
+def load_images(limit: int) -> list:
+    """(file name, bytes, object_id) of the dataset references and the verified images."""
+    images = []
+    for name, path in DATASET_IMAGES.items():
+        path = os.path.join(ROOT, path)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                images.append((os.path.basename(path), f.read(), name))
+    names = list(DATASET_IMAGES)
+    rng = random.Random(0)
+    # Verified images carry no label; they are checked against a random object, like a wrong guess would be
+    for directory, _, files in os.walk(os.path.join(ROOT, "verified_images")):
+        for file_name in sorted(files):
+            if os.path.splitext(file_name)[1].lower() in IMAGE_EXTENSIONS:
+                with open(os.path.join(directory, file_name), "rb") as f:
+                    images.append((file_name, f.read(), rng.choice(names)))
+    return images[:limit or None]
+
+
+async def timed_post(client, recorder, endpoint, **kwargs):
+    start = time.perf_counter()
+    try:
+        response = await client.post(endpoint, **kwargs)
+    except httpx.HTTPError as e:
+        recorder.add(endpoint, type(e).__name__, (time.perf_counter() - start) * 1000)
+        return None, None
+    latency_ms = (time.perf_counter() - start) * 1000
+    try:
+        result = response.json()
+    except ValueError:
+        result = None
+    recorder.add(endpoint, response.status_code, latency_ms, result)
+    return response.status_code, result
+
+
+async def timed_stream(client, recorder, data):
+    """/prompt_stream, recording the time to the first point event and to the end of the stream."""
+    endpoint = "/prompt_stream"
+    start = time.perf_counter()
+    first_point, result, event = None, None, None
+    try:
+        async with client.stream("POST", endpoint, data=data) as response:
+            status = response.status_code
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                    if event == "point" and first_point is None:
+                        first_point = (time.perf_counter() - start) * 1000
+                elif line.startswith("data: ") and event == "done":
+                    result = json.loads(line[len("data: "):])
+                elif line.startswith("data: ") and event == "error":
+                    status = "stream_error"
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    recorder.add(endpoint, status, (time.perf_counter() - start) * 1000, result)
+    if first_point is not None:
+        recorder.first_point_ms[endpoint].append(first_point)
+
+
+async def session(client, recorder, rng, images, args):
+    file_name, data, object_id = rng.choice(images)
+    status, result = await timed_post(client, recorder, "/verify", data={"object_id": object_id}, files={"image": (file_name, data)})
+    if status != 200:
+        return
+    prompts = list(DATASET_IMAGES)
+    for i in range(args.prompts):
+        if i or args.think_ms:
+            await asyncio.sleep(args.think_ms / 1000)
+        form = {"image_id": result["image_id"], "prompt": f"point to the {rng.choice(prompts)}"}
+        if rng.random() < args.stream_fraction:
+            await timed_stream(client, recorder, form)
+        else:
+            await timed_post(client, recorder, "/prompt", data=form)
+
+
+async def run(client, args, images) -> dict:
+    recorder = Recorder()
+    rng = random.Random(args.seed)
+    deadline = time.monotonic() + args.duration if args.duration else None
+    budget = {"left": args.sessions if not args.duration else float("inf"), "done": 0}
+
+    def another():
+        if budget["left"] <= 0 or (deadline is not None and time.monotonic() >= deadline):
+            return False
+        budget["left"] -= 1
+        return True
+
+    async def one_session():
+        await session(client, recorder, rng, images, args)
+        budget["done"] += 1
+
+    start = time.perf_counter()
+    if args.rate <= 0:
+        # Closed loop: every worker starts its next session as soon as the last one ends
+        async def worker():
+            while another():
+                await one_session()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    else:
+        # Open loop: sessions arrive on schedule, whether or not earlier ones are done
+        slots = asyncio.Semaphore(args.concurrency)
+
+        async def arrival():
+            arrived = time.perf_counter()
+            async with slots:
+                recorder.client_wait_ms.append((time.perf_counter() - arrived) * 1000)
+                await one_session()
+
+        tasks = []
+        while another():
+            tasks.append(asyncio.create_task(arrival()))
+            await asyncio.sleep(rng.expovariate(args.rate))
+        await asyncio.gather(*tasks)
+    return recorder.report(time.perf_counter() - start, budget["done"])
+
+
+def client_for(args):
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    timeout = httpx.Timeout(args.timeout)
+    if not args.in_process:
+        return httpx.AsyncClient(base_url=args.url, limits=limits, timeout=timeout)
+
+    # Configure New_API.py before it is imported, since it sets itself up at import time
+    if args.fake_latency_ms is not None:
+        os.environ["ROBOBRAIN_FAKE_MODEL"] = json.dumps({"latency_ms": args.fake_latency_ms, "per_request_ms": args.fake_per_request_ms, "seed": args.seed})
+    os.environ.setdefault("ROBOBRAIN_PERSIST_VERIFIED", "0")
+    if args.no_result_cache:
+        os.environ["ROBOBRAIN_RESULT_CACHE_SIZE"] = "0"
+    os.chdir(ROOT)
+    from New_API import app
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://robobrain", limits=limits, timeout=timeout)
+
+
+def compare(report: dict, baseline: dict):
+    print(f"\n{'endpoint':<16}{'':>6}{'baseline':>12}{'now':>12}{'change':>9}")
+    for endpoint, now in report["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(endpoint)
+        if not before or not before["latency_ms"] or not now["latency_ms"]:
+            continue
+        for q in ("p50", "p95", "p99"):
+            old, new = before["latency_ms"][q], now["latency_ms"][q]
+            print(f"{endpoint:<16}{q:>6}{old:>9.1f} ms{new:>9.1f} ms{(new - old) / old if old else 0:>+9.1%}")
+    print(f"{'throughput':<22}{baseline['throughput_rps']:>9.2f}/s{report['throughput_rps']:>10.2f}/s")
+    print(f"{'error rate':<22}{baseline['error_rate']:>11.2%}{report['error_rate']:>12.2%}")
+
+
+async def main_async(args):
+    images = load_images(args.images)
+    if not images:
+        sys.exit("No images found in dataset/ or verified_images/.")
+    async with client_for(args) as client:
+        report = await run(client, args, images)
+    report["config"] = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    report["config"]["images"] = len(images)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--in-process", action="store_true", help="Load New_API.py in this process instead of calling --url.")
+    parser.add_argument("--fake-latency-ms", type=float, default=None, help="In process: serve with the fake model, with this latency per batch.")
+    parser.add_argument("--fake-per-request-ms", type=float, default=10)
+    parser.add_argument("--no-result-cache", action="store_true", help="In process: disable the result cache, so every call runs the model.")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=0, help="Sessions per second (open loop); 0 runs --concurrency sessions back to back.")
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=0, help="Run for this many seconds instead of a number of sessions.")
+    parser.add_argument("--prompts", type=int, default=3, help="Prompts per verified image.")
+    parser.add_argument("--stream-fraction", type=float, default=0.0)
+    parser.add_argument("--think-ms", type=float, default=0)
+    parser.add_argument("--images", type=int, default=0, help="Use at most this many images (0 = all).")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="", help="Write the JSON report here.")
+    parser.add_argument("--compare", default="", help="An earlier JSON report to compare the percentiles with.")
+    args = parser.parse_args()
+    # In process, New_API.py is loaded from the repository root
+    args.output = os.path.abspath(args.output) if args.output else ""
+    args.compare = os.path.abspath(args.compare) if args.compare else ""
+
+    report = asyncio.run(main_async(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
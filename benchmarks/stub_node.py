@@ -0,0 +1,88 @@
+"""
+A stand-in for New_API.py with the same stateful /verify -> /prompt flow and no model, to run the gateway locally.
+
+/verify stores the upload under the same content-derived image_id New_API.py uses, /prompt answers 404 for
+image_ids this node has not verified, and /images lists, serves and imports images like the real node.
+Every /verify and /prompt holds the node for --service-ms, one request at a time, like a single GPU would.
+
+Usage:
+    python benchmarks/stub_node.py --port 8001 --service-ms 20
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import uvicorn
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import Response
+
+from image_store import content_image_id
+
+app = FastAPI(title="RoboBrain stub node")
+images = {}
+service_s = 0.02
+model_lock = None
+counters = {"verified": 0, "prompts": 0, "imported": 0}
+
+
+async def run_model():
+    global model_lock
+    if model_lock is None:
+        model_lock = asyncio.Lock()
+    async with model_lock:
+        await asyncio.sleep(service_s)
+
+
+@app.get("/")
+def root():
+    return {"message": "RoboBrain stub node"}
+
+@app.get("/stats")
+def stats():
+    return {**counters, "verified_images_in_memory": len(images)}
+
+@app.post("/verify")
+async def verify(object_id: str = Form(...), image: UploadFile = File(...)):
+    data = await image.read()
+    await run_model()
+    image_id = content_image_id(data)
+    images[image_id] = data
+    counters["verified"] += 1
+    return {"status": "verified", "image_id": image_id, "confidence": 1.0}
+
+@app.post("/prompt")
+async def prompt(image_id: str = Form(...), prompt: str = Form("")):
+    if image_id not in images:
+        raise HTTPException(status_code=404, detail=f"Image with ID '{image_id}' not found. Please verify the image first.")
+    await run_model()
+    counters["prompts"] += 1
+    return {"answer": "[(0, 0)]", "points": [[0, 0]], "node": os.getpid()}
+
+@app.get("/images")
+def list_images():
+    return {"image_ids": list(images)}
+
+@app.get("/images/{image_id}")
+def download_image(image_id: str):
+    if image_id not in images:
+        raise HTTPException(status_code=404, detail="Not found.")
+    return Response(content=images[image_id], media_type="image/png")
+
+@app.post("/images")
+async def import_image(image: UploadFile = File(...)):
+    data = await image.read()
+    images[content_image_id(data)] = data
+    counters["imported"] += 1
+    return {"image_id": content_image_id(data)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--service-ms", type=float, default=20)
+    args = parser.parse_args()
+    service_s = args.service_ms / 1000
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
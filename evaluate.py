@@ -0,0 +1,289 @@
+"""
+Offline regression evaluation of verification and pointing, run in batches directly on SimpleInference.
+
+Entries come from --manifest, a JSONL file with one object per line, e.g.
+    {"id": "stove-1", "image": "eval/stove.jpg", "object_id": "electric stove",
+     "prompt": "point to the power button", "expected_label": "same", "expected_point": [412, 230]}
+or from every image in --images, with --object-id, --prompt and --expected-label applied to all of them and
+the expected points read from --ground-truth (a JSON file {"file name": [x, y]}). Only "image" is required:
+an entry is verified if it has an object_id and pointed on if it has a prompt. "id" defaults to the image
+path plus the object_id and prompt.
+
+Each entry runs once per --variants: "base" uses the model alone ("verify", "pointing"); "rag" matches the
+object_id and prompt against the DATASET_IMAGES references like the server does and runs the reference tasks
+when one matches (the base tasks otherwise). Images are decoded and preprocessed by --workers threads,
+--prefetch batches ahead of the model. Every (entry, variant) is appended to --output as one JSON line as
+soon as its batch is done, and a rerun skips the rows already there, so an interrupted run resumes where it
+stopped; rows that failed with an "error" are run again. The report covers the latest row of every entry
+and variant in --output: verification accuracy, pointing error in pixels of the original image and the
+share of points within --radius, per variant; images/s is for this run.
+
+Usage:
+    python evaluate.py --manifest eval/manifest.jsonl --output eval/results.jsonl
+    python evaluate.py --images eval/stove --object-id "electric stove" --prompt "point to the power button" --ground-truth eval/stove.json
+    python evaluate.py --output eval/results.jsonl --report-only
+"""
+import argparse
+import json
+import math
+import os
+import statistics
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from dataset import DATASET_IMAGES
+from image_store import IMAGE_EXTENSIONS
+from reference_store import ReferenceStore
+from retrieval import ReferenceIndex
+
+VARIANTS = ("base", "rag")
+# Task per kind of call, without and with a reference image
+TASKS = {
+    "verify": ("verify", "verify_based_on_reference"),
+    "point": ("pointing", "pointing_based_on_reference"),
+}
+
+
+def load_entries(args) -> list:
+    if args.manifest:
+        with open(args.manifest) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+    else:
+        ground_truth = {}
+        if args.ground_truth:
+            with open(args.ground_truth) as f:
+                ground_truth = json.load(f)
+        names = sorted(name for name in os.listdir(args.images) if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+        entries = [{
+            "image": os.path.join(args.images, name),
+            "object_id": args.object_id,
+            "prompt": args.prompt,
+            "expected_label": args.expected_label,
+            "expected_point": ground_truth.get(name),
+        } for name in names]
+    for entry in entries:
+        entry.setdefault("id", "|".join([entry["image"], entry.get("object_id") or "", entry.get("prompt") or ""]))
+    return entries[:args.limit or None]
+
+
+def read_rows(path: str) -> list:
+    """The rows already in the output file. A last line cut off by a crash is removed from the file."""
+    if not os.path.exists(path):
+        return []
+    rows, complete = [], 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                break
+            complete += len(line)
+    if complete < os.path.getsize(path):
+        with open(path, "r+b") as f:
+            f.truncate(complete)
+    return rows
+
+
+class Evaluator:
+    """Prepares entries (in worker threads) and runs the prepared batches through the model."""
+
+    def __init__(self, model, threshold=0.5, rag_threshold=0.75):
+        self.model = model
+        self.threshold = threshold
+        self.references = ReferenceStore(DATASET_IMAGES)
+        self.index = ReferenceIndex(threshold=rag_threshold)
+        self.index.add_many({name: self.references.source(name) for name in self.references})
+
+    def prepare(self, entry: dict, variants: list) -> dict:
+        """
+        Decode the entry's image and preprocess it (and any matched reference) for every call it needs.
+        Failures are kept in "error", so they end up in the entry's rows instead of stopping the run.
+        """
+        prepared = {"entry": entry, "variants": variants, "calls": [], "error": None}
+        try:
+            image = Image.open(entry["image"]).convert("RGB")
+        except (OSError, ValueError) as e:
+            prepared["error"] = f"Cannot read {entry['image']}: {e}"
+            return prepared
+
+        # Same key for every budget, so the vision cache shares an encoding between variants
+        key = f"evaluate:{entry['id']}"
+        prepared["key"] = key
+        encodings = {}
+        try:
+            for variant in variants:
+                for kind, text in (("verify", entry.get("object_id")), ("point", entry.get("prompt"))):
+                    if not text:
+                        continue
+                    match = self.index.match(text) if variant == "rag" else None
+                    task = TASKS[kind][match is not None]
+                    budget = self.model.pixel_budget(task, "image")
+                    if budget not in encodings:
+                        encodings[budget] = self.model.encode_image(image, key=key, budget=budget)
+                    images = [encodings[budget]]
+                    if match is not None:
+                        images.append(self.model.reference_cache.get(self.references[match[0]], self.model.pixel_budget(task, "reference")))
+                    prepared["calls"].append({"variant": variant, "kind": kind, "task": task, "text": text, "image": images, "reference": match and match[0]})
+        except Exception as e:
+            prepared["error"] = f"Preprocessing failed: {type(e).__name__}: {e}"
+            prepared["calls"] = []
+        return prepared
+
+    def run(self, batch: list, batch_size: int) -> list:
+        """Classify and point for a list of prepared entries; returns one row per (entry, variant)."""
+        calls = [call for prepared in batch for call in prepared["calls"]]
+        verifications = [call for call in calls if call["kind"] == "verify"]
+        pointings = [call for call in calls if call["kind"] == "point"]
+        for start in range(0, len(verifications), batch_size):
+            chunk = verifications[start:start + batch_size]
+            self._call_model(chunk, lambda: self.model.batch_classify([{"text": call["text"], "image": call["image"], "task": call["task"]} for call in chunk]))
+        for start in range(0, len(pointings), batch_size):
+            chunk = pointings[start:start + batch_size]
+            requests = [{"text": call["text"], "image": call["image"], "task": call["task"], "enable_thinking": False} for call in chunk]
+            # Greedy, so a rerun of the same tree gives the same points
+            self._call_model(chunk, lambda: self.model.batch_inference(requests, do_sample=False))
+
+        rows = []
+        for prepared in batch:
+            entry = prepared["entry"]
+            if "key" in prepared:
+                self.model.forget_image(prepared["key"])
+            for variant in prepared["variants"]:
+                row = {"id": entry["id"], "variant": variant, "image": entry["image"], "object_id": entry.get("object_id"), "prompt": entry.get("prompt")}
+                if prepared["error"]:
+                    row["error"] = prepared["error"]
+                for call in prepared["calls"]:
+                    if call["variant"] != variant:
+                        continue
+                    if "error" in call:
+                        row["error"] = call["error"]
+                    else:
+                        row[call["kind"]] = self.score(entry, call)
+                rows.append(row)
+        return rows
+
+    def _call_model(self, chunk: list, run):
+        """Store the results of one model call on its calls; a failure (e.g. out of memory) fails only those calls."""
+        try:
+            results = run()
+        except Exception as e:
+            print(f"A batch of {len(chunk)} failed: {type(e).__name__}: {e}")
+            for call in chunk:
+                call["error"] = f"Model call failed: {type(e).__name__}: {e}"
+            return
+        for call, result in zip(chunk, results):
+            call["result"] = result
+
+    def score(self, entry: dict, call: dict) -> dict:
+        result = call["result"]
+        scored = {"task": call["task"], "reference": call["reference"]}
+        if call["kind"] == "verify":
+            same = result["scores"]["same"]
+            scored.update({"p_same": round(same, 4), "label": "same" if same >= self.threshold else "different"})
+            if entry.get("expected_label"):
+                scored["correct"] = scored["label"] == entry["expected_label"]
+        else:
+            points = result.get("points") or []
+            scored.update({"answer": result["answer"], "point": points[0] if points else None, "generated_tokens": result.get("generated_tokens")})
+            expected = entry.get("expected_point")
+            if expected:
+                scored["error_px"] = round(math.dist(points[0], expected), 1) if points else None
+        return scored
+
+
+def prepared_batches(evaluator, entries, done, args):
+    """Prepared batches of the entries not done yet, with --prefetch batches preparing ahead in --workers threads."""
+    todo = [(entry, [variant for variant in args.variants if (entry["id"], variant) not in done]) for entry in entries]
+    todo = [(entry, variants) for entry, variants in todo if variants]
+    batches = [todo[i:i + args.batch_size] for i in range(0, len(todo), args.batch_size)]
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append([pool.submit(evaluator.prepare, entry, variants) for entry, variants in batch])
+            if len(pending) > args.prefetch:
+                yield [future.result() for future in pending.popleft()]
+        while pending:
+            yield [future.result() for future in pending.popleft()]
+
+
+def report(rows: list, radius: float):
+    print(f"\n{'variant':<8}{'rows':>6}{'errors':>8}{'verify acc':>12}{'n':>6}{'median px':>11}{'mean px':>9}{'no point':>10}{f'<= {radius:g} px':>11}{'n':>6}")
+    for variant in VARIANTS:
+        selected = [row for row in rows if row["variant"] == variant]
+        if not selected:
+            continue
+        verified = [row["verify"]["correct"] for row in selected if "correct" in row.get("verify", {})]
+        pointed = [row["point"] for row in selected if "error_px" in row.get("point", {})]
+        errors = [point["error_px"] for point in pointed if point["error_px"] is not None]
+        accuracy = f"{sum(verified) / len(verified):.1%}" if verified else "-"
+        median = f"{statistics.median(errors):.1f}" if errors else "-"
+        mean = f"{statistics.mean(errors):.1f}" if errors else "-"
+        within = f"{sum(error <= radius for error in errors) / len(pointed):.1%}" if pointed else "-"
+        failed = sum("error" in row for row in selected)
+        print(f"{variant:<8}{len(selected):>6}{failed:>8}{accuracy:>12}{len(verified):>6}{median:>11}{mean:>9}{len(pointed) - len(errors):>10}{within:>11}{len(pointed):>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--manifest", default="", help="JSONL file of entries.")
+    parser.add_argument("--images", default="", help="Directory of images, instead of --manifest.")
+    parser.add_argument("--object-id", default="", help="object_id of every image in --images.")
+    parser.add_argument("--prompt", default="", help="Pointing prompt of every image in --images.")
+    parser.add_argument("--expected-label", choices=["same", "different"], help="Expected verification of every image in --images.")
+    parser.add_argument("--ground-truth", default="", help="JSON file mapping the file names in --images to the expected [x, y].")
+    parser.add_argument("--output", default="evaluation.jsonl")
+    parser.add_argument("--variants", nargs="+", choices=VARIANTS, default=list(VARIANTS))
+    parser.add_argument("--model", default="BAAI/RoboBrain2.0-3B")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=4, help="Threads decoding and preprocessing images.")
+    parser.add_argument("--prefetch", type=int, default=2, help="Batches prepared ahead of the model.")
+    parser.add_argument("--threshold", type=float, default=0.5, help="P('same') needed to verify.")
+    parser.add_argument("--rag-threshold", type=float, default=0.75, help="Minimum retrieval score to use a reference.")
+    parser.add_argument("--radius", type=float, default=25, help="Points within this many pixels of the expected one count as hits.")
+    parser.add_argument("--limit", type=int, default=0, help="Only use the first N entries (0 = all).")
+    parser.add_argument("--report-only", action="store_true", help="Only report on the rows already in --output.")
+    args = parser.parse_args()
+
+    rows = read_rows(args.output)
+    if not args.report_only:
+        if not args.manifest and not args.images:
+            sys.exit("Give --manifest or --images.")
+        entries = load_entries(args)
+        # Failed rows (e.g. an image that could not be read) are retried
+        done = {(row["id"], row["variant"]) for row in rows if "error" not in row}
+        remaining = sum((entry["id"], variant) not in done for entry in entries for variant in args.variants)
+        print(f"{len(entries)} entries x {len(args.variants)} variants: {remaining} to run, {len(entries) * len(args.variants) - remaining} already in {args.output}.")
+
+        if remaining:
+            from inference import SimpleInference
+            evaluator = Evaluator(SimpleInference(args.model), threshold=args.threshold, rag_threshold=args.rag_threshold)
+            images, start = 0, time.perf_counter()
+            with open(args.output, "a") as output:
+                for batch in prepared_batches(evaluator, entries, done, args):
+                    new_rows = evaluator.run(batch, args.batch_size)
+                    for row in new_rows:
+                        output.write(json.dumps(row) + "\n")
+                    # One flush per batch: a crash loses at most the batch that was running
+                    output.flush()
+                    os.fsync(output.fileno())
+                    rows.extend(new_rows)
+                    images += len(batch)
+                    print(f"{images} images, {images / (time.perf_counter() - start):.2f} images/s")
+            elapsed = time.perf_counter() - start
+            print(f"\nThis run: {images} images in {elapsed:.1f} s, {images / elapsed:.2f} images/s")
+
+    if not rows:
+        sys.exit(f"No results in {args.output}.")
+    # A retried row replaces the failed one before it
+    latest = {(row["id"], row["variant"]): row for row in rows}
+    report(list(latest.values()), args.radius)
+
+
+if __name__ == "__main__":
+    main()
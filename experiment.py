@@ -59,6 +59,58 @@ def verify_image(image_path: str, object_id: str) -> str | None:
         console.print(f"❌ A network error occurred: {e}", style="bold red")
         return None
 
+def show_pointing_result(result_data: dict, image_id: str, original_image_path: str):
+    """Draws the returned point on the original image, then saves and displays the result."""
+    console.print("✅ Task complete. Received JSON response:", style="green")
+    console.print(result_data)
+
+    # --- UPDATED DRAWING LOGIC ---
+    coordinates = None
+    answer_string = result_data.get('answer') # Get the string from the 'answer' key
+
+    if result_data.get('points'):
+        # The server already parsed the answer into a list of [x, y] points
+        coordinates = tuple(result_data['points'][0])
+    elif answer_string:
+        try:
+            # Safely convert the string '[(343, 526)]' into a Python list [(343, 526)]
+            parsed_list = ast.literal_eval(answer_string)
+            
+            # Check if we got a list with at least one coordinate tuple inside
+            if isinstance(parsed_list, list) and len(parsed_list) > 0:
+                coordinates = parsed_list[0] # Grab the first tuple, e.g., (343, 526)
+                
+        except (ValueError, SyntaxError):
+            console.print(f"Could not parse coordinates from the server's answer string: {answer_string}", style="yellow")
+
+    # Now, check if we successfully got the coordinates before drawing
+    if coordinates and len(coordinates) == 2:
+        # Open the original image to draw on
+        image = Image.open(original_image_path).convert("RGB")
+        draw = ImageDraw.Draw(image)
+
+        # Define dot properties
+        x, y = coordinates
+        radius = 15  # Dot size
+        color = "green"
+        
+        # Calculate bounding box for the circle
+        bounding_box = [x - radius, y - radius, x + radius, y + radius]
+        draw.ellipse(bounding_box, fill=color, outline=color)
+
+        # Save the modified image
+        timestamp = int(time.time())
+        filename = f"result_{timestamp}_{image_id}.png"
+        save_path = os.path.join(RESULTS_DIR, filename)
+        image.save(save_path)
+        
+        console.print(f"Dot drawn at ({x},{y}). Result saved to: [cyan]{save_path}[/cyan]")
+        
+        # Display the image with the dot
+        image.show()
+    else:
+        console.print("Could not find point coordinates in the server response.", style="yellow")
+
 def run_prompt(image_id: str, prompt: str, original_image_path: str):
     """
     Sends prompt to server, gets coordinates, draws a dot on the original image,
@@ -72,54 +124,7 @@ def run_prompt(image_id: str, prompt: str, original_image_path: str):
         response = requests.post(prompt_url, data=data, timeout=180)
 
         if response.status_code == 200:
-            result_data = response.json()
-            console.print("✅ Task complete. Received JSON response:", style="green")
-            console.print(result_data)
-
-            # --- UPDATED DRAWING LOGIC ---
-            coordinates = None
-            answer_string = result_data.get('answer') # Get the string from the 'answer' key
-
-            if answer_string:
-                try:
-                    # Safely convert the string '[(343, 526)]' into a Python list [(343, 526)]
-                    parsed_list = ast.literal_eval(answer_string)
-                    
-                    # Check if we got a list with at least one coordinate tuple inside
-                    if isinstance(parsed_list, list) and len(parsed_list) > 0:
-                        coordinates = parsed_list[0] # Grab the first tuple, e.g., (343, 526)
-                        
-                except (ValueError, SyntaxError):
-                    console.print(f"Could not parse coordinates from the server's answer string: {answer_string}", style="yellow")
-
-            # Now, check if we successfully got the coordinates before drawing
-            if coordinates and len(coordinates) == 2:
-                # Open the original image to draw on
-                image = Image.open(original_image_path).convert("RGB")
-                draw = ImageDraw.Draw(image)
-
-                # Define dot properties
-                x, y = coordinates
-                radius = 15  # Dot size
-                color = "green"
-                
-                # Calculate bounding box for the circle
-                bounding_box = [x - radius, y - radius, x + radius, y + radius]
-                draw.ellipse(bounding_box, fill=color, outline=color)
-
-                # Save the modified image
-                timestamp = int(time.time())
-                filename = f"result_{timestamp}_{image_id}.png"
-                save_path = os.path.join(RESULTS_DIR, filename)
-                image.save(save_path)
-                
-                console.print(f"Dot drawn at ({x},{y}). Result saved to: [cyan]{save_path}[/cyan]")
-                
-                # Display the image with the dot
-                image.show()
-            else:
-                console.print("Could not find point coordinates in the server response.", style="yellow")
-
+            show_pointing_result(response.json(), image_id, original_image_path)
         else:
             console.print(f"❌ Prompt failed (HTTP {response.status_code})", style="bold red")
             console.print(f"Server says: {response.text}")
@@ -127,6 +132,36 @@ def run_prompt(image_id: str, prompt: str, original_image_path: str):
     except requests.exceptions.RequestException as e:
         console.print(f"❌ A network error occurred: {e}", style="bold red")
 
+def verify_and_point(image_path: str, object_id: str, prompt: str) -> str | None:
+    """
+    Sends image, object_id and prompt to /verify_and_point, which verifies and
+    points in a single request. Returns the image_id on success.
+    """
+    url = f"{SERVER_URL}/verify_and_point"
+    console.print(f"Verifying '{object_id}' and running prompt '{prompt}'...", style="bold blue")
+
+    try:
+        with open(image_path, "rb") as image_file:
+            files = {"image": (os.path.basename(image_path), image_file)}
+            data = {"object_id": object_id, "prompt": prompt}
+            
+            response = requests.post(url, files=files, data=data, timeout=180)
+
+        if response.status_code == 200:
+            result_data = response.json()
+            image_id = result_data.get("image_id")
+            console.print(f"✅ Verification successful! Image ID: [bold green]{image_id}[/bold green]")
+            show_pointing_result(result_data, image_id, image_path)
+            return image_id
+        else:
+            console.print(f"❌ Request failed (HTTP {response.status_code})", style="bold red")
+            console.print(f"Server says: {response.text}")
+            return None
+
+    except requests.exceptions.RequestException as e:
+        console.print(f"❌ A network error occurred: {e}", style="bold red")
+        return None
+
 def run_full_test_flow() -> dict | None:
     """Orchestrates the entire test flow from file selection to prompt."""
     image_path = select_image_file()
@@ -151,9 +186,8 @@ def run_reprompt_flow(image_path: str) -> dict | None:
         console.print("Object ID and Prompt cannot be empty. Aborting.", style="bold red")
         return None
 
-    image_id = verify_image(image_path, object_id)
+    image_id = verify_and_point(image_path, object_id, prompt)
     if image_id:
-        run_prompt(image_id, prompt, image_path)
         # Return the data so it becomes the new "last run"
         return {"image_path": image_path, "object_id": object_id, "prompt": prompt}
     
@@ -195,9 +229,7 @@ if __name__ == "__main__":
             console.print(f"Object ID: [cyan]{last_run_data['object_id']}[/cyan]")
             console.print(f"Prompt: [cyan]{last_run_data['prompt']}[/cyan]")
             
-            image_id = verify_image(last_run_data['image_path'], last_run_data['object_id'])
-            if image_id:
-                run_prompt(image_id, last_run_data['prompt'], last_run_data['image_path'])
+            verify_and_point(last_run_data['image_path'], last_run_data['object_id'], last_run_data['prompt'])
 
         elif choice == 'r':
             if not last_run_data:
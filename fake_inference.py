@@ -0,0 +1,117 @@
+import random
+import threading
+import time
+
+import torch
+from PIL import Image
+
+from reference_cache import CachedImage, ReferenceTensorCache
+from structured_output import TASK_OUTPUT_TYPES, parse_structured_answer
+
+# Pixels covered by one visual token of the real model (14 px patches, merged 2 x 2)
+PIXELS_PER_TOKEN = 28 * 28
+
+
+class _FakeProcessor:
+    tokenizer = None
+
+
+class FakeInference:
+    """
+    Stand-in for SimpleInference that needs no GPU or checkpoint, for load tests of the API.
+
+    It has the methods New_API.py uses. Images are "encoded" into empty tensors (keeping their size),
+    a batch takes `latency_ms` plus `per_request_ms` for each request in it (varied by +-`jitter`),
+    generated answers are streamed in `chunks` pieces, verification answers "same" with probability
+    `same_rate` and pointing answers a random point inside the image.
+    """
+
+    def __init__(self, latency_ms=80, per_request_ms=10, jitter=0.1, same_rate=1.0, chunks=8, seed=None, reference_cache_bytes=256 * 1024 * 1024, visual_token_budgets=None, **kwargs):
+        self.latency_ms = latency_ms
+        self.per_request_ms = per_request_ms
+        self.jitter = jitter
+        self.same_rate = same_rate
+        self.chunks = max(1, int(chunks))
+        self.visual_token_budgets = visual_token_budgets or {}
+        self.processor = _FakeProcessor()
+        self.vision_cache = None
+        self.reference_cache = ReferenceTensorCache(self.encode_image, max_bytes=reference_cache_bytes, on_evict=self.forget_image)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def batch_inference(self, requests: list, do_sample=True, temperature=0.5, max_new_tokens=768, structured_stopping=True, streamer=None, cancel=None):
+        duration = self._duration(len(requests))
+        results = []
+        for request in requests:
+            answer = self._answer(request)
+            if streamer is not None:
+                # Spread the batch time over the chunks, like tokens arriving one after another
+                for i in range(self.chunks):
+                    if cancel is not None and cancel.is_set():
+                        break
+                    time.sleep(duration / self.chunks)
+                    piece = answer[i * len(answer) // self.chunks:(i + 1) * len(answer) // self.chunks]
+                    if piece:
+                        streamer.on_text(piece)
+                streamer.close()
+            result = {"thinking": "", "answer": answer, "generated_tokens": len(answer) // 3, "stopped_early": True}
+            result.update(parse_structured_answer(request.get("task", "general"), answer))
+            if cancel is not None:
+                result["cancelled"] = cancel.is_set()
+            results.append(result)
+        if streamer is None:
+            time.sleep(duration)
+        return results
+
+    def batch_classify(self, requests: list, labels=("same", "different")):
+        time.sleep(self._duration(len(requests)))
+        results = []
+        for _ in requests:
+            same = self._uniform() < self.same_rate
+            scores = {label: float(same if i == 0 else not same) for i, label in enumerate(labels)}
+            best = labels[0] if same else labels[1]
+            results.append({"thinking": "", "answer": best, "confidence": 1.0, "scores": scores})
+        return results
+
+    def encode_image(self, image, key=None, budget=None) -> CachedImage:
+        if isinstance(image, CachedImage):
+            return image
+        if budget is not None and key is not None:
+            key = (key, budget)
+        if isinstance(image, Image.Image):
+            size = image.size
+        else:
+            with Image.open(image) as f:
+                size = f.size
+        return CachedImage(key, torch.zeros(1, 1), torch.ones(1, 3, dtype=torch.long), size=size, input_size=size, budget=budget)
+
+    def pixel_budget(self, task: str, role="image"):
+        tokens = self.visual_token_budgets.get(task, {}).get(role)
+        return None if tokens is None else (tokens[0] * PIXELS_PER_TOKEN, tokens[1] * PIXELS_PER_TOKEN)
+
+    def output_scale(self, image):
+        return 1.0, 1.0
+
+    def forget_image(self, key):
+        pass
+
+    def _duration(self, batch_size: int) -> float:
+        base = (self.latency_ms + self.per_request_ms * batch_size) / 1000
+        return max(0.0, base * (1 + self.jitter * (2 * self._uniform() - 1)))
+
+    def _uniform(self) -> float:
+        with self._lock:
+            return self._random.random()
+
+    def _answer(self, request: dict) -> str:
+        task = request.get("task", "general")
+        images = request.get("image")
+        image = images[0] if isinstance(images, list) else images
+        width, height = getattr(image, "size", None) or (640, 480)
+        if task.startswith("verify"):
+            return "same" if self._uniform() < self.same_rate else "different"
+        if TASK_OUTPUT_TYPES.get(task) == "boxes":
+            return f"[[{width // 4}, {height // 4}, {3 * width // 4}, {3 * height // 4}]]"
+        if task in TASK_OUTPUT_TYPES:
+            return f"[({int(self._uniform() * width)}, {int(self._uniform() * height)})]"
+        return "A fake answer."
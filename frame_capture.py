@@ -0,0 +1,112 @@
+import threading
+import time
+from collections import deque
+
+import cv2
+
+
+class Frame:
+    """A captured camera frame: its sequence number, the time it was read and the BGR pixels."""
+
+    __slots__ = ("index", "timestamp", "image")
+
+    def __init__(self, index: int, timestamp: float, image):
+        self.index = index
+        self.timestamp = timestamp
+        self.image = image
+
+    def age_ms(self) -> float:
+        """Milliseconds since the frame was read from the stream."""
+        return (time.perf_counter() - self.timestamp) * 1000
+
+
+class FrameGrabber:
+    """
+    Reads a cv2.VideoCapture on its own thread so the stream never backs up behind the consumer.
+
+    Frames go into a ring buffer of `buffer_size` slots (a deque with maxlen, whose appends and
+    reads need no lock); older frames fall out as newer ones arrive and `latest()` always returns
+    the newest one. A frame that is overwritten before anyone took it counts as dropped.
+    """
+
+    def __init__(self, source, buffer_size=2):
+        self.source = source
+        self._capture = cv2.VideoCapture(source)
+        # Keep the backend's own queue short as well, it is what makes MJPEG streams lag
+        self._capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self._frames = deque(maxlen=max(1, int(buffer_size)))
+        self._new_frame = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.captured = 0
+        self.dropped = 0
+        self._last_taken = -1
+        self._read_ms = 0.0
+        self._latency_ms = 0.0
+
+    def is_opened(self) -> bool:
+        return self._capture.isOpened()
+
+    def is_running(self) -> bool:
+        """False once the stream has ended or the grabber was stopped."""
+        return not self._stopped.is_set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="frame-grabber", daemon=True)
+        self._thread.start()
+        return self
+
+    def latest(self, newer_than=-1, timeout=1.0):
+        """
+        The newest frame with an index above `newer_than`, waiting up to `timeout` seconds for one.
+        Returns None on timeout or once the stream has ended.
+        """
+        deadline = time.perf_counter() + timeout
+        while True:
+            frame = self._frames[-1] if self._frames else None
+            if frame is not None and frame.index > newer_than:
+                if frame.index > self._last_taken:
+                    # Every frame between the last one taken and this one was never seen
+                    self.dropped += max(0, frame.index - self._last_taken - 1)
+                    self._last_taken = frame.index
+                return frame
+            remaining = deadline - time.perf_counter()
+            if self._stopped.is_set() or remaining <= 0:
+                return None
+            self._new_frame.wait(remaining)
+            self._new_frame.clear()
+
+    def record_display(self, frame: Frame):
+        """Record that `frame` has been shown, for the capture-to-display latency."""
+        self._latency_ms = 0.9 * self._latency_ms + 0.1 * frame.age_ms() if self._latency_ms else frame.age_ms()
+
+    def stats(self) -> dict:
+        """Frame counters and moving averages of the read time and the capture-to-display latency."""
+        return {
+            "captured": self.captured,
+            "dropped": self.dropped,
+            "read_ms": round(self._read_ms, 2),
+            "latency_ms": round(self._latency_ms, 2)
+        }
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+        self._capture.release()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            start = time.perf_counter()
+            ok, image = self._capture.read()
+            if not ok:
+                print(f"Frame grabber: stream {self.source} ended.")
+                break
+            now = time.perf_counter()
+            self._read_ms = 0.9 * self._read_ms + 0.1 * (now - start) * 1000
+            self._frames.append(Frame(self.captured, now, image))
+            self.captured += 1
+            self._new_frame.set()
+        self._stopped.set()
+        self._new_frame.set()
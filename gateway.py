@@ -0,0 +1,407 @@
+import os
+import asyncio
+import hashlib
+import mimetypes
+import uvicorn
+import httpx
+import websockets
+from contextlib import asynccontextmanager, suppress
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, StreamingResponse
+
+from image_store import content_image_id
+
+# --- Global Settings ---
+# The New_API.py instances behind the gateway
+NODES = [url.strip().rstrip("/") for url in os.environ.get("ROBOBRAIN_GATEWAY_NODES", "http://127.0.0.1:8001").split(",") if url.strip()]
+GATEWAY_PORT = int(os.environ.get("ROBOBRAIN_GATEWAY_PORT", 8000))
+# Every node is probed this often; after MAX_HEALTH_FAILURES failed probes (or requests) in a row it gets no traffic
+HEALTH_INTERVAL_S = float(os.environ.get("ROBOBRAIN_GATEWAY_HEALTH_INTERVAL", 2))
+MAX_HEALTH_FAILURES = int(os.environ.get("ROBOBRAIN_GATEWAY_MAX_FAILURES", 3))
+# Pooled keep-alive connections to the nodes, shared by all requests
+MAX_CONNECTIONS = int(os.environ.get("ROBOBRAIN_GATEWAY_MAX_CONNECTIONS", 200))
+REQUEST_TIMEOUT_S = float(os.environ.get("ROBOBRAIN_GATEWAY_TIMEOUT", 120))
+
+# Hop-by-hop and length headers are set again by whoever sends the message on
+SKIPPED_HEADERS = {"host", "content-length", "transfer-encoding", "connection", "keep-alive", "content-encoding"}
+
+
+class Node:
+    """One New_API.py instance: its health, whether it is being drained and its request counters."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.healthy = True
+        self.draining = False
+        self.failures = 0
+        self.in_flight = 0
+        self.served = 0
+        self.migrated = 0
+
+    @property
+    def available(self) -> bool:
+        """Whether the node takes new images."""
+        return self.healthy and not self.draining
+
+    def weight(self, key: str) -> int:
+        """Rendezvous hash of a key on this node; the highest weight wins."""
+        return int.from_bytes(hashlib.blake2b(f"{self.url}|{key}".encode(), digest_size=8).digest(), "big")
+
+    def record(self, ok: bool):
+        """Count a successful or failed probe / request; too many failures in a row take the node out."""
+        if ok:
+            if not self.healthy:
+                print(f"Node {self.url} is healthy again.")
+            self.healthy, self.failures = True, 0
+            return
+        self.failures += 1
+        if self.healthy and self.failures >= MAX_HEALTH_FAILURES:
+            self.healthy = False
+            print(f"Node {self.url} failed {self.failures} times in a row. Its image_ids now hash to the other nodes.")
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "draining": self.draining,
+            "in_flight": self.in_flight,
+            "served": self.served,
+            "migrated": self.migrated,
+        }
+
+
+class NodeSet:
+    """
+    The nodes behind the gateway, with image_id affinity by rendezvous hashing.
+
+    An image_id belongs to the available node with the highest weight for it, so /verify and every
+    later /prompt for that image land on the node that holds it and its caches. When a node leaves
+    (unhealthy or removed), only the image_ids it owned move, each to its next-highest node; nodes
+    being drained take no new images but keep answering for the ones they still hold.
+    """
+
+    def __init__(self, urls):
+        self.nodes = {url: Node(url) for url in urls}
+
+    def __iter__(self):
+        return iter(list(self.nodes.values()))
+
+    def add(self, url: str) -> Node:
+        return self.nodes.setdefault(url.rstrip("/"), Node(url.rstrip("/")))
+
+    def remove(self, url: str):
+        return self.nodes.pop(url.rstrip("/"), None)
+
+    def get(self, url: str) -> Node:
+        node = self.nodes.get(url.rstrip("/"))
+        if node is None:
+            raise HTTPException(status_code=404, detail=f"Unknown node {url}.")
+        return node
+
+    def owner(self, key: str, exclude=None):
+        """The available node an image_id belongs to, or None if no node is available."""
+        candidates = [node for node in self if node.available and node is not exclude]
+        return max(candidates, key=lambda node: node.weight(key)) if candidates else None
+
+    def candidates(self, key: str) -> list:
+        """Healthy nodes to try for an image_id: its owner first, then the others by weight (e.g. a draining node)."""
+        ranked = sorted((node for node in self if node.healthy), key=lambda node: node.weight(key), reverse=True)
+        owner = self.owner(key)
+        return ([owner] if owner is not None else []) + [node for node in ranked if node is not owner]
+
+    def least_loaded(self):
+        """The available node with the fewest requests in flight, for requests not tied to an image."""
+        candidates = [node for node in self if node.available]
+        if not candidates:
+            raise HTTPException(status_code=503, detail="No RoboBrain node is available.", headers={"Retry-After": str(int(HEALTH_INTERVAL_S) + 1)})
+        return min(candidates, key=lambda node: node.in_flight)
+
+
+nodes = NodeSet(NODES)
+client = None
+
+
+async def check_health():
+    """Probe every node forever."""
+    async def probe(node: Node):
+        try:
+            response = await client.get(f"{node.url}/", timeout=5)
+            node.record(response.status_code == 200)
+        except httpx.HTTPError:
+            node.record(False)
+
+    while True:
+        await asyncio.gather(*(probe(node) for node in nodes))
+        await asyncio.sleep(HEALTH_INTERVAL_S)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client
+    client = httpx.AsyncClient(
+        timeout=REQUEST_TIMEOUT_S,
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+    )
+    health = asyncio.create_task(check_health())
+    try:
+        yield
+    finally:
+        health.cancel()
+        with suppress(asyncio.CancelledError):
+            await health
+        await client.aclose()
+
+
+app = FastAPI(
+    title="RoboBrain Gateway",
+    description="Spreads traffic over several RoboBrain API nodes. Requests for an image_id always go to the node that holds it.",
+    version="1.0.0",
+    lifespan=lifespan
+)
+
+
+# --- Helpers ---
+def forward_headers(request: Request) -> dict:
+    return {name: value for name, value in request.headers.items() if name.lower() not in SKIPPED_HEADERS}
+
+def to_response(response: httpx.Response) -> Response:
+    headers = {name: value for name, value in response.headers.items() if name.lower() not in SKIPPED_HEADERS}
+    return Response(content=response.content, status_code=response.status_code, headers=headers)
+
+def to_streaming_response(response: httpx.Response) -> StreamingResponse:
+    """Relay a response opened with stream=True chunk by chunk, e.g. Server-Sent Events."""
+    headers = {name: value for name, value in response.headers.items() if name.lower() not in SKIPPED_HEADERS}
+
+    async def relay():
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        finally:
+            await response.aclose()
+
+    return StreamingResponse(relay(), status_code=response.status_code, headers=headers)
+
+async def send(node: Node, request: Request, body: bytes, stream=False) -> httpx.Response:
+    """Send the incoming request on to `node`. Connection errors count against the node's health."""
+    outgoing = client.build_request(request.method, f"{node.url}{request.url.path}", params=request.query_params, headers=forward_headers(request), content=body)
+    node.in_flight += 1
+    try:
+        response = await client.send(outgoing, stream=stream)
+    except httpx.TransportError:
+        node.record(False)
+        raise
+    finally:
+        node.in_flight -= 1
+    node.served += 1
+    return response
+
+async def send_to_image_node(key: str, request: Request, body: bytes, stream=False, retry_not_found=True) -> httpx.Response:
+    """
+    Send a request for an image to the node it belongs to, or the next candidate if that one is unreachable.
+    With `retry_not_found`, a 404 ("not verified here") is also retried on the other healthy nodes, so
+    images still on a draining node or not yet moved are found. Uploads must not retry on 404: for them
+    it is a rejected verification, and running it again elsewhere would cost a model call per node and
+    could store the image away from its owner.
+    """
+    response = None
+    for node in nodes.candidates(key):
+        if response is not None:
+            await response.aclose()
+        try:
+            response = await send(node, request, body, stream=stream)
+        except httpx.TransportError as e:
+            print(f"Node {node.url} is unreachable ({e}). Trying the next one.")
+            response = None
+            continue
+        if response.status_code != 404 or not retry_not_found:
+            return response
+    if response is None:
+        raise HTTPException(status_code=503, detail="No RoboBrain node is available.", headers={"Retry-After": str(int(HEALTH_INTERVAL_S) + 1)})
+    return response
+
+async def upload_key(request: Request) -> str:
+    """The image_id the node will give the uploaded image, derived from its bytes like New_API.py does."""
+    form = await request.form()
+    image = form.get("image")
+    if image is None or not hasattr(image, "read"):
+        raise HTTPException(status_code=422, detail="An image upload is required.")
+    return content_image_id(await image.read())
+
+async def image_id_key(request: Request) -> str:
+    form = await request.form()
+    image_id = form.get("image_id")
+    if not image_id:
+        raise HTTPException(status_code=422, detail="An image_id is required.")
+    return image_id
+
+async def migrate(node: Node):
+    """Copy every image of a draining node to the node it belongs to now, so /prompt keeps finding it."""
+    try:
+        response = await client.get(f"{node.url}/images")
+        response.raise_for_status()
+        image_ids = response.json()["image_ids"]
+    except (httpx.HTTPError, KeyError, ValueError) as e:
+        print(f"Could not list the images of {node.url}: {e}")
+        return
+
+    for image_id in image_ids:
+        target = nodes.owner(image_id, exclude=node)
+        if target is None:
+            print(f"No node left to take the images of {node.url}.")
+            return
+        try:
+            image = await client.get(f"{node.url}/images/{image_id}")
+            if image.status_code != 200:
+                continue
+            media_type = image.headers.get("content-type", "application/octet-stream")
+            extension = mimetypes.guess_extension(media_type) or ".png"
+            stored = await client.post(f"{target.url}/images", files={"image": (f"{image_id}{extension}", image.content, media_type)})
+            stored.raise_for_status()
+            node.migrated += 1
+        except httpx.HTTPError as e:
+            print(f"Could not move image {image_id} from {node.url} to {target.url}: {e}")
+    print(f"Moved {node.migrated} images off {node.url}.")
+
+
+# --- API Endpoints ---
+@app.get("/gateway/nodes")
+def list_nodes():
+    return {"nodes": [node.stats() for node in nodes]}
+
+@app.post("/gateway/nodes")
+def add_node(url: str):
+    """Add a node. The image_ids that now hash to it are found on their old node until they expire there."""
+    node = nodes.add(url)
+    node.draining = False
+    return node.stats()
+
+@app.post("/gateway/nodes/drain")
+async def drain_node(url: str):
+    """Stop sending new images to a node and move the ones it holds to the other nodes."""
+    node = nodes.get(url)
+    node.draining = True
+    await migrate(node)
+    return node.stats()
+
+@app.delete("/gateway/nodes")
+async def remove_node(url: str):
+    """Drain a node (if it is still up) and take it out of the gateway."""
+    node = nodes.get(url)
+    if node.healthy:
+        node.draining = True
+        await migrate(node)
+    nodes.remove(url)
+    return node.stats()
+
+@app.get("/stats")
+async def stats():
+    """The gateway's view of the nodes plus every healthy node's own /stats."""
+    async def node_stats(node: Node):
+        try:
+            return (await client.get(f"{node.url}/stats", timeout=5)).json()
+        except (httpx.HTTPError, ValueError):
+            return None
+
+    healthy = [node for node in nodes if node.healthy]
+    results = await asyncio.gather(*(node_stats(node) for node in healthy))
+    return {"gateway": [node.stats() for node in nodes], "nodes": {node.url: result for node, result in zip(healthy, results)}}
+
+@app.post("/verify")
+@app.post("/verify_and_point")
+async def verify(request: Request):
+    """
+    Goes to the node the upload's image_id belongs to, so the later /prompt calls find it there.
+    A /verify_and_point with `stream` is relayed as it arrives, like /prompt_stream.
+    """
+    body = await request.body()
+    # Parsed like FastAPI parses the node's bool form field
+    stream = str((await request.form()).get("stream", "")).lower() in ("1", "true", "on", "yes")
+    response = await send_to_image_node(await upload_key(request), request, body, stream=stream, retry_not_found=False)
+    return to_streaming_response(response) if stream else to_response(response)
+
+@app.post("/prompt")
+async def prompt(request: Request):
+    body = await request.body()
+    return to_response(await send_to_image_node(await image_id_key(request), request, body))
+
+@app.post("/prompt_stream")
+async def prompt_stream(request: Request):
+    body = await request.body()
+    response = await send_to_image_node(await image_id_key(request), request, body, stream=True)
+    return to_streaming_response(response)
+
+@app.get("/images/{image_id}")
+async def download_image(image_id: str, request: Request):
+    return to_response(await send_to_image_node(image_id, request, b""))
+
+@app.post("/references")
+async def add_reference(request: Request):
+    """Every node needs the new reference, so it is sent to all of them."""
+    body = await request.body()
+    targets = [node for node in nodes if node.healthy]
+    if not targets:
+        raise HTTPException(status_code=503, detail="No RoboBrain node is available.")
+    responses = await asyncio.gather(*(send(node, request, body) for node in targets), return_exceptions=True)
+    for node, response in zip(targets, responses):
+        if isinstance(response, Exception) or response.status_code >= 400:
+            print(f"Adding the reference failed on {node.url}: {response if isinstance(response, Exception) else response.status_code}")
+            if not isinstance(response, Exception):
+                return to_response(response)
+    ok = [response for response in responses if not isinstance(response, Exception)]
+    if not ok:
+        raise HTTPException(status_code=502, detail="Adding the reference failed on every node.")
+    return to_response(ok[0])
+
+@app.api_route("/{path:path}", methods=["GET", "POST"])
+async def other(path: str, request: Request):
+    """Anything not tied to an image (/, /references, ...) goes to the least busy node."""
+    body = await request.body()
+    try:
+        return to_response(await send(nodes.least_loaded(), request, body))
+    except httpx.TransportError as e:
+        raise HTTPException(status_code=502, detail=f"RoboBrain node unreachable: {e}")
+
+@app.websocket("/ws")
+async def ar_session(websocket: WebSocket):
+    """
+    A /ws session lives on one node for its whole lifetime (it keeps its frames and state there);
+    it is placed on the least busy node and relayed message by message.
+    """
+    node = nodes.least_loaded()
+    await websocket.accept()
+    url = node.url.replace("http://", "ws://", 1).replace("https://", "wss://", 1) + "/ws"
+    node.in_flight += 1
+    try:
+        async with websockets.connect(url, max_size=None) as upstream:
+            async def client_to_node():
+                while True:
+                    message = await websocket.receive()
+                    if message["type"] == "websocket.disconnect":
+                        return
+                    await upstream.send(message["bytes"] if message.get("bytes") is not None else message["text"])
+
+            async def node_to_client():
+                async for message in upstream:
+                    if isinstance(message, bytes):
+                        await websocket.send_bytes(message)
+                    else:
+                        await websocket.send_text(message)
+
+            tasks = [asyncio.create_task(client_to_node()), asyncio.create_task(node_to_client())]
+            # Whichever side closes first ends the session
+            _, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+                with suppress(asyncio.CancelledError, WebSocketDisconnect, websockets.ConnectionClosed):
+                    await task
+    except (OSError, websockets.WebSocketException) as e:
+        print(f"WebSocket relay to {node.url} ended: {e}")
+    finally:
+        node.in_flight -= 1
+        with suppress(RuntimeError):
+            await websocket.close()
+
+
+if __name__ == "__main__":
+    print(f"Gateway for {len(NODES)} nodes: {', '.join(NODES)}")
+    uvicorn.run(app, host="0.0.0.0", port=GATEWAY_PORT)
@@ -0,0 +1,262 @@
+import hashlib
+import io
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from metrics import metrics
+
+IMAGE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.webp']
+
+
+def content_image_id(data: bytes) -> str:
+    """A UUID-formatted image_id derived from the image bytes, so an identical upload gets the same id."""
+    return str(uuid.UUID(bytes=hashlib.sha1(data).digest()[:16], version=5))
+
+
+def decode_image(data: bytes) -> Image.Image:
+    """Decode uploaded bytes into an RGB PIL image. Raises ValueError if the bytes are not an image."""
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception as e:
+        raise ValueError(f"Could not decode image: {e}") from e
+    return image.convert("RGB")
+
+
+class StoredImage:
+    """A verified image held in memory: the decoded pixels plus the original encoded bytes."""
+
+    def __init__(self, image_id: str, image: Image.Image, data: bytes, extension: str, encodings=None, phash=None):
+        self.image_id = image_id
+        self.image = image
+        self.data = data
+        self.extension = extension
+        # Preprocessed model inputs (CachedImages) by pixel budget, filled in by the API
+        self.encodings = encodings or {}
+        # Perceptual hash used to find cached results of near-duplicate images, filled in by the API
+        self.phash = phash
+
+
+class ImageDirectory:
+    """
+    Verified images on disk, with an in-memory image_id -> path index so a lookup never probes the disk.
+
+    Files are sharded into subdirectories by the first two characters of their id, written under a
+    unique temporary name and renamed into place. The directory is capped at `max_files` files and
+    `max_bytes` bytes; beyond that, and for files unused for `ttl` seconds, the least recently used
+    are deleted. Eviction runs after every write, on `stats()` and every `sweep_interval` seconds, so
+    expired files also go on a node that no longer receives new images; an expired file is never
+    returned by `path`. The index is rebuilt by scanning the shards at startup (using the file mtimes
+    as last use). Images stored flat in `root` by earlier versions (e.g. the sample images in the
+    repository) can still be looked up, but are never counted against the caps or deleted.
+    """
+
+    def __init__(self, root, max_files=10000, max_bytes=2 * 1024 ** 3, ttl=7 * 24 * 3600, sweep_interval=600):
+        self.root = root
+        self.max_files = max(1, int(max_files))
+        self.max_bytes = max(1, int(max_bytes))
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        # image_id -> [path, size, last_used], least recently used first
+        self._index = OrderedDict()
+        # image_id -> path of the flat files of earlier versions, read-only
+        self._legacy = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._scan()
+        if sweep_interval:
+            threading.Thread(target=self._sweep, name="image-directory-sweep", daemon=True).start()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, image_id):
+        return image_id in self._index
+
+    def path(self, image_id: str):
+        """Path of a stored image (marking it as used), or None."""
+        with self._lock:
+            entry = self._index.get(image_id)
+            if entry is None:
+                return self._legacy.get(image_id)
+            expired = time.time() - entry[2] > self.ttl
+            if not expired:
+                entry[2] = time.time()
+                self._index.move_to_end(image_id)
+                return entry[0]
+        # The index is ordered by last use, so evict() reaches this file (and everything older)
+        self.evict()
+        return None
+
+    def write(self, image_id: str, data: bytes, extension: str):
+        """Store an image unless it is already there, then evict what no longer fits."""
+        if self.path(image_id) is not None:
+            return
+        shard = os.path.join(self.root, image_id[:2])
+        os.makedirs(shard, exist_ok=True)
+        path = os.path.join(shard, f"{image_id}{extension}")
+        # Write to a unique temporary name first so readers never see a half-written file
+        temp_path = os.path.join(shard, f".{uuid.uuid4().hex}.tmp")
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"Failed to persist image {image_id}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+
+        with self._lock:
+            self._index[image_id] = [path, len(data), time.time()]
+            self._bytes += len(data)
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used files until the caps are met, and every file past its TTL."""
+        now = time.time()
+        removed = []
+        with self._lock:
+            while self._index:
+                image_id, (path, size, last_used) = next(iter(self._index.items()))
+                if len(self._index) <= self.max_files and self._bytes <= self.max_bytes and now - last_used <= self.ttl:
+                    break
+                del self._index[image_id]
+                self._bytes -= size
+                removed.append(path)
+        for path in removed:
+            try:
+                os.remove(path)
+            except OSError as e:
+                print(f"Failed to delete evicted image {path}: {e}")
+
+    def image_ids(self) -> list:
+        with self._lock:
+            return list(self._index) + [image_id for image_id in self._legacy if image_id not in self._index]
+
+    def stats(self) -> dict:
+        self.evict()
+        return {"files": len(self._index), "bytes": self._bytes, "max_files": self.max_files, "max_bytes": self.max_bytes}
+
+    def _sweep(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            self.evict()
+
+    def _scan(self):
+        found = []
+        for entry in os.scandir(self.root):
+            image_id, ext = os.path.splitext(entry.name)
+            if entry.is_file() and ext.lower() in IMAGE_EXTENSIONS:
+                self._legacy[image_id] = entry.path
+            # Only the <id[:2]>/<id>.<ext> shards belong to this directory
+            if not entry.is_dir() or len(entry.name) != 2:
+                continue
+            for name in os.listdir(entry.path):
+                image_id, ext = os.path.splitext(name)
+                path = os.path.join(entry.path, name)
+                if name.startswith(".") and ext == ".tmp":
+                    # Left over by a write that was interrupted
+                    os.remove(path)
+                elif ext.lower() in IMAGE_EXTENSIONS and image_id.startswith(entry.name) and os.path.isfile(path):
+                    stat = os.stat(path)
+                    found.append((stat.st_mtime, image_id, path, stat.st_size))
+        for mtime, image_id, path, size in sorted(found):
+            self._index[image_id] = [path, size, mtime]
+            self._bytes += size
+        self.evict()
+
+
+class ImageStore:
+    """
+    In-memory store of verified images keyed by image_id, so /prompt never has to touch the disk.
+
+    Keeps the `max_images` most recently used images and calls `on_evict(image_id)` for the ones
+    it drops, so caches tied to an image can follow its lifetime. If `persist_dir` is set, every
+    new image is also written to an ImageDirectory there by a background thread (`disk_options`
+    are its caps); images that were evicted (or verified by an earlier server run) are then reloaded
+    from that directory on demand.
+    """
+
+    def __init__(self, max_images=256, persist_dir=None, on_evict=None, **disk_options):
+        self.max_images = max(1, int(max_images))
+        self.persist_dir = persist_dir
+        self.on_evict = on_evict
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+        self.directory = ImageDirectory(persist_dir, **disk_options) if persist_dir else None
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="image-store-writer") if persist_dir else None
+
+    def __len__(self):
+        return len(self._images)
+
+    def __contains__(self, image_id):
+        return image_id in self._images
+
+    def put(self, stored: StoredImage, persist=True):
+        """Add an image to the store and, if enabled, schedule it to be written to disk."""
+        evicted = []
+        with self._lock:
+            self._images[stored.image_id] = stored
+            self._images.move_to_end(stored.image_id)
+            while len(self._images) > self.max_images:
+                evicted.append(self._images.popitem(last=False)[0])
+
+        if self.on_evict is not None:
+            for image_id in evicted:
+                self.on_evict(image_id)
+
+        if persist and self._writer is not None:
+            self._writer.submit(self._persist, stored)
+
+    def get(self, image_id: str):
+        """Return the StoredImage for `image_id` from memory, or None."""
+        with self._lock:
+            stored = self._images.get(image_id)
+            if stored is not None:
+                self._images.move_to_end(image_id)
+            return stored
+
+    def image_ids(self) -> list:
+        """Ids of every image held in memory or on disk."""
+        with self._lock:
+            ids = list(self._images)
+        if self.directory is not None:
+            ids.extend(image_id for image_id in self.directory.image_ids() if image_id not in self._images)
+        return ids
+
+    def load_from_disk(self, image_id: str):
+        """Reload a persisted image into memory. Blocking, so call it from a worker thread."""
+        if self.directory is None:
+            return None
+
+        path = self.directory.path(image_id)
+        if path is None:
+            return None
+        try:
+            with metrics.span("disk_read"), open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        with metrics.span("decode"):
+            decoded = decode_image(data)
+        stored = StoredImage(image_id, decoded, data, os.path.splitext(path)[1])
+        self.put(stored, persist=False)
+        return stored
+
+    def close(self):
+        """Wait for pending disk writes to finish."""
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+
+    def _persist(self, stored: StoredImage):
+        # Runs in the background after the request has been answered, so it is only observed on its own
+        start = time.perf_counter()
+        self.directory.write(stored.image_id, stored.data, stored.extension)
+        metrics.record("disk_write", time.perf_counter() - start)
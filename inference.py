@@ -1,37 +1,420 @@
-import os, re, cv2, torch
+import os, re, cv2, torch, inspect, uuid
+from contextlib import contextmanager
 from typing import Union
-from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig
-from qwen_vl_utils import process_vision_info
+from PIL import Image
+from transformers import Qwen2_5_VLForConditionalGeneration, AutoProcessor, BitsAndBytesConfig, BatchFeature, StoppingCriteria, StoppingCriteriaList
+from qwen_vl_utils import fetch_image
+from reference_cache import CachedImage, ReferenceTensorCache
+from vision_cache import VisionEmbeddingCache
+from metrics import metrics
+from structured_output import TASK_OUTPUT_TYPES, TASK_TOKEN_BUDGETS, answer_text, closed_list_end, parse_structured_answer, rescale_result
+
+# Visual-token budgets (min, max) per task and image role: "image" is the user's image, "reference" the RAG
+# reference image. Prefill cost grows with the number of visual tokens, and one token covers a 28x28 pixel
+# patch, so closed questions get a small budget and pointing, which needs detail, a larger one.
+# Tasks and roles not listed here use the processor's defaults.
+VISUAL_TOKEN_BUDGETS = {
+    "verify": {"image": (4, 256)},
+    "verify_based_on_reference": {"image": (4, 256), "reference": (4, 256)},
+    "pointing": {"image": (256, 1024)},
+    "pointing_based_on_reference": {"image": (256, 1024), "reference": (4, 256)},
+    "pointing_within_box": {"image": (256, 1024)},
+    "grounding": {"image": (256, 1024)},
+    "affordance": {"image": (256, 1024)},
+    "trajectory": {"image": (256, 1024)},
+}
+
+
+class StructuredOutputStoppingCriteria(StoppingCriteria):
+    """
+    Per-row stopping for batched generation: a row is finished once its answer list
+    (points, boxes or trajectory) has closed, or once it used up its own token budget.
+    """
+
+    def __init__(self, tokenizer, prompt_length: int, tasks: list, thinking: list, budgets: list):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.structured = [task in TASK_OUTPUT_TYPES for task in tasks]
+        self.thinking = thinking
+        self.budgets = budgets
+        self.finished = [False] * len(tasks)
+        self.closed = [False] * len(tasks)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        num_generated = input_ids.shape[1] - self.prompt_length
+        for row in range(input_ids.shape[0]):
+            if self.finished[row]:
+                continue
+            if num_generated >= self.budgets[row]:
+                self.finished[row] = True
+            elif self.structured[row] and "]" in self.tokenizer.decode(input_ids[row, -1:]):
+                # Only decode the whole answer when the newest token can have closed the list
+                text = answer_text(self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True), self.thinking[row])
+                if text is not None and closed_list_end(text) >= 0:
+                    self.finished[row] = self.closed[row] = True
+        return torch.tensor(self.finished, dtype=torch.bool, device=input_ids.device)
+
+class CancelledStoppingCriteria(StoppingCriteria):
+    """Stops every row once `cancel` (a threading.Event) is set, e.g. when a streaming client disconnects."""
+
+    def __init__(self, cancel):
+        self.cancel = cancel
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.cancel.is_set(), dtype=torch.bool, device=input_ids.device)
 
 class SimpleInference:
     """
     A class for performing inference using Hugging Face models.
     """
     
-    def __init__(self, model_id="BAAI/RoboBrain2.0-3B"):
+    def __init__(self, model_id="BAAI/RoboBrain2.0-3B", reference_cache_bytes=256 * 1024 * 1024, vision_cache_bytes=512 * 1024 * 1024, visual_token_budgets=None, device=None, load_model=True):
         """
         Initialize the model and processor with 4-bit quantization.
+        `visual_token_budgets` overrides VISUAL_TOKEN_BUDGETS (same layout); an empty dict keeps the processor's defaults everywhere.
+        `device` ("cuda", "cuda:1", "cpu", ...) pins the model to one device; by default it is spread over the
+        GPUs, or runs on the CPU if there is none. With `load_model=False` only the processor is loaded, which
+        is enough to preprocess images (e.g. in front of a ReplicaPool) but not to run the model.
         """
-        print("Loading Checkpoint...")
+        self.model = None
+        if load_model:
+            print("Loading Checkpoint...")
 
-        # Uncomment this section if you want to quantize
-        #quantization_config = BitsAndBytesConfig(
-        #    load_in_4bit=True,
-        #    bnb_4bit_compute_dtype=torch.float16
-        #)
+            # Uncomment this section if you want to quantize
+            #quantization_config = BitsAndBytesConfig(
+            #    load_in_4bit=True,
+            #    bnb_4bit_compute_dtype=torch.float16
+            #)
 
-        self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-            model_id,
-            #quantization_config=quantization_config, # Uncomment if using quantization
-            device_map="auto",
-            torch_dtype="auto" # Remove if using quantization
-        )
+            on_cpu = device == "cpu" or (device is None and not torch.cuda.is_available())
+            self.model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+                model_id,
+                #quantization_config=quantization_config, # Uncomment if using quantization
+                device_map="auto" if device is None and not on_cpu else {"": device or "cpu"},
+                # Half precision is slow or unsupported on most CPUs
+                torch_dtype=torch.float32 if on_cpu else "auto" # Remove if using quantization
+            )
         
         self.processor = AutoProcessor.from_pretrained(model_id)
+        # Batched generation appends tokens on the right, so prompts have to be padded on the left
+        self.processor.tokenizer.padding_side = "left"
+        self.visual_token_budgets = VISUAL_TOKEN_BUDGETS if visual_token_budgets is None else visual_token_budgets
+
+        # Vision-tower outputs per image key, so repeated prompts on one image only pay for their text tokens
+        self.vision_cache = VisionEmbeddingCache(max_bytes=vision_cache_bytes) if vision_cache_bytes and load_model else None
+        self._vision_keys = None
+        if self.vision_cache is not None:
+            self._install_vision_cache()
+
+        # Preprocessed RAG reference images, so the same files are not decoded and resized on every request
+        self.reference_cache = ReferenceTensorCache(self.encode_image, max_bytes=reference_cache_bytes, on_evict=self.forget_image)
         
-    def inference(self, text:str, image: Union[list,str], task="general", plot=False, enable_thinking=True, do_sample=True, temperature=0.5, **kwargs):
-        """Perform inference with text and images input."""
-        if isinstance(image, str):
+    def inference(self, text: Union[str, list], image: Union[list,str,Image.Image,CachedImage], task="general", plot=False, enable_thinking=True, do_sample=True, temperature=0.5, max_new_tokens=768, structured_stopping=True, **kwargs):
+        """
+        Perform inference with text and images input.
+        Images can be paths, URLs, PIL images or CachedImage tensors (e.g. from `reference_cache` or `encode_image`).
+
+        `text` can also be a list of prompts for the same images: they run as one padded batch, the
+        images are preprocessed and encoded only once, and a list of results is returned in order.
+
+        Paths and PIL images are resized to the task's visual-token budget (see `pixel_budget`);
+        coordinates in the result always refer to the original size of the first image.
+        """
+        if not isinstance(text, list):
+            request = {"text": text, "image": image, "task": task, "enable_thinking": enable_thinking, **kwargs}
+            return self.batch_inference([request], do_sample=do_sample, temperature=temperature, max_new_tokens=max_new_tokens, structured_stopping=structured_stopping)[0]
+
+        # Preprocess once, under a temporary key so the vision tower encodes each image once for the whole batch
+        images = image if isinstance(image, list) else [image]
+        temporary_keys = []
+        shared = []
+        for index, item in enumerate(images):
+            if not isinstance(item, CachedImage):
+                key = f"_shared_{uuid.uuid4().hex}"
+                item = self.encode_image(item, key=key, budget=self.pixel_budget(task, self._image_role(task, index)))
+                temporary_keys.append(key)
+            shared.append(item)
+        requests = [{"text": prompt, "image": shared, "task": task, "enable_thinking": enable_thinking, **kwargs} for prompt in text]
+        try:
+            return self.batch_inference(requests, do_sample=do_sample, temperature=temperature, max_new_tokens=max_new_tokens, structured_stopping=structured_stopping)
+        finally:
+            for key in temporary_keys:
+                self.forget_image(key)
+
+    def batch_inference(self, requests: list, do_sample=True, temperature=0.5, max_new_tokens=768, structured_stopping=True, streamer=None, cancel=None):
+        """
+        Perform inference for several requests with a single padded generate call.
+        Each request is a dict with the arguments of `inference` (text, image, task, enable_thinking, ...),
+        so one-image and two-image tasks can be mixed freely. Returns one result dict per request, in order.
+
+        With `structured_stopping`, pointing / grounding / affordance / trajectory answers stop as soon as
+        their list closes and are capped by TASK_TOKEN_BUDGETS; their parsed coordinates are added to the
+        result ("points", "boxes" or "trajectory") next to the raw answer.
+
+        A single request can be streamed by passing a transformers `streamer`; generation stops early
+        once the optional `cancel` event is set.
+        """
+        if streamer is not None and len(requests) != 1:
+            raise ValueError("Streaming is only supported for a single request.")
+
+        with metrics.trace() as trace:
+            with metrics.span("prepare"):
+                prepared = [self._prepare_request(**request) for request in requests]
+            images = [item for images, _, _, _ in prepared for item in images]
+            texts = [text for _, text, _, _ in prepared]
+            tasks = [task for _, _, _, task in prepared]
+            thinking = [enable_thinking for _, _, enable_thinking, _ in prepared]
+
+            with metrics.span("tokenize"):
+                inputs = self._build_inputs(texts, images)
+            with metrics.span("to_device"):
+                inputs = inputs.to(self.model.device)
+
+            generate_kwargs = {"max_new_tokens": max_new_tokens, "do_sample": do_sample, "temperature": temperature, "streamer": streamer}
+            stopping_criteria = StoppingCriteriaList()
+            stopping = None
+            if structured_stopping:
+                # Thinking runs are not capped by the answer budget, their reasoning comes first
+                budgets = [max_new_tokens if think else min(max_new_tokens, TASK_TOKEN_BUDGETS.get(task, max_new_tokens)) for task, think in zip(tasks, thinking)]
+                stopping = StructuredOutputStoppingCriteria(self.processor.tokenizer, inputs.input_ids.shape[1], tasks, thinking, budgets)
+                generate_kwargs["max_new_tokens"] = max(budgets)
+                stopping_criteria.append(stopping)
+            if cancel is not None:
+                stopping_criteria.append(CancelledStoppingCriteria(cancel))
+            if stopping_criteria:
+                generate_kwargs["stopping_criteria"] = stopping_criteria
+
+            with metrics.span("generate"), torch.inference_mode(), self._vision_cache_keys(images):
+                generated_ids = self.model.generate(**inputs, **generate_kwargs)
+
+            # Prompts are left padded to the same length, so the new tokens of every row start at the same index
+            generated_ids_trimmed = [out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)]
+            with metrics.span("decode"):
+                output_text = self.processor.batch_decode(generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+
+            pad_token_id = self.processor.tokenizer.pad_token_id
+            results = []
+            with metrics.span("parse"):
+                for row, (output, task, enable_thinking) in enumerate(zip(output_text, tasks, thinking)):
+                    result = self._parse_output(output, enable_thinking)
+                    result.update(parse_structured_answer(task, result["answer"]))
+                    # The model answers in the coordinates of the resized input, map them back to the original image
+                    scale = self.output_scale(prepared[row][0][0])
+                    if scale != (1.0, 1.0):
+                        result = rescale_result(result, *scale)
+                    # Rows that finished early are padded up to the longest row
+                    result["generated_tokens"] = int((generated_ids_trimmed[row] != pad_token_id).sum())
+                    result["stopped_early"] = bool(stopping and stopping.closed[row])
+                    if cancel is not None:
+                        result["cancelled"] = cancel.is_set()
+                    results.append(result)
+        if trace is not None:
+            self._add_stages(results, trace, prepared, inputs)
+        return results
+
+    def classify(self, text:str, image: Union[list,str,Image.Image,CachedImage], task="verify", labels=("same", "different"), **kwargs):
+        """
+        Score the possible answers instead of generating one. See `batch_classify`.
+        """
+        request = {"text": text, "image": image, "task": task, **kwargs}
+        return self.batch_classify([request], labels=labels)[0]
+
+    def batch_classify(self, requests: list, labels=("same", "different")):
+        """
+        Answer closed questions (e.g. verify / verify_based_on_reference) with a single forward pass.
+        The prompt ends right after the `<answer>` prefix, so the next-token distribution is compared
+        between the first tokens of each label. This is deterministic and needs no decoding loop.
+        Returns one dict per request with "answer" (the most likely label), "confidence" and the
+        normalized "scores" of every label.
+        """
+        with metrics.trace() as trace:
+            with metrics.span("prepare"):
+                prepared = [self._prepare_request(**{**request, "enable_thinking": False}) for request in requests]
+            images = [item for images, _, _, _ in prepared for item in images]
+            texts = [text for _, text, _, _ in prepared]
+
+            with metrics.span("tokenize"):
+                inputs = self._build_inputs(texts, images)
+            with metrics.span("to_device"):
+                inputs = inputs.to(self.model.device)
+            label_token_ids = self._label_token_ids(labels)
+
+            # The span ends with .tolist(), which waits for the GPU to finish the forward pass
+            with metrics.span("forward"):
+                with torch.inference_mode(), self._vision_cache_keys(images):
+                    logits = self.model(**inputs, **self._last_logits_only()).logits[:, -1, :]
+
+                # Prompts are left padded, so the last position of every row is its next-token prediction
+                probabilities = logits.float().softmax(dim=-1)
+                label_probabilities = torch.stack([probabilities[:, ids].sum(dim=-1) for ids in label_token_ids], dim=-1)
+                scores = (label_probabilities / label_probabilities.sum(dim=-1, keepdim=True).clamp_min(1e-12)).tolist()
+
+        results = []
+        for row in scores:
+            best = max(range(len(labels)), key=lambda i: row[i])
+            results.append({
+                "thinking": "",
+                "answer": labels[best],
+                "confidence": row[best],
+                "scores": dict(zip(labels, row)),
+            })
+        if trace is not None:
+            self._add_stages(results, trace, prepared, inputs)
+        return results
+
+    def encode_image(self, image, key=None, budget=None) -> CachedImage:
+        """
+        Run the vision preprocessing (load, smart resize, patchify) for one image and return the tensors.
+        `image` can be a path, URL or PIL image. The result can be reused in later `inference` calls.
+        `budget` is a (min_pixels, max_pixels) pair from `pixel_budget`; None keeps the processor's defaults.
+        Encodings at a budget are keyed `(key, budget)`, so the same image at two budgets is cached twice.
+        """
+        if isinstance(image, CachedImage):
+            return image
+        element = {"image": self._image_source(image)}
+        if budget is not None:
+            element["min_pixels"], element["max_pixels"] = budget
+            if key is not None:
+                key = (key, budget)
+        with metrics.span("fetch_image"):
+            resized = fetch_image(element)
+        with metrics.span("image_processor"):
+            image_inputs = self.processor.image_processor(images=[resized], return_tensors="pt")
+        return CachedImage(key, image_inputs["pixel_values"], image_inputs["image_grid_thw"], size=self._original_size(image), input_size=resized.size, budget=budget)
+
+    def pixel_budget(self, task: str, role="image"):
+        """The (min_pixels, max_pixels) an image in `role` ("image" or "reference") is resized to for `task`, or None."""
+        tokens = self.visual_token_budgets.get(task, {}).get(role)
+        if tokens is None:
+            return None
+        image_processor = self.processor.image_processor
+        pixels_per_token = (image_processor.patch_size * image_processor.merge_size) ** 2
+        return tokens[0] * pixels_per_token, tokens[1] * pixels_per_token
+
+    def output_scale(self, image):
+        """(x, y) factors from the model-input coordinates of `image` (a CachedImage) to its original size."""
+        if not isinstance(image, CachedImage) or image.size is None or image.input_size is None:
+            return 1.0, 1.0
+        return image.size[0] / image.input_size[0], image.size[1] / image.input_size[1]
+
+    def _label_token_ids(self, labels):
+        """First token ids of each label and its common spellings, leaving out ids shared between labels."""
+        tokenizer = self.processor.tokenizer
+        candidates = []
+        for label in labels:
+            variants = {label, label.capitalize(), f" {label}", f" {label.capitalize()}"}
+            candidates.append({tokenizer.encode(variant, add_special_tokens=False)[0] for variant in variants})
+        shared = set.union(*[a & b for i, a in enumerate(candidates) for b in candidates[i + 1:]]) if len(candidates) > 1 else set()
+        return [sorted(ids - shared) for ids in candidates]
+
+    def _last_logits_only(self):
+        """Ask the model for the last position's logits only, if this transformers version supports it."""
+        parameters = inspect.signature(self.model.forward).parameters
+        if "logits_to_keep" in parameters:
+            return {"logits_to_keep": 1}
+        if "num_logits_to_keep" in parameters:
+            return {"num_logits_to_keep": 1}
+        return {}
+
+    def forget_image(self, key):
+        """Drop everything cached for an image key, e.g. when the verified image is evicted."""
+        if self.vision_cache is not None:
+            self.vision_cache.invalidate(key)
+
+    def _install_vision_cache(self):
+        """Route the vision tower through the embedding cache, keyed by the images of the current call."""
+        visual = self.model.visual
+        original_forward = visual.forward
+        merge_length = visual.spatial_merge_size ** 2
+
+        def cached_forward(hidden_states, grid_thw=None, **kwargs):
+            keys = self._vision_keys
+            if self.vision_cache is not None and keys is not None and grid_thw is not None and len(keys) == len(grid_thw):
+                encode_fn = lambda pixel_values, thw: original_forward(pixel_values, grid_thw=thw, **kwargs)
+                embeddings = self.vision_cache.encode(keys, hidden_states, grid_thw, encode_fn, merge_length)
+                if embeddings is not None:
+                    return embeddings
+                # This transformers version does not return a plain tensor, so embeddings cannot be split per image
+                print("Vision encoder output cannot be cached per image. Disabling the vision cache.")
+                self.vision_cache = None
+            return original_forward(hidden_states, grid_thw=grid_thw, **kwargs)
+
+        visual.forward = cached_forward
+
+    @contextmanager
+    def _vision_cache_keys(self, images):
+        """Tell the vision cache which image keys the next forward pass encodes."""
+        self._vision_keys = [image.key for image in images]
+        try:
+            yield
+        finally:
+            self._vision_keys = None
+
+    def _to_cached_image(self, item, budget=None):
+        return item if isinstance(item, CachedImage) else self.encode_image(item, budget=budget)
+
+    def _image_role(self, task: str, index: int) -> str:
+        """The second image of a RAG task is the reference, every other image is the user's."""
+        return "reference" if index == 1 and task.endswith("_based_on_reference") else "image"
+
+    def _original_size(self, image):
+        """(width, height) of a PIL image or local file, read from the header only; None for URLs."""
+        if isinstance(image, Image.Image):
+            return image.size
+        if isinstance(image, str) and not image.startswith("http"):
+            with Image.open(image) as f:
+                return f.size
+        return None
+
+    def _add_stages(self, results: list, trace, prepared: list, inputs):
+        """
+        Attach the batch's stage timings to every result as "stages", with the row's own token counts:
+        input visual and text tokens, generated tokens and generated tokens per second of generation.
+        """
+        merge_length = self.processor.image_processor.merge_size ** 2
+        prompt_tokens = inputs["attention_mask"].sum(dim=-1).tolist()
+        generate_seconds = trace.stages.get("generate")
+        for row, result in enumerate(results):
+            visual_tokens = sum(int(image.image_grid_thw.prod()) // merge_length for image in prepared[row][0])
+            stages = trace.as_dict()
+            stages.update({"visual_tokens": visual_tokens, "text_tokens": int(prompt_tokens[row]) - visual_tokens})
+            if "generated_tokens" in result:
+                stages["generated_tokens"] = result["generated_tokens"]
+                if generate_seconds:
+                    stages["tokens_per_s"] = round(result["generated_tokens"] / generate_seconds, 2)
+            result["stages"] = stages
+
+    def _build_inputs(self, texts: list, images: list):
+        """
+        Tokenize the prompts and attach the image tensors, like `processor(text, images)` does,
+        but from images that may already have been preprocessed.
+        """
+        image_token = getattr(self.processor, "image_token", "<|image_pad|>")
+        merge_length = self.processor.image_processor.merge_size ** 2
+
+        # Every image placeholder stands for (t * h * w) / merge_size^2 visual tokens
+        index = 0
+        expanded_texts = []
+        for text in texts:
+            while image_token in text:
+                num_image_tokens = int(images[index].image_grid_thw.prod()) // merge_length
+                text = text.replace(image_token, "<|placeholder|>" * num_image_tokens, 1)
+                index += 1
+            expanded_texts.append(text.replace("<|placeholder|>", image_token))
+        assert index == len(images), f"Prompts contain {index} image placeholders but {len(images)} images were given."
+
+        data = dict(self.processor.tokenizer(expanded_texts, padding=True, return_tensors="pt"))
+        if images:
+            data["pixel_values"] = torch.cat([image.pixel_values for image in images])
+            data["image_grid_thw"] = torch.cat([image.image_grid_thw for image in images])
+        return BatchFeature(data=data)
+
+    def _prepare_request(self, text:str, image: Union[list,str,Image.Image,CachedImage], task="general", enable_thinking=True, **kwargs):
+        """
+        Build the templated prompt for a single request and return it with the request's images (preprocessed
+        at the task's pixel budget), thinking flag and task.
+        """
+        if not isinstance(image, list):
             image = [image]
 
         # Add the new, explicit RAG tasks
@@ -47,6 +430,7 @@ class SimpleInference:
             (task in two_image_tasks and len(image) == 2) or
             (task in ["general", "pointing", "verify"])
         ), f"Task '{task}' requires a specific number of images. Got {len(image)}."
+        image = [self._to_cached_image(item, self.pixel_budget(task, self._image_role(task, index))) for index, item in enumerate(image)]
 
         # Define prompts for the new tasks
         if task == "pointing":
@@ -70,6 +454,10 @@ class SimpleInference:
             bbox = kwargs.get("bbox")
             if not bbox:
                 raise ValueError("The 'pointing_within_box' task requires a 'bbox' keyword argument.")
+            # The box is given in original image coordinates, the model sees the resized image
+            scale_x, scale_y = self.output_scale(image[0])
+            if (scale_x, scale_y) != (1.0, 1.0) and not isinstance(bbox, str):
+                bbox = [round(value / (scale_x if i % 2 == 0 else scale_y)) for i, value in enumerate(bbox)]
             text = f"Within the bounding box {bbox}, find the feature described as: '{text}'. Your answer should be formatted as a list of tuples, i.e. [(x1, y1), (x2, y2), ...]."
 
         elif task == "affordance":
@@ -79,7 +467,7 @@ class SimpleInference:
         elif task == "grounding":
             text = f"Provide a bounding box for the area of the object identified as '{text}'. Your answer MUST be formatted as a list of bounding boxes in the format [[x1, y1, x2, y2], ...]."
         
-        messages = [{"role": "user", "content": [{"type": "image", "image": path if path.startswith("http") else f"file://{os.path.abspath(path)}"} for path in image] + [{"type": "text", "text": f"{text}"}],}]
+        messages = [{"role": "user", "content": [{"type": "image", "image": self._image_source(item)} for item in image] + [{"type": "text", "text": f"{text}"}],}]
         text = self.processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
 
         if enable_thinking:
@@ -87,22 +475,23 @@ class SimpleInference:
         else:
             text = f"{text}<think></think><answer>"
 
-        image_inputs, video_inputs = process_vision_info(messages)
-        inputs = self.processor(text=[text], images=image_inputs, videos=video_inputs, padding=True, return_tensors="pt").to("cuda")
+        return image, text, enable_thinking, task
 
-        with torch.inference_mode():
-            generated_ids = self.model.generate(**inputs, max_new_tokens=768, do_sample=do_sample, temperature=temperature)
-        
-        generated_ids_trimmed = [out_ids[len(in_ids) :] for in_ids, out_ids in zip(inputs.input_ids, generated_ids)]
-        output_text = self.processor.batch_decode(generated_ids_trimmed, skip_special_tokens=True, clean_up_tokenization_spaces=False)
+    def _image_source(self, item):
+        """Paths are turned into file:// URLs, in-memory and preprocessed images are passed through as they are."""
+        if isinstance(item, (Image.Image, CachedImage)):
+            return item
+        return item if item.startswith("http") else f"file://{os.path.abspath(item)}"
 
+    def _parse_output(self, output_text:str, enable_thinking=True):
+        """Split a decoded generation into its thinking and answer parts."""
         if enable_thinking:
-            parts = output_text[0].split("</think>")
+            parts = output_text.split("</think>")
             thinking_text = parts[0].replace("<think>", "").strip()
             answer_text = parts[1].replace("<answer>", "").replace("</answer>", "").strip() if len(parts) > 1 else ""
         else:
             thinking_text = ""
-            answer_text = output_text[0].replace("<answer>", "").replace("</answer>", "").strip()
+            answer_text = output_text.replace("<answer>", "").replace("</answer>", "").strip()
 
         if not answer_text and thinking_text:
             answer_text = thinking_text
@@ -0,0 +1,166 @@
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Upper bounds of the histogram buckets
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# The trace of the request (or model batch) the current code runs for, if any
+_current = contextvars.ContextVar("robobrain_trace", default=None)
+_NULL_SPAN = nullcontext()
+
+
+class Trace:
+    """Time spent per stage and token counts of one request or one model batch."""
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def count(self, name: str, value):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def as_dict(self) -> dict:
+        return {"stages_ms": {stage: round(seconds * 1000, 2) for stage, seconds in self.stages.items()}, **self.counts}
+
+    def header(self) -> str:
+        """The breakdown as an X-Timing header value: "stage=ms, ..., count=value"."""
+        parts = [f"{stage}={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        parts += [f"{name}={value:.1f}" if isinstance(value, float) else f"{name}={value}" for name, value in self.counts.items()]
+        return ", ".join(parts)
+
+
+class _Span:
+    __slots__ = ("trace", "stage", "start")
+
+    def __init__(self, trace: Trace, stage: str):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Histogram:
+    """A Prometheus histogram with one series per label set."""
+
+    def __init__(self, name: str, help_text: str, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in sorted(series.items()):
+            labels = ",".join(f'{name}="{_escape(value)}"' for name, value in key)
+            prefix = f"{labels}," if labels else ""
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {values[-1]}')
+            suffix = f"{{{labels}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {values[-2]:.6f}")
+            lines.append(f"{self.name}_count{suffix} {values[-1]}")
+        return lines
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Per-stage timing of the hot path, aggregated into Prometheus histograms.
+
+    Code marks its stages with `span(stage)`; the time is added to the trace of the request (or model
+    batch) it runs for, which `trace()` starts. Traces follow the request through contextvars, also
+    into run_in_threadpool. A finished request trace is observed into the histograms with
+    `observe_request`. When disabled, `trace()` starts nothing and `span()` returns a shared no-op
+    context manager, so instrumented code only pays for one context-variable lookup.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.requests = Histogram("robobrain_request_seconds", "Latency of API requests by endpoint and status.", SECONDS_BUCKETS)
+        self.stages = Histogram("robobrain_stage_seconds", "Time a request spent in each stage of the hot path.", SECONDS_BUCKETS)
+        self.tokens = Histogram("robobrain_tokens", "Input visual, input text and generated tokens per request.", TOKEN_BUCKETS)
+        self.token_rate = Histogram("robobrain_generation_tokens_per_second", "Generated tokens per second of generation time, per request.", RATE_BUCKETS)
+
+    def span(self, stage: str):
+        trace = _current.get()
+        if trace is None:
+            return _NULL_SPAN
+        return _Span(trace, stage)
+
+    def current(self):
+        """The trace of the running request or batch, or None."""
+        return _current.get()
+
+    @contextmanager
+    def trace(self):
+        """Start a trace for the code inside the block. Yields it, or None when disabled."""
+        if not self.enabled:
+            yield None
+            return
+        trace = Trace()
+        token = _current.set(trace)
+        try:
+            yield trace
+        finally:
+            _current.reset(token)
+
+    def record(self, stage: str, seconds: float):
+        """Observe a stage that runs outside any request, e.g. a background disk write."""
+        if self.enabled:
+            self.stages.observe(seconds, stage=stage)
+
+    def observe_request(self, endpoint: str, status, seconds: float, trace: Trace):
+        self.requests.observe(seconds, endpoint=endpoint, status=str(status))
+        for stage, stage_seconds in trace.stages.items():
+            self.stages.observe(stage_seconds, stage=stage)
+        for kind in ("visual_tokens", "text_tokens", "generated_tokens"):
+            if kind in trace.counts:
+                self.tokens.observe(trace.counts[kind], kind=kind[:-len("_tokens")])
+        if "tokens_per_s" in trace.counts:
+            self.token_rate.observe(trace.counts["tokens_per_s"])
+
+    def render(self, gauges=None) -> str:
+        """Every histogram (and the given {name: value} gauges) in the Prometheus text format."""
+        lines = []
+        for histogram in (self.requests, self.stages, self.tokens, self.token_rate):
+            lines.extend(histogram.render())
+        for name, value in (gauges or {}).items():
+            lines.extend([f"# TYPE {name} gauge", f"{name} {value}"])
+        return "\n".join(lines) + "\n"
+
+
+# Read from the environment so replica processes follow the server's setting
+metrics = Metrics(enabled=os.environ.get("ROBOBRAIN_METRICS", "1") == "1")
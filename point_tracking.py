@@ -0,0 +1,165 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+
+class PointTracker:
+    """
+    Follows a set of image points from frame to frame.
+
+    `add` may be called from another thread than `update` (points stream in from the detection
+    thread while the main loop keeps tracking), and with an older frame than the last one tracked:
+    the point is then carried forward to the current frame on the next `update`.
+    """
+
+    def add(self, frame, point):
+        """Start tracking `point` (x, y), given in `frame`."""
+        raise NotImplementedError
+
+    def update(self, frame) -> list:
+        """Track every point into `frame` and return the (x, y) of the ones still found."""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CSRTPointTracker(PointTracker):
+    """One cv2.TrackerCSRT per point around a fixed box, updated in parallel on a thread pool."""
+
+    def __init__(self, box_size=50, max_workers=10):
+        self.box_size = box_size
+        self._trackers = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="csrt")
+
+    def add(self, frame, point):
+        x, y = int(point[0]), int(point[1])
+        half = self.box_size // 2
+        tracker = cv2.TrackerCSRT_create()
+        tracker.init(frame, (x - half, y - half, self.box_size, self.box_size))
+        with self._lock:
+            self._trackers.append(tracker)
+
+    def update(self, frame):
+        with self._lock:
+            trackers = list(self._trackers)
+        futures = [self._executor.submit(tracker.update, frame) for tracker in trackers]
+        points, lost = [], []
+        for tracker, future in zip(trackers, futures):
+            success, bbox = future.result()
+            if success:
+                points.append((bbox[0] + bbox[2] / 2, bbox[1] + bbox[3] / 2))
+            else:
+                lost.append(tracker)
+
+        with self._lock:
+            # Trackers may have been added (or cleared) while these were updating
+            self._trackers = [tracker for tracker in self._trackers if tracker not in lost]
+        return points
+
+    def clear(self):
+        with self._lock:
+            self._trackers = []
+
+    def __len__(self):
+        return len(self._trackers)
+
+    def close(self):
+        self._executor.shutdown()
+
+
+class LKPointTracker(PointTracker):
+    """
+    Pyramidal Lucas-Kanade optical flow: all points move in one vectorized calcOpticalFlowPyrLK call.
+
+    A point is dropped when the flow loses it, or when tracking it back to the previous frame lands
+    more than `max_fb_error` pixels away from where it started (forward-backward check).
+    """
+
+    def __init__(self, win_size=21, max_level=3, max_fb_error=1.5):
+        self.max_fb_error = max_fb_error
+        self._flow_params = {
+            "winSize": (win_size, win_size),
+            "maxLevel": max_level,
+            "criteria": (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01)
+        }
+        self._points = np.empty((0, 1, 2), np.float32)
+        self._prev_gray = None
+        # Points added since the last update, grouped by the frame they were given in: [(frame, gray, points)]
+        self._pending = []
+        # Bumped by clear, so an update that overlaps it does not bring the old points back
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def add(self, frame, point):
+        new_point = np.array([[[float(point[0]), float(point[1])]]], np.float32)
+        with self._lock:
+            if self._pending and self._pending[-1][0] is frame:
+                source, gray, points = self._pending[-1]
+                self._pending[-1] = (source, gray, np.concatenate([points, new_point]))
+            else:
+                self._pending.append((frame, _gray(frame), new_point))
+
+    def update(self, frame):
+        gray = _gray(frame)
+        with self._lock:
+            prev_gray, points, pending, generation = self._prev_gray, self._points, self._pending, self._generation
+            self._pending = []
+
+        tracked = [self._track(prev_gray, gray, points)] if prev_gray is not None else []
+        # New points (often from an older frame the detection ran on) jump straight from their frame to this one
+        tracked += [self._track(source_gray, gray, source_points) for _, source_gray, source_points in pending]
+        points = np.concatenate(tracked) if tracked else np.empty((0, 1, 2), np.float32)
+
+        with self._lock:
+            if self._generation != generation:
+                return []
+            self._points = points
+            self._prev_gray = gray
+        return [tuple(point) for point in points.reshape(-1, 2)]
+
+    def clear(self):
+        with self._lock:
+            self._points = np.empty((0, 1, 2), np.float32)
+            self._pending = []
+            self._prev_gray = None
+            self._generation += 1
+
+    def __len__(self):
+        return len(self._points) + sum(len(points) for _, _, points in self._pending)
+
+    def _track(self, prev_gray, gray, points):
+        if len(points) == 0:
+            return points
+        forward, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, points, None, **self._flow_params)
+        backward, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, forward, None, **self._flow_params)
+        fb_error = np.linalg.norm((points - backward).reshape(-1, 2), axis=1)
+        keep = (status.ravel() == 1) & (back_status.ravel() == 1) & (fb_error <= self.max_fb_error)
+        return forward[keep]
+
+
+TRACKER_BACKENDS = {
+    "lk": LKPointTracker,
+    "csrt": CSRTPointTracker,
+}
+
+
+def create_tracker(backend="lk", **kwargs) -> PointTracker:
+    """A PointTracker by name: 'lk' (optical flow) or 'csrt'."""
+    try:
+        return TRACKER_BACKENDS[backend](**kwargs)
+    except KeyError:
+        raise ValueError(f"Unknown tracker backend '{backend}'. Use one of {', '.join(TRACKER_BACKENDS)}.") from None
+
+
+def _gray(frame):
+    return frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
@@ -0,0 +1,113 @@
+import os
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+class PreVerifier:
+    """
+    Keypoint pre-check of an upload against a RAG reference image, run before the model.
+
+    ORB keypoints of the upload are matched against the reference's (computed once per reference
+    file and kept in memory), filtered with Lowe's ratio test and fitted with a RANSAC homography.
+    - At least `accept_inliers` inliers: the reference object is clearly in the image -> "same".
+    - At most `reject_inliers` inliers although the upload has `min_keypoints` keypoints or more, the
+      reference at least a third of that and the ratio test kept `min_matches` matches, i.e. both sides
+      have enough texture to have found the object if it were there -> "different". Small, flat
+      references (e.g. a crop of a button) find few keypoints, so they never reject.
+    - Anything else is ambiguous and returns None, so the model decides.
+    """
+
+    def __init__(self, accept_inliers=25, reject_inliers=3, min_keypoints=300, min_matches=12, ratio=0.75, max_size=640, features=1000):
+        self.accept_inliers = accept_inliers
+        self.reject_inliers = reject_inliers
+        self.min_keypoints = min_keypoints
+        self.min_matches = min_matches
+        self.ratio = ratio
+        self.max_size = max_size
+        self.features = features
+        # OpenCV detectors and matchers are not shared between the request threads
+        self._local = threading.local()
+        # Reference path -> (mtime, keypoints, descriptors)
+        self._references = {}
+        self._lock = threading.Lock()
+        self._verdicts = {"same": 0, "different": 0, None: 0}
+
+    def check(self, image, reference_path: str):
+        """
+        Compare `image` (a PIL image) with the reference at `reference_path`.
+        Returns the verdict ("same", "different" or None) and the match statistics.
+        """
+        ref_keypoints, ref_descriptors = self.reference_features(reference_path)
+        keypoints, descriptors = self._features(image)
+        stats = {"keypoints": len(keypoints), "reference_keypoints": len(ref_keypoints), "matches": 0, "inliers": 0}
+
+        if descriptors is not None and ref_descriptors is not None and len(ref_keypoints) >= 2:
+            pairs = self._detectors()[1].knnMatch(ref_descriptors, descriptors, k=2)
+            good = [pair[0] for pair in pairs if len(pair) == 2 and pair[0].distance < self.ratio * pair[1].distance]
+            stats["matches"] = len(good)
+            if len(good) >= 4:
+                source = np.float32([ref_keypoints[m.queryIdx].pt for m in good]).reshape(-1, 1, 2)
+                target = np.float32([keypoints[m.trainIdx].pt for m in good]).reshape(-1, 1, 2)
+                _, mask = cv2.findHomography(source, target, cv2.RANSAC, 5.0)
+                stats["inliers"] = int(mask.sum()) if mask is not None else 0
+
+        verdict = None
+        if stats["inliers"] >= self.accept_inliers:
+            verdict = "same"
+        elif (stats["inliers"] <= self.reject_inliers and stats["keypoints"] >= self.min_keypoints
+              and stats["reference_keypoints"] >= self.min_keypoints // 3 and stats["matches"] >= self.min_matches):
+            verdict = "different"
+        with self._lock:
+            self._verdicts[verdict] += 1
+        return verdict, stats
+
+    def stats(self) -> dict:
+        """How many checks were settled as same / different, and how many were left to the model."""
+        with self._lock:
+            same, different, ambiguous = self._verdicts["same"], self._verdicts["different"], self._verdicts[None]
+        total = same + different + ambiguous
+        return {
+            "checks": total,
+            "same": same,
+            "different": different,
+            "ambiguous": ambiguous,
+            "skip_rate": round((same + different) / total, 3) if total else 0.0
+        }
+
+    def reference_features(self, path: str):
+        """Keypoints and descriptors of a reference image, recomputed only when the file changes."""
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            cached = self._references.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1], cached[2]
+
+        with Image.open(path) as image:
+            keypoints, descriptors = self._features(image)
+        with self._lock:
+            self._references[path] = (mtime, keypoints, descriptors)
+        return keypoints, descriptors
+
+    def warm(self, paths):
+        """Compute the features of every reference now instead of on first use."""
+        for path in paths:
+            try:
+                self.reference_features(path)
+            except Exception as e:
+                print(f"Could not compute keypoints of reference image {path}: {e}")
+
+    def _features(self, image):
+        gray = np.asarray(image.convert("L"))
+        scale = min(1.0, self.max_size / max(gray.shape))
+        if scale < 1.0:
+            gray = cv2.resize(gray, (round(gray.shape[1] * scale), round(gray.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+        return self._detectors()[0].detectAndCompute(gray, None)
+
+    def _detectors(self):
+        if not hasattr(self._local, "orb"):
+            self._local.orb = cv2.ORB_create(nfeatures=self.features)
+            self._local.matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+        return self._local.orb, self._local.matcher
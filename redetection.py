@@ -0,0 +1,115 @@
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Frames are compared at this size: enough to see the scene change, cheap enough for every frame
+MOTION_SIZE = (64, 48)
+
+
+class RedetectionScheduler:
+    """
+    Decides when the AR client should ask the server for a new detection, instead of waiting for 's'.
+
+    Every displayed frame is passed to `observe`, which measures two mean absolute differences of a
+    small grayscale copy: `motion` against the previous frame and `change` against the frame the last
+    detection ran on. `decide` then asks for a detection when
+    - tracking is lost: fewer than `lost_fraction` of the detected points are still tracked, or
+    - the scene changed: `change` is above `scene_change`,
+    but only once the camera has settled (`motion` below `max_motion`), never more often than every
+    `min_interval` seconds, and with the interval doubling (up to `max_interval`) after each detection
+    that found nothing. A static scene that is tracked fine, or where the last detection failed, never
+    triggers a request. A detection still running when the scene has changed is reported as stale so
+    it can be cancelled.
+
+    The render loop and the detection thread both call into the scheduler, so every method holds a
+    lock while it reads or updates the bookkeeping.
+    """
+
+    def __init__(self, min_interval=1.0, max_interval=8.0, lost_fraction=0.5, scene_change=18.0, max_motion=6.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.lost_fraction = lost_fraction
+        self.scene_change = scene_change
+        self.max_motion = max_motion
+
+        self.motion = 0.0
+        self.change = 0.0
+        self._previous = None
+        self._reference = None
+        self._detected_points = 0
+        self._interval = min_interval
+        self._next_allowed = 0.0
+
+        self.requests = 0
+        self.cancelled = 0
+        self._started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def observe(self, frame):
+        """Update the motion metrics with a new BGR (or grayscale) frame."""
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, MOTION_SIZE, interpolation=cv2.INTER_AREA).astype(np.int16)
+        with self._lock:
+            self.motion = float(np.abs(small - self._previous).mean()) if self._previous is not None else 0.0
+            self.change = float(np.abs(small - self._reference).mean()) if self._reference is not None else 0.0
+            self._previous = small
+
+    def decide(self, tracked_points: int, detecting: bool, now=None):
+        """
+        What to do for the current frame: (None, None), ("detect", reason) or ("cancel", reason).
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if detecting:
+                if self.change > self.scene_change and self.motion <= self.max_motion:
+                    return "cancel", "scene changed during detection"
+                return None, None
+
+            if now < self._next_allowed or self.motion > self.max_motion:
+                return None, None
+
+            if self._reference is None:
+                return "detect", "first detection"
+            if self._detected_points and tracked_points < self.lost_fraction * self._detected_points:
+                return "detect", "tracking lost" if tracked_points == 0 else "tracking confidence dropped"
+            if self.change > self.scene_change:
+                return "detect", "scene changed"
+            return None, None
+
+    def detection_started(self, now=None):
+        """Call when a request is sent; the current frame becomes the reference for `change`."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._reference = self._previous
+            self.change = 0.0
+            self._next_allowed = now + self._interval
+            self.requests += 1
+
+    def detection_finished(self, num_points: int, cancelled=False, now=None):
+        """Call when a request has ended, with the number of points it returned."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if cancelled:
+                self.cancelled += 1
+                self._next_allowed = now
+                return
+            self._detected_points = num_points
+            # Back off while detections find nothing, go back to the base rate once one succeeds
+            self._interval = self.min_interval if num_points else min(self.max_interval, self._interval * 2)
+            self._next_allowed = max(self._next_allowed, now + (0 if num_points else self._interval))
+
+    def reset(self):
+        """Forget the last detection, e.g. after the object or prompt changed."""
+        with self._lock:
+            self._reference = None
+            self._detected_points = 0
+            self._interval = self.min_interval
+            self._next_allowed = 0.0
+
+    def requests_per_minute(self) -> float:
+        minutes = (time.monotonic() - self._started_at) / 60
+        with self._lock:
+            requests = self.requests
+        return requests / minutes if minutes > 0 else 0.0
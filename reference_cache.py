@@ -0,0 +1,118 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class CachedImage:
+    """
+    The vision-processor output for a single image: its `pixel_values` rows and its (t, h, w) patch grid.
+    Can be passed to SimpleInference.inference in place of a path or PIL image.
+    `size` is the (width, height) of the original image and `input_size` the one the model sees after resizing
+    to `budget` (min_pixels, max_pixels), so coordinates in the model's answer can be mapped back.
+    """
+
+    def __init__(self, key, pixel_values, image_grid_thw, size=None, input_size=None, budget=None):
+        self.key = key
+        self.pixel_values = pixel_values
+        self.image_grid_thw = image_grid_thw
+        self.size = size
+        self.input_size = input_size
+        self.budget = budget
+        self.nbytes = pixel_values.element_size() * pixel_values.nelement() + image_grid_thw.element_size() * image_grid_thw.nelement()
+
+
+class ReferenceTensorCache:
+    """
+    LRU cache of preprocessed reference images, keyed by absolute path and modification time
+    so an edited reference file is encoded again, and by the pixel budget it was resized to.
+
+    `encode(path, key, budget)` turns a path into a CachedImage (SimpleInference.encode_image). Entries are evicted,
+    least recently used first, once their total size exceeds `max_bytes`; `on_evict(key)` is then
+    called so anything derived from that reference can be dropped as well.
+    """
+
+    def __init__(self, encode, max_bytes=256 * 1024 * 1024, on_evict=None):
+        self.encode = encode
+        self.max_bytes = int(max_bytes)
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, path: str, budget=None) -> CachedImage:
+        """Return the preprocessed tensors for `path` at `budget`, encoding and caching them on a miss."""
+        path = os.path.abspath(path)
+        file_key = (path, os.path.getmtime(path))
+        # Same scheme as SimpleInference.encode_image, so the entry key is also the vision cache key
+        key = file_key if budget is None else (file_key, budget)
+
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        # Encode outside the lock so one slow miss does not hold up hits on other references
+        cached = self.encode(path, key=file_key, budget=budget)
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = cached
+                self._bytes += cached.nbytes
+                evicted = self._evict()
+            else:
+                evicted = []
+            cached = self._entries[key]
+
+        if self.on_evict is not None:
+            for evicted_key in evicted:
+                self.on_evict(evicted_key)
+        return cached
+
+    def warm(self, paths, budgets=(None,)):
+        """Encode every path up front at every budget, e.g. all DATASET_IMAGES at startup."""
+        for path in paths:
+            try:
+                for budget in budgets:
+                    self.get(path, budget)
+            except Exception as e:
+                print(f"Could not preprocess reference image {path}: {e}")
+
+    def clear(self):
+        with self._lock:
+            keys = list(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+        if self.on_evict is not None:
+            for key in keys:
+                self.on_evict(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _evict(self):
+        """Drop least recently used entries until the cache fits; returns the evicted keys."""
+        evicted_keys = []
+        # The newest entry is always kept, even if it alone is over budget
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            key, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self.evictions += 1
+            evicted_keys.append(key)
+        return evicted_keys
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections.abc import Mapping
+from PIL import Image
+
+MANIFEST_NAME = "manifest.json"
+
+
+class ReferenceStore(Mapping):
+    """
+    RAG reference images by name, resized lazily and cached on disk by content hash.
+
+    `references` maps names to source image paths (DATASET_IMAGES). Looking a name up returns
+    the path of a copy resized to at most `max_size` pixels, created on first use and recorded in
+    `cache_dir`/manifest.json together with the source mtime, size and SHA-1. Later lookups, also
+    in later server runs, only stat the source; the artifact is rebuilt when the source changes.
+    Sources that are already small enough are used as they are.
+
+    References whose source file is missing are left out with a warning. `add` and `add_image`
+    register references at runtime; they are kept in the manifest so they survive a restart.
+    """
+
+    def __init__(self, references: dict, cache_dir="dataset/.cache", max_size=480, upload_dir="dataset/uploads"):
+        self.cache_dir = cache_dir
+        self.upload_dir = upload_dir
+        self.max_size = int(max_size)
+        self._lock = threading.Lock()
+        self._manifest_path = os.path.join(cache_dir, MANIFEST_NAME)
+        self._manifest = self._load_manifest()
+        self._sources = {}
+
+        for name, source in {**references, **self._manifest["references"]}.items():
+            self._register(name, source)
+
+    def __getitem__(self, name: str) -> str:
+        source = self._sources[name]
+        return self.resolve(source)
+
+    def __iter__(self):
+        return iter(list(self._sources))
+
+    def __len__(self):
+        return len(self._sources)
+
+    def source(self, name: str) -> str:
+        """The original image path of a reference."""
+        return self._sources[name]
+
+    def add(self, name: str, source: str) -> bool:
+        """Register (or replace) a reference at runtime. Returns False if the source file does not exist."""
+        if not self._register(name, source):
+            return False
+        with self._lock:
+            self._manifest["references"][name] = source
+            self._save_manifest()
+        return True
+
+    def add_image(self, name: str, data: bytes, extension: str) -> str:
+        """Save uploaded image bytes under `upload_dir` (named by content hash) and register them as `name`."""
+        os.makedirs(self.upload_dir, exist_ok=True)
+        path = os.path.join(self.upload_dir, f"{hashlib.sha1(data).hexdigest()[:16]}{extension}")
+        if not os.path.exists(path):
+            self._write_atomic(path, data)
+        self.add(name, path)
+        return path
+
+    def resolve(self, source: str) -> str:
+        """Path of the resized artifact for a source image, building it if the manifest has no valid entry."""
+        stat = os.stat(source)
+        with self._lock:
+            entry = self._manifest["artifacts"].get(os.path.abspath(source))
+            if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size and os.path.exists(entry["artifact"]):
+                return entry["artifact"]
+
+            with open(source, "rb") as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            if entry and entry["sha1"] == digest and os.path.exists(entry["artifact"]):
+                # Touched but not changed: no need to resize again
+                artifact = entry["artifact"]
+            else:
+                artifact = self._build_artifact(source, digest)
+
+            self._manifest["artifacts"][os.path.abspath(source)] = {
+                "mtime": stat.st_mtime,
+                "size": stat.st_size,
+                "sha1": digest,
+                "artifact": artifact,
+            }
+            self._save_manifest()
+            return artifact
+
+    def warm(self):
+        """Resolve every reference now instead of on first use. Returns the artifact paths."""
+        artifacts = []
+        for name in self:
+            try:
+                artifacts.append(self[name])
+            except Exception as e:
+                print(f"Could not prepare reference image '{name}': {e}")
+        return artifacts
+
+    def _register(self, name: str, source: str) -> bool:
+        if not source or not os.path.exists(source):
+            print(f"Reference image for '{name}' not found at {source}. Leaving it out.")
+            return False
+        self._sources[name] = source
+        return True
+
+    def _build_artifact(self, source: str, digest: str) -> str:
+        image = Image.open(source)
+        if max(image.size) <= self.max_size:
+            return source
+
+        print(f"Resizing reference image: {source} (Original size: {image.size})")
+        image.thumbnail((self.max_size, self.max_size))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        extension = os.path.splitext(source)[1].lower() or ".png"
+        artifact = os.path.join(self.cache_dir, f"{digest[:16]}_{self.max_size}{extension}")
+        temp_path = os.path.join(self.cache_dir, f".{uuid.uuid4().hex}{extension}")
+        image.save(temp_path)
+        os.replace(temp_path, artifact)
+        return artifact
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(self._manifest_path, "r") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            manifest = {}
+        except (OSError, ValueError) as e:
+            print(f"Could not read reference manifest {self._manifest_path} ({e}). Starting a new one.")
+            manifest = {}
+        manifest.setdefault("artifacts", {})
+        manifest.setdefault("references", {})
+        return manifest
+
+    def _save_manifest(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._write_atomic(self._manifest_path, json.dumps(self._manifest, indent=2).encode())
+
+    @staticmethod
+    def _write_atomic(path: str, data: bytes):
+        # Write to a unique temporary name first so readers never see a half-written file
+        temp_path = os.path.join(os.path.dirname(path) or ".", f".{uuid.uuid4().hex}.tmp")
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
@@ -0,0 +1,448 @@
+import itertools
+import os
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import torch
+import torch.multiprocessing as mp
+
+from reference_cache import CachedImage
+from streaming import TextChunkStreamer
+
+
+class ReplicaError(RuntimeError):
+    """A request failed inside a replica, or the replica died while serving it."""
+
+
+class ReplicaSpec:
+    """Where one replica runs: a torch device, optionally pinned to a set of CPU cores with its own thread count."""
+
+    def __init__(self, device="cpu", cpus=None, threads=None):
+        self.device = device
+        self.cpus = sorted(cpus) if cpus else None
+        self.threads = threads or (len(self.cpus) if self.cpus else None)
+
+    def __repr__(self):
+        cores = f", cpus={_format_cpus(self.cpus)}" if self.cpus else ""
+        return f"ReplicaSpec({self.device}{cores}, threads={self.threads})"
+
+
+def parse_replicas(spec: str) -> list:
+    """
+    Replica specs from a string such as "cuda*2" (one replica per GPU), "cpu*4" (the available cores split
+    into 4 groups) or an explicit ";"-separated list like "cuda:0;cpu:0-3;cpu:4-7,12".
+    """
+    spec = spec.strip()
+    if "*" in spec:
+        device, count = spec.split("*", 1)
+        count = int(count)
+        if device == "cpu":
+            cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+            size = max(1, len(cores) // count)
+            return [ReplicaSpec("cpu", cores[i * size:(i + 1) * size] or cores[-size:]) for i in range(count)]
+        return [ReplicaSpec(f"{device}:{i}") for i in range(count)]
+
+    replicas = []
+    for item in filter(None, (part.strip() for part in spec.split(";"))):
+        if item.startswith("cpu:"):
+            replicas.append(ReplicaSpec("cpu", _parse_cpus(item[len("cpu:"):])))
+        else:
+            replicas.append(ReplicaSpec(item))
+    return replicas
+
+
+def _parse_cpus(text: str) -> list:
+    cpus = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def _format_cpus(cpus) -> str:
+    return ",".join(str(cpu) for cpu in cpus) if len(cpus) < 4 else f"{cpus[0]}-{cpus[-1]}"
+
+
+class StubInference:
+    """
+    Stand-in for SimpleInference without a checkpoint: the same batch interface, where every request costs
+    `work` multiplications of a `size` x `size` matrix on the CPU (following torch.set_num_threads).
+    For smoke tests and scaling benchmarks of the pool on machines that cannot load the real model.
+    """
+
+    def __init__(self, device="cpu", work=20, size=256):
+        self.device = device
+        self.work = work
+        self.matrix = torch.rand(size, size)
+
+    def batch_inference(self, requests: list, streamer=None, cancel=None, **options):
+        results = []
+        for request in requests:
+            self._compute()
+            if streamer is not None:
+                streamer.on_text("[(0, 0)]")
+            results.append({"thinking": "", "answer": "[(0, 0)]", "points": [[0, 0]], "generated_tokens": 0, "stopped_early": False})
+        return results
+
+    def batch_classify(self, requests: list, labels=("same", "different")):
+        results = []
+        for request in requests:
+            self._compute()
+            results.append({"thinking": "", "answer": labels[0], "confidence": 1.0, "scores": {label: float(i == 0) for i, label in enumerate(labels)}})
+        return results
+
+    def forget_image(self, key):
+        pass
+
+    def _compute(self):
+        result = self.matrix
+        for _ in range(self.work):
+            result = torch.tanh(result @ self.matrix)
+
+
+class _PipeStreamer(TextChunkStreamer):
+    """Sends the text of a streamed generation from the replica back to the pool."""
+
+    def __init__(self, tokenizer, conn, request_id):
+        super().__init__(tokenizer)
+        self.conn = conn
+        self.request_id = request_id
+
+    def on_text(self, text: str):
+        self.conn.send(("text", self.request_id, text))
+
+
+def _replica_main(conn, factory, spec: ReplicaSpec):
+    """Entry point of a replica process: load the model, then serve the requests coming over `conn`."""
+    if spec.cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, spec.cpus)
+    if spec.threads:
+        torch.set_num_threads(spec.threads)
+    model = factory(device=spec.device)
+    conn.send(("ready", None, os.getpid()))
+
+    # Messages are read on their own thread, so a "cancel" reaches a generation that is still running
+    jobs = queue.Queue()
+    cancels = {}
+
+    def read():
+        while True:
+            try:
+                kind, request_id, payload = conn.recv()
+            except (EOFError, OSError):
+                kind = "stop"
+            if kind == "stop":
+                jobs.put(None)
+                return
+            if kind == "cancel":
+                if request_id in cancels:
+                    cancels[request_id].set()
+                continue
+            if kind == "run":
+                cancels[request_id] = threading.Event()
+            jobs.put((kind, request_id, payload))
+
+    threading.Thread(target=read, name="replica-reader", daemon=True).start()
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        kind, request_id, payload = job
+        if kind == "forget":
+            model.forget_image(payload)
+            continue
+
+        method, requests, options = payload
+        try:
+            if options.pop("stream", False):
+                options["streamer"] = _PipeStreamer(getattr(getattr(model, "processor", None), "tokenizer", None), conn, request_id)
+            if options.pop("cancellable", False):
+                options["cancel"] = cancels[request_id]
+            conn.send(("result", request_id, getattr(model, method)(requests, **options)))
+        except Exception as e:
+            conn.send(("error", request_id, f"{type(e).__name__}: {e}"))
+        finally:
+            cancels.pop(request_id, None)
+
+
+# Process starts read the state of __main__, so they are serialized
+_start_lock = threading.Lock()
+
+
+@contextmanager
+def _main_script_hidden():
+    """
+    A spawned process normally re-runs the parent's main script before starting, which for New_API.py
+    would load a whole server (and another pool) in every replica. Hide the script while a replica starts;
+    the replica's factory is then unpickled by module name, so it must not be defined in the main script.
+    """
+    main = sys.modules["__main__"]
+    saved = {name: main.__dict__[name] for name in ("__file__", "__spec__") if name in main.__dict__}
+    main.__dict__.pop("__file__", None)
+    main.__spec__ = None
+    try:
+        yield
+    finally:
+        main.__dict__.update(saved)
+
+
+class _Replica:
+    def __init__(self, index: int, spec: ReplicaSpec):
+        self.index = index
+        self.spec = spec
+        self.process = None
+        self.conn = None
+        self.pid = None
+        self.ready = False
+        self.failed = False
+        self.restarts = 0
+        self.served = 0
+        # request_id -> (future, streamer, cancel, cancel_sent)
+        self.pending = {}
+        # Image keys this replica has recently encoded, so their vision embeddings are likely cached there
+        self.recent_keys = OrderedDict()
+        self.send_lock = threading.Lock()
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+
+class ReplicaPool:
+    """
+    N model replicas in their own processes, behind the batch interface of SimpleInference.
+
+    Each replica is pinned to a device or a set of CPU cores (with its own torch thread count, see
+    ReplicaSpec) and loads its own copy of the model with `factory(device=...)`, e.g.
+    `functools.partial(SimpleInference, model_id)` or StubInference. `batch_inference` and
+    `batch_classify` go to the replica with the fewest calls in flight, preferring one that recently
+    saw the same image so its vision cache hits. Requests and results travel over a pipe, image
+    tensors through shared memory. A replica that dies is restarted on its own; the calls it was
+    serving fail with ReplicaError.
+
+    Preprocessing stays in this process on `frontend`, a SimpleInference created with
+    `load_model=False`: encode_image, the reference cache, pixel budgets and the tokenizer are
+    forwarded to it, so the pool can replace the model in New_API.py. Run BatchingInference with
+    `num_workers=len(pool)` so every replica gets its own batches.
+    """
+
+    def __init__(self, replicas: list, factory, frontend=None, max_restart_delay=30.0, cancel_poll_s=0.02):
+        self.factory = factory
+        self.cancel_poll_s = cancel_poll_s
+        self.frontend = frontend
+        self.max_restart_delay = max_restart_delay
+        self._replicas = [_Replica(i, spec) for i, spec in enumerate(replicas)]
+        self._ids = itertools.count()
+        self._closed = False
+        self._changed = threading.Condition()
+        # Spawn, since CUDA cannot be used in forked processes; torch's context shares tensors through shared memory
+        self._context = mp.get_context("spawn")
+        if frontend is not None and getattr(frontend, "reference_cache", None) is not None:
+            # Evicted references have to be dropped from the replicas' vision caches as well
+            frontend.reference_cache.on_evict = self.forget_image
+
+        for replica in self._replicas:
+            self._start(replica)
+        # Wait until every replica has loaded its model, like loading a single model would
+        with self._changed:
+            self._changed.wait_for(lambda: all(r.ready or r.failed for r in self._replicas))
+        failed = [r.spec for r in self._replicas if r.failed]
+        if failed:
+            self.close()
+            raise ReplicaError(f"Replicas failed to start: {failed}")
+        threading.Thread(target=self._forward_cancels, name="replica-cancels", daemon=True).start()
+        print(f"Inference pool ready: {len(self._replicas)} replicas ({', '.join(repr(r.spec) for r in self._replicas)}).")
+
+    def __len__(self):
+        return len(self._replicas)
+
+    def __getattr__(self, name):
+        # Only called for attributes the pool does not have itself
+        frontend = self.__dict__.get("frontend")
+        if frontend is None:
+            raise AttributeError(name)
+        return getattr(frontend, name)
+
+    def batch_inference(self, requests: list, streamer=None, cancel=None, **options):
+        """SimpleInference.batch_inference on the least-loaded replica. Blocks until it is done."""
+        if streamer is not None:
+            options["stream"] = True
+        if cancel is not None:
+            options["cancellable"] = True
+        return self._call("batch_inference", requests, options, streamer, cancel).result()
+
+    def batch_classify(self, requests: list, labels=("same", "different")):
+        """SimpleInference.batch_classify on the least-loaded replica. Blocks until it is done."""
+        return self._call("batch_classify", requests, {"labels": labels}).result()
+
+    def forget_image(self, key):
+        """Drop an image key here and from every replica's caches."""
+        if self.frontend is not None:
+            self.frontend.forget_image(key)
+        for replica in self._replicas:
+            replica.recent_keys.pop(key, None)
+            if replica.ready:
+                try:
+                    replica.send(("forget", None, key))
+                except OSError:
+                    pass
+
+    def stats(self) -> list:
+        """Per replica: where it runs, calls in flight, calls served and restarts."""
+        return [{
+            "device": replica.spec.device,
+            "cpus": _format_cpus(replica.spec.cpus) if replica.spec.cpus else None,
+            "threads": replica.spec.threads,
+            "pid": replica.pid,
+            "ready": replica.ready,
+            "in_flight": len(replica.pending),
+            "served": replica.served,
+            "restarts": replica.restarts,
+        } for replica in self._replicas]
+
+    def close(self):
+        """Stop every replica, waiting briefly for it to finish what it is serving."""
+        self._closed = True
+        for replica in self._replicas:
+            if replica.conn is not None:
+                try:
+                    replica.send(("stop", None, None))
+                except OSError:
+                    pass
+        for replica in self._replicas:
+            if replica.process is not None:
+                replica.process.join(timeout=10)
+                if replica.process.is_alive():
+                    replica.process.terminate()
+
+    def _call(self, method: str, requests: list, options: dict, streamer=None, cancel=None) -> Future:
+        future = Future()
+        request_id = next(self._ids)
+        key = _image_key(requests)
+        with self._changed:
+            if not self._changed.wait_for(lambda: self._closed or any(r.ready for r in self._replicas), timeout=600):
+                raise ReplicaError("No inference replica is available.")
+            if self._closed:
+                raise ReplicaError("The inference pool has been closed.")
+            replica = min(
+                (r for r in self._replicas if r.ready),
+                key=lambda r: (len(r.pending), key not in r.recent_keys, r.index)
+            )
+            replica.pending[request_id] = [future, streamer, cancel, False]
+            if key is not None:
+                replica.recent_keys[key] = True
+                replica.recent_keys.move_to_end(key)
+                while len(replica.recent_keys) > 256:
+                    replica.recent_keys.popitem(last=False)
+
+        try:
+            replica.send(("run", request_id, (method, requests, options)))
+        except OSError as e:
+            # The replica died; its reader thread restarts it
+            with self._changed:
+                replica.pending.pop(request_id, None)
+            future.set_exception(ReplicaError(f"Replica {replica.index} is not reachable: {e}"))
+        return future
+
+    def _start(self, replica: _Replica):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_replica_main, args=(child_conn, self.factory, replica.spec), name=f"inference-replica-{replica.index}", daemon=True)
+        with _start_lock, _main_script_hidden():
+            process.start()
+        # Without the parent's copy of the child end, recv raises EOFError as soon as the replica dies
+        child_conn.close()
+        replica.process, replica.conn = process, parent_conn
+        threading.Thread(target=self._read, args=(replica, parent_conn), name=f"replica-{replica.index}-reader", daemon=True).start()
+
+    def _read(self, replica: _Replica, conn):
+        """Route the messages of one replica process to their futures and streamers, and restart it if it dies."""
+        started_at = time.monotonic()
+        while True:
+            try:
+                kind, request_id, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            if kind == "ready":
+                with self._changed:
+                    replica.ready, replica.pid = True, payload
+                    self._changed.notify_all()
+                continue
+
+            entry = replica.pending.get(request_id)
+            if entry is None:
+                continue
+            future, streamer = entry[0], entry[1]
+            if kind == "text":
+                if streamer is not None:
+                    streamer.on_text(payload)
+                continue
+
+            with self._changed:
+                replica.pending.pop(request_id, None)
+                replica.served += 1
+                self._changed.notify_all()
+            if kind == "result":
+                future.set_result(payload)
+            else:
+                future.set_exception(ReplicaError(payload))
+
+        # The replica is gone: fail what it was serving, then bring it back unless the pool is closing
+        with self._changed:
+            was_ready = replica.ready
+            replica.ready = False
+            pending, replica.pending = replica.pending, {}
+            replica.recent_keys.clear()
+            # A replica that cannot even load its model the first time is a configuration error, not a crash
+            if not was_ready and replica.restarts == 0:
+                replica.failed = True
+            self._changed.notify_all()
+        for future, *_ in pending.values():
+            future.set_exception(ReplicaError(f"Replica {replica.index} ({replica.spec.device}) died while serving this request."))
+        replica.process.join(timeout=1)
+        if self._closed or replica.failed:
+            return
+
+        replica.restarts += 1
+        print(f"Replica {replica.index} ({replica.spec.device}) exited with code {replica.process.exitcode} after {time.monotonic() - started_at:.0f}s. Restarting it.")
+        # Back off when a replica keeps crashing right after starting
+        time.sleep(min(self.max_restart_delay, 2 ** min(replica.restarts - 1, 5)))
+        if not self._closed:
+            self._start(replica)
+
+
+    def _forward_cancels(self):
+        """
+        The cancel events of the callers cannot cross processes: poll them and send "cancel" to the
+        replica as soon as one is set, also while the replica is still in prefill.
+        """
+        while not self._closed:
+            time.sleep(self.cancel_poll_s)
+            for replica in self._replicas:
+                with self._changed:
+                    cancelled = [(request_id, entry) for request_id, entry in replica.pending.items()
+                                 if entry[2] is not None and not entry[3] and entry[2].is_set()]
+                for request_id, entry in cancelled:
+                    entry[3] = True
+                    try:
+                        replica.send(("cancel", request_id, None))
+                    except OSError:
+                        pass
+
+
+def _image_key(requests: list):
+    """Cache key of the first image of a call, used to send calls on the same image to the same replica."""
+    for request in requests:
+        images = request.get("image")
+        first = images[0] if isinstance(images, list) and images else images
+        if isinstance(first, CachedImage):
+            return first.key
+        if isinstance(first, str):
+            return first
+    return None
@@ -0,0 +1,125 @@
+import copy
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+from structured_output import rescale_result
+
+
+def image_hash(image: Image.Image) -> int:
+    """64-bit difference hash: which of two neighbouring pixels is brighter, on a 9x8 grayscale thumbnail."""
+    pixels = list(image.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return bits
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+class _Entry:
+    __slots__ = ("key", "hash", "size", "result", "created_at", "saved_ms")
+
+    def __init__(self, key, hash_, size, result, saved_ms):
+        self.key = key
+        self.hash = hash_
+        self.size = size
+        self.result = result
+        self.created_at = time.monotonic()
+        self.saved_ms = saved_ms
+
+
+class ResultCache:
+    """
+    Model results keyed by the request (task, normalized text, generation options, ...) and the
+    perceptual hash of the image, so a resent frame that is the same or nearly the same is answered
+    without running the model again.
+
+    A lookup matches an entry of the same request whose image hash is at most `max_distance` bits
+    away. Coordinates of pointing / grounding / trajectory results are rescaled when the image has
+    a different resolution than the one the entry was computed on. Entries expire after `ttl`
+    seconds; beyond `max_entries` the least recently used ones are dropped.
+    """
+
+    def __init__(self, max_entries=1024, ttl=300.0, max_distance=4):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self._entries = OrderedDict()
+        # Request key -> ids of the entries stored for it
+        self._by_key = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_ms = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, hash_: int, size):
+        """The cached result for `key` on an image like this one (a copy, with "cached": True), or None."""
+        now = time.monotonic()
+        with self._lock:
+            best, best_distance = None, None
+            for entry_id in list(self._by_key.get(key, ())):
+                entry = self._entries[entry_id]
+                if now - entry.created_at > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                distance = (entry.hash ^ hash_).bit_count()
+                if distance <= self.max_distance and (best is None or distance < best_distance):
+                    best, best_distance = entry_id, distance
+
+            if best is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best)
+            entry = self._entries[best]
+            self.hits += 1
+            self.saved_ms += entry.saved_ms
+
+        if entry.size != tuple(size):
+            result = rescale_result(entry.result, size[0] / entry.size[0], size[1] / entry.size[1])
+        else:
+            result = copy.deepcopy(entry.result)
+        result["cached"] = True
+        result["cache_distance"] = best_distance
+        return result
+
+    def put(self, key, hash_: int, size, result: dict):
+        """Store a result; the time it took (from its "timing") counts as saved on every hit."""
+        timing = result.get("timing") or {}
+        saved_ms = timing.get("wait_ms", 0.0) + timing.get("service_ms", 0.0)
+        # The queue wait and stage times were those of the original run, a hit would misreport them as its own
+        result = {name: value for name, value in result.items() if name not in ("timing", "stages")}
+        entry = _Entry(key, hash_, tuple(size), copy.deepcopy(result), saved_ms)
+        with self._lock:
+            entry_id = next(self._ids)
+            self._entries[entry_id] = entry
+            self._by_key.setdefault(key, []).append(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "saved_ms": round(self.saved_ms, 1)
+        }
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        ids = self._by_key[entry.key]
+        ids.remove(entry_id)
+        if not ids:
+            del self._by_key[entry.key]
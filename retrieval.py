@@ -0,0 +1,122 @@
+import re
+import threading
+import zlib
+
+import numpy as np
+
+
+class ReferenceIndex:
+    """
+    Vectorized lookup of RAG reference images by name.
+
+    Every reference name is turned into a hashed character n-gram count vector (`dim` buckets),
+    stored as one row of a NumPy matrix. `search` scores a prompt or object_id against all rows
+    in a single vectorized operation over just the columns of the n-grams the query contains,
+    so lookups do not depend on the order of the references and stay cheap as the dataset grows.
+
+    The score mixes how much of the reference name occurs in the query (containment, so a short
+    name inside a long prompt still scores 1.0) with the cosine similarity of the two vectors
+    (so "kettle button" beats "kettle" for "point to the kettle button"). `match` returns the
+    best reference if it reaches `threshold`, which decides between the RAG and non-RAG tasks.
+    References can be added at any time; only the new row is computed.
+    """
+
+    def __init__(self, threshold=0.75, ngram=3, dim=4096, containment_weight=0.8):
+        self.threshold = float(threshold)
+        self.ngram = int(ngram)
+        self.dim = int(dim)
+        self.containment_weight = float(containment_weight)
+        self.names = []
+        self.paths = []
+        self._rows = {}
+        # Column-major, so the columns of a query's n-grams are contiguous; grown by doubling
+        self._counts = np.zeros((16, self.dim), dtype=np.float32, order="F")
+        self._totals = np.zeros(16, dtype=np.float32)
+        self._norms = np.zeros(16, dtype=np.float32)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return self.normalize(name) in self._rows
+
+    def add(self, name: str, path: str):
+        """Add a reference (or point an existing name at a new image)."""
+        if not path:
+            print(f"Reference '{name}' has no image. Leaving it out of the index.")
+            return
+
+        key = self.normalize(name)
+        counts = self.vectorize(name)
+        with self._lock:
+            row = self._rows.get(key)
+            if row is not None:
+                self.paths[row] = path
+                return
+            row = len(self.names)
+            if row == len(self._totals):
+                self._grow()
+            self._counts[row] = counts
+            self._totals[row] = counts.sum()
+            self._norms[row] = np.linalg.norm(counts)
+            self._rows[key] = row
+            self.names.append(name)
+            self.paths.append(path)
+
+    def add_many(self, references: dict):
+        """Add every name -> path pair of a dict like DATASET_IMAGES."""
+        for name, path in references.items():
+            self.add(name, path)
+
+    def search(self, query: str, k=3) -> list:
+        """The top-k references for `query` as (name, path, score) tuples, best first."""
+        query_counts = self.vectorize(query)
+        columns = np.flatnonzero(query_counts)
+        query_values = query_counts[columns]
+
+        with self._lock:
+            size = len(self.names)
+            if size == 0 or len(columns) == 0:
+                return []
+            counts = self._counts[:size, columns]
+            totals, norms = self._totals[:size], self._norms[:size]
+            names, paths = self.names[:size], self.paths[:size]
+
+            # Both scores only involve the n-grams present in the query
+            containment = np.minimum(counts, query_values).sum(axis=1) / np.maximum(totals, 1.0)
+            cosine = (counts @ query_values) / np.maximum(norms * np.linalg.norm(query_values), 1e-12)
+        scores = self.containment_weight * containment + (1.0 - self.containment_weight) * cosine
+
+        k = min(k, len(names))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(names[i], paths[i], float(scores[i])) for i in top]
+
+    def match(self, query: str):
+        """The best (name, path, score) for `query` if it reaches the threshold, otherwise None."""
+        results = self.search(query, k=1)
+        if results and results[0][2] >= self.threshold:
+            return results[0]
+        return None
+
+    def normalize(self, text: str) -> str:
+        """Lower case, punctuation to spaces, single spaces."""
+        return " ".join(re.sub(r"[^0-9a-z]+", " ", text.lower()).split())
+
+    def vectorize(self, text: str) -> np.ndarray:
+        """Hashed character n-gram counts of the normalized text, padded with spaces to mark word boundaries."""
+        text = f" {self.normalize(text)} "
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for i in range(len(text) - self.ngram + 1):
+            # crc32 rather than hash(), which is salted per process
+            vector[zlib.crc32(text[i:i + self.ngram].encode()) % self.dim] += 1.0
+        return vector
+
+    def _grow(self):
+        capacity = 2 * len(self._totals)
+        counts = np.zeros((capacity, self.dim), dtype=np.float32, order="F")
+        counts[:len(self._totals)] = self._counts
+        self._counts = counts
+        self._totals = np.resize(self._totals, capacity)
+        self._norms = np.resize(self._norms, capacity)
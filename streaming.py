@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+from transformers.generation.streamers import BaseStreamer
+
+
+def sse_event(event: str, data) -> str:
+    """Format one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class TextChunkStreamer(BaseStreamer):
+    """
+    Streamer for `generate` that decodes the new tokens and hands every new piece of text to `on_text`,
+    then calls `close` once generation has ended. Unlike TextStreamer it does not hold text back until
+    a word boundary, so a closing ")" is delivered with the token that produced it. Only batches of one
+    sequence are supported.
+    """
+
+    def __init__(self, tokenizer, skip_prompt=True):
+        self.tokenizer = tokenizer
+        self.skip_prompt = skip_prompt
+        self._next_tokens_are_prompt = True
+        self._token_cache = []
+        self._emitted = 0
+
+    def put(self, value):
+        if value.dim() > 1:
+            if value.shape[0] > 1:
+                raise ValueError(f"{type(self).__name__} only supports a batch size of 1.")
+            value = value[0]
+        if self.skip_prompt and self._next_tokens_are_prompt:
+            self._next_tokens_are_prompt = False
+            return
+
+        self._token_cache.extend(value.tolist())
+        text = self.tokenizer.decode(self._token_cache, skip_special_tokens=True)
+        # A trailing replacement character means the token ended inside a multi-byte character
+        if text.endswith("�"):
+            return
+        self._send(text[self._emitted:])
+        self._emitted = len(text)
+
+    def end(self):
+        text = self.tokenizer.decode(self._token_cache, skip_special_tokens=True)
+        self._send(text[self._emitted:])
+        self._emitted = len(text)
+        self.close()
+
+    def on_text(self, text: str):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def _send(self, text: str):
+        if text:
+            self.on_text(text)
+
+
+class AsyncTextStreamer(TextChunkStreamer):
+    """
+    TextChunkStreamer that hands decoded text to an asyncio event loop.
+
+    Generation runs on the inference worker thread; every new piece of text is put on an
+    asyncio.Queue of `loop`, followed by None once generation has ended. `on_text` can also be
+    called directly, e.g. with text generated in another process.
+    """
+
+    def __init__(self, tokenizer, loop: asyncio.AbstractEventLoop, skip_prompt=True):
+        super().__init__(tokenizer, skip_prompt=skip_prompt)
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def on_text(self, text: str):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+
+    def close(self):
+        """Signal the consumer that no more text will come (also used when generation fails)."""
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
@@ -0,0 +1,149 @@
+import copy
+import re
+
+# Which structured field each task's answer is parsed into
+TASK_OUTPUT_TYPES = {
+    "pointing": "points",
+    "pointing_based_on_reference": "points",
+    "pointing_within_box": "points",
+    "affordance": "boxes",
+    "grounding": "boxes",
+    "trajectory": "trajectory",
+}
+
+# Token budgets for answers generated without thinking. A point costs roughly 8-10 tokens
+# and a box 15, so these leave room for ~10 points / ~6 boxes before the list is cut off.
+TASK_TOKEN_BUDGETS = {
+    "pointing": 128,
+    "pointing_based_on_reference": 128,
+    "pointing_within_box": 128,
+    "affordance": 48,
+    "grounding": 128,
+    "trajectory": 160,
+}
+
+NUMBER = r"-?\d+(?:\.\d+)?"
+POINT_PATTERN = re.compile(rf"[\(\[]\s*({NUMBER})\s*,\s*({NUMBER})\s*[\)\]]")
+BOX_PATTERN = re.compile(rf"[\(\[]\s*({NUMBER})\s*,\s*({NUMBER})\s*,\s*({NUMBER})\s*,\s*({NUMBER})\s*[\)\]]")
+
+
+def _number(value: str):
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+def scale_item(item: list, scale_x: float, scale_y: float) -> list:
+    """A point ([x, y]) or box ([x1, y1, x2, y2]) with its x and y coordinates scaled and rounded to pixels."""
+    return [_number(f"{value * (scale_x if i % 2 == 0 else scale_y):.0f}") for i, value in enumerate(item)]
+
+
+def rescale_result(result: dict, scale_x: float, scale_y: float) -> dict:
+    """A copy of a pointing / grounding / trajectory result with its coordinates (and answer text) scaled."""
+    result = copy.deepcopy(result)
+    for field in ("points", "trajectory", "boxes"):
+        if field in result:
+            result[field] = [scale_item(item, scale_x, scale_y) for item in result[field]]
+
+    def scale_match(match):
+        values = [float(value) * (scale_x if i % 2 == 0 else scale_y) for i, value in enumerate(match.groups())]
+        text = match.group(0)
+        return text[0] + ", ".join(f"{value:.0f}" for value in values) + text[-1]
+
+    if isinstance(result.get("answer"), str):
+        result["answer"] = POINT_PATTERN.sub(scale_match, BOX_PATTERN.sub(scale_match, result["answer"]))
+    return result
+
+
+def answer_text(output_text: str, enable_thinking: bool):
+    """The part of a (partial) generation that holds the answer, or None while the model is still thinking."""
+    if enable_thinking:
+        if "</think>" not in output_text:
+            return None
+        output_text = output_text.split("</think>", 1)[1]
+    return output_text.replace("<answer>", "")
+
+
+def closed_list_end(text: str) -> int:
+    """
+    Index just after the first top-level [...] list once its brackets are balanced, or -1 if
+    the list has not been closed yet.
+    """
+    start = text.find("[")
+    if start < 0:
+        return -1
+
+    depth = 0
+    for i in range(start, len(text)):
+        if text[i] in "[(":
+            depth += 1
+        elif text[i] in "])":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+    return -1
+
+
+def parse_points(text: str) -> list:
+    """All (x, y) / [x, y] pairs in the text, as [x, y] lists."""
+    return [[_number(x), _number(y)] for x, y in POINT_PATTERN.findall(text)]
+
+
+def parse_boxes(text: str) -> list:
+    """All [x1, y1, x2, y2] boxes in the text."""
+    return [[_number(value) for value in box] for box in BOX_PATTERN.findall(text)]
+
+
+def parse_structured_answer(task: str, answer: str) -> dict:
+    """
+    Parse the answer of a pointing / grounding / affordance / trajectory task into typed JSON,
+    e.g. {"points": [[343, 526]]}. Other tasks return an empty dict.
+    """
+    output_type = TASK_OUTPUT_TYPES.get(task)
+    if output_type is None:
+        return {}
+
+    end = closed_list_end(answer)
+    answer = answer[:end] if end >= 0 else answer
+    if output_type == "boxes":
+        return {"boxes": parse_boxes(answer)}
+    return {output_type: parse_points(answer)}
+
+
+class StreamingAnswerParser:
+    """
+    Incremental counterpart of `parse_structured_answer` for streamed generations.
+
+    `feed` takes the next chunk of generated text and returns the points (or boxes) that were
+    completed by it, so each coordinate tuple can be used as soon as its closing bracket arrives.
+    Nothing is returned while the model is still thinking or after the answer list has closed.
+    Coordinates are multiplied by `scale` (x, y), e.g. to map them from the model input back to the original image.
+    """
+
+    def __init__(self, task: str, enable_thinking: bool, scale=(1.0, 1.0)):
+        self.output_type = TASK_OUTPUT_TYPES.get(task)
+        self.pattern = BOX_PATTERN if self.output_type == "boxes" else POINT_PATTERN
+        self.enable_thinking = enable_thinking
+        self.scale = scale
+        self.text = ""
+        self.items = []
+        self.closed = False
+
+    def feed(self, chunk: str) -> list:
+        self.text += chunk
+        if self.output_type is None or self.closed:
+            return []
+
+        answer = answer_text(self.text, self.enable_thinking)
+        if answer is None:
+            return []
+        end = closed_list_end(answer)
+        if end >= 0:
+            answer = answer[:end]
+            self.closed = True
+
+        items = [[_number(value) for value in match] for match in self.pattern.findall(answer)]
+        new_items = items[len(self.items):]
+        self.items = items
+        if self.scale != (1.0, 1.0):
+            new_items = [scale_item(item, *self.scale) for item in new_items]
+        return new_items
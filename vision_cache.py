@@ -0,0 +1,121 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class VisionEmbeddingCache:
+    """
+    LRU cache of vision-encoder outputs, one entry per image key (an image_id for uploads,
+    the reference cache key for RAG references).
+
+    SimpleInference routes the vision tower through `encode`, so an image that was already
+    seen skips the vision tower and only its text tokens are new work. Entries are dropped
+    least recently used first once their total size exceeds `max_bytes`, or explicitly via
+    `invalidate` when the image they belong to goes away.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = int(max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def encode(self, keys: list, pixel_values, grid_thw, encode_fn, merge_length: int):
+        """
+        Return the vision embeddings for a batch of images, computing only the ones not cached.
+
+        `keys` has one entry per image (None means "do not cache"), `pixel_values` holds the
+        patches of all images back to back and `encode_fn(pixel_values, grid_thw)` is the real
+        vision tower. Returns None if the vision tower output cannot be split per image.
+        """
+        patch_counts = grid_thw.prod(-1).tolist()
+        patches = pixel_values.split(patch_counts)
+        embeddings = [None] * len(keys)
+
+        with self._lock:
+            for i, key in enumerate(keys):
+                cached = self._entries.get(key) if key is not None else None
+                if cached is not None:
+                    self._entries.move_to_end(key)
+                    embeddings[i] = cached
+                    self.hits += 1
+
+        # The same image can appear twice in one batch; encode it once
+        todo, first_index = [], {}
+        for i, key in enumerate(keys):
+            if embeddings[i] is not None:
+                continue
+            if key is not None and key in first_index:
+                continue
+            if key is not None:
+                first_index[key] = i
+            todo.append(i)
+
+        if todo:
+            output = encode_fn(torch.cat([patches[i] for i in todo]), grid_thw[todo])
+            if not isinstance(output, torch.Tensor):
+                return None
+            computed = output.split([patch_counts[i] // merge_length for i in todo])
+            with self._lock:
+                for i, embedding in zip(todo, computed):
+                    embeddings[i] = embedding
+                    self.misses += 1
+                    if keys[i] is not None:
+                        # Clone so the entry does not keep the whole batch output alive
+                        self._store(keys[i], embedding.clone())
+
+        for i, key in enumerate(keys):
+            if embeddings[i] is None:
+                embeddings[i] = embeddings[first_index[key]]
+
+        return torch.cat(embeddings)
+
+    def invalidate(self, key):
+        """
+        Drop the embeddings of an image that is no longer stored, including its encodings at
+        other pixel budgets (keyed `(key, budget)`).
+        """
+        with self._lock:
+            keys = [entry for entry in self._entries if entry == key or (isinstance(entry, tuple) and len(entry) == 2 and entry[0] == key)]
+            for entry in keys:
+                self._bytes -= self._nbytes(self._entries.pop(entry))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _store(self, key, embedding):
+        if key in self._entries:
+            self._bytes -= self._nbytes(self._entries.pop(key))
+        self._entries[key] = embedding
+        self._bytes += self._nbytes(embedding)
+        while self._bytes > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= self._nbytes(evicted)
+            self.evictions += 1
+
+    @staticmethod
+    def _nbytes(tensor):
+        return tensor.element_size() * tensor.nelement()